@@ -2,27 +2,20 @@ import numpy as np
 import nibabel as nb
 
 
-def seed_based_FC(bold_file, brain_mask, seed_list):
+def seed_based_FC(bold_file, brain_mask, seed_list, store_file=None, cache_dir=None):
     import os
     import nibabel as nb
     import numpy as np
-    from rabies.analysis_pkg.analysis_functions import seed_corr
+    from rabies.analysis_pkg.analysis_functions import cached_seed_resampling, seed_corr_maps
 
     if len(seed_list)>0:
-        mask_array = np.asarray(nb.load(brain_mask).dataobj)
-        mask_vector = mask_array.reshape(-1)
-        mask_indices = (mask_vector==True)
-        mask_vector = mask_vector.astype(float)
-
-        corr_maps = np.zeros(list(mask_array.shape)+[len(seed_list)])
-        i = 0
-        for seed in seed_list:
-            mask_vector[mask_indices] = seed_corr(bold_file, brain_mask, seed)
-            corr_maps[:,:,:,i] = mask_vector.reshape(mask_array.shape)
-            i+=1
+        from rabies.preprocess_pkg.masking import scatter_masked
+        resampled_seeds = cached_seed_resampling(seed_list, brain_mask, cache_dir=cache_dir)
+        corr_maps = scatter_masked(seed_corr_maps(
+            bold_file, brain_mask, resampled_seeds, store_file=store_file).T, brain_mask)
 
         corr_map_file = os.path.abspath(os.path.basename(
-            seed).split('.nii')[0]+'_corr_map.nii.gz')
+            seed_list[-1]).split('.nii')[0]+'_corr_map.nii.gz')
         nb.Nifti1Image(corr_maps, nb.load(brain_mask).affine, nb.load(
             brain_mask).header).to_filename(corr_map_file)
         return corr_map_file
@@ -30,31 +23,89 @@ def seed_based_FC(bold_file, brain_mask, seed_list):
         return None
 
 
-def seed_corr(bold_file, brain_mask, seed):
+def cached_seed_resampling(seed_list, brain_mask, cache_dir=None):
+    '''
+    Resamples the seeds onto the grid of the brain mask with label interpolation. The resampled seeds are
+    stored in cache_dir under a key derived from the content of the seed file and the mask grid, so that
+    each seed is only resampled once for a given grid. Without cache_dir, the working directory is used.
+    '''
     import os
-    from nilearn.input_data import NiftiMasker
-
-    resampled = os.path.abspath('resampled.nii.gz')
-    os.system('antsApplyTransforms -i %s -r %s -o %s -n GenericLabel' %
-              (seed, brain_mask, resampled))
-
-    masker = NiftiMasker(mask_img=nb.load(resampled), standardize=False, verbose=0)
-    # extract the voxel timeseries within the mask
-    voxel_seed_timeseries = masker.fit_transform(bold_file)
-    # take the mean ROI timeseries
-    seed_timeseries = np.mean(voxel_seed_timeseries, axis=1)
-
-    mask_array = np.asarray(nb.load(brain_mask).dataobj)
-    mask_vector = mask_array.reshape(-1)
-    mask_indices = (mask_vector==True)
-
-    timeseries_array = np.asarray(nb.load(bold_file).dataobj)
-    sub_timeseries = np.zeros([mask_indices.sum(), timeseries_array.shape[3]])
-    for t in range(timeseries_array.shape[3]):
-        sub_timeseries[:, t] = (
-            timeseries_array[:, :, :, t].reshape(-1))[mask_indices]
-
-    corrs = vcorrcoef(sub_timeseries, seed_timeseries)
+    import hashlib
+    from rabies.preprocess_pkg.utils import file_hash, resample_label_images
+    from rabies.preprocess_pkg.image_io import read_image, read_image_information
+
+    if cache_dir is None:
+        cache_dir = os.getcwd()
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    grid = read_image_information(brain_mask)
+    grid_key = str((grid.GetSize(), np.round(grid.GetOrigin(), 6).tolist(),
+                    np.round(grid.GetSpacing(), 6).tolist(), np.round(grid.GetDirection(), 6).tolist()))
+
+    resampled_seeds = []
+    to_resample = []
+    for seed in seed_list:
+        key = hashlib.sha1(('%s,%s' % (file_hash(seed), grid_key)).encode())
+        resampled = '%s/%s_%s.nii.gz' % (cache_dir, os.path.basename(
+            seed).split('.nii')[0], key.hexdigest())
+        resampled_seeds.append(resampled)
+        if os.path.isfile(resampled):
+            print("Using cached resampled seed %s" % (resampled,))
+        elif resampled not in [out for seed, out in to_resample]:
+            to_resample.append((seed, resampled))
+
+    if len(to_resample) > 0:
+        # write under temporary names to avoid exposing partial files to concurrent nodes
+        tmp_files = ['%s/.%s_%s.nii.gz' % (cache_dir, os.path.basename(resampled).split('.nii')[0], os.getpid())
+                     for seed, resampled in to_resample]
+        resample_label_images([seed for seed, resampled in to_resample],
+                              read_image(brain_mask), tmp_files)
+        for tmp_file, (seed, resampled) in zip(tmp_files, to_resample):
+            os.replace(tmp_file, resampled)
+    return resampled_seeds
+
+
+def seed_corr_maps(bold_file, brain_mask, seed_files, store_file=None):
+    '''
+    Returns the num_voxel X num_seed matrix of correlations between the voxel timeseries within the brain
+    mask and the mean timeseries of each seed, from a single read of the bold. The seeds must be on the
+    grid of the brain mask (see cached_seed_resampling).
+    '''
+    from scipy import sparse
+    from rabies.preprocess_pkg.masking import get_mask_indices
+
+    brain_array = get_mask_indices(brain_mask)[0]
+    seed_arrays = [np.asarray(nb.load(seed).dataobj) > 0 for seed in seed_files]
+    # voxels are read once over the union of the brain mask and the seeds, which may overlap
+    union = brain_array.copy()
+    for seed_array in seed_arrays:
+        union |= seed_array
+    brain_columns = brain_array[union]
+    # sparse num_seed X num_voxel matrix averaging the voxels of each seed
+    seed_columns = sparse.csr_matrix(np.array([seed_array[union] for seed_array in seed_arrays], dtype=float))
+    with np.errstate(divide='ignore'):
+        reduction = sparse.diags(1./np.asarray(seed_columns.sum(axis=1)).reshape(-1)).dot(seed_columns)
+
+    timeseries = None
+    if store_file is not None:
+        from rabies.conf_reg_pkg.utils import read_timeseries_store
+        timeseries = read_timeseries_store(store_file, union)
+    if timeseries is None:
+        from rabies.preprocess_pkg.masking import extract_masked
+        timeseries = extract_masked(bold_file, union)
+
+    # the mean timeseries of all seeds
+    seed_timeseries = reduction.dot(timeseries.T).T
+    sub_timeseries = timeseries[:, brain_columns]
+    del timeseries
+
+    # correlations are the products of the centered, unit-norm timeseries
+    def normalize(X):
+        X = X-X.mean(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return X/np.sqrt((X**2).sum(axis=0))
+    corrs = normalize(sub_timeseries).T.dot(normalize(seed_timeseries))
     corrs[np.isnan(corrs)] = 0
     return corrs
 
@@ -68,6 +119,22 @@ def vcorrcoef(X, y):  # return a correlation between each row of X with y
     return r
 
 
+def load_masked_timeseries(bold_file, mask, store_file=None):
+    '''
+    Returns the timepoint X voxel matrix of the voxels within mask (a mask file or array). The voxels are
+    read from the timeseries store if one is provided and includes them, otherwise they are extracted
+    from bold_file.
+    '''
+    from rabies.preprocess_pkg.masking import get_mask_indices, extract_masked
+    mask_array = get_mask_indices(mask)[0]
+    if store_file is not None:
+        from rabies.conf_reg_pkg.utils import read_timeseries_store
+        timeseries = read_timeseries_store(store_file, mask_array)
+        if timeseries is not None:
+            return timeseries
+    return extract_masked(bold_file, mask)
+
+
 def get_CAPs(data, volumes, n_clusters):
     from sklearn.cluster import KMeans
     kmeans = KMeans(n_clusters=n_clusters, n_init=10, max_iter=300)
@@ -81,10 +148,8 @@ def get_CAPs(data, volumes, n_clusters):
 
 
 def recover_3D(mask_file, vector_map):
-    brain_mask = np.asarray(nb.load(mask_file).dataobj)
-    volume_indices = brain_mask.astype(bool)
-    volume = np.zeros(brain_mask.shape)
-    volume[volume_indices] = vector_map
+    from rabies.preprocess_pkg.masking import scatter_masked
+    volume = scatter_masked(vector_map, mask_file)
     volume_img = nb.Nifti1Image(volume, nb.load(
         mask_file).affine, nb.load(mask_file).header)
     return volume_img
@@ -92,15 +157,8 @@ def recover_3D(mask_file, vector_map):
 
 def recover_3D_mutiple(mask_file, vector_maps):
     # vector maps of shape num_volumeXnum_voxel
-    brain_mask = np.asarray(nb.load(mask_file).dataobj)
-    volume_indices = brain_mask.astype(bool)
-    shape = (brain_mask.shape[0], brain_mask.shape[1],
-             brain_mask.shape[2], vector_maps.shape[0])
-    volumes = np.zeros(shape)
-    for i in range(vector_maps.shape[0]):
-        volume = volumes[:, :, :, i]
-        volume[volume_indices] = vector_maps[i, :]
-        volumes[:, :, :, i] = volume
+    from rabies.preprocess_pkg.masking import scatter_masked
+    volumes = scatter_masked(vector_maps, mask_file)
     volume_img = nb.Nifti1Image(volumes, nb.load(
         mask_file).affine, nb.load(mask_file).header)
     return volume_img
@@ -124,67 +182,160 @@ FC matrix
 '''
 
 
-def run_FC_matrix(bold_file, mask_file, atlas, roi_type='parcellated'):
+def run_FC_matrix(bold_file, mask_file, atlas, roi_type='parcellated', store_file=None, voxelwise_format='npy', top_k=0, threshold=0.25):
     import os
     import pickle
     import pathlib  # Better path manipulation
     filename_split = pathlib.Path(bold_file).name.rsplit(".nii")
     figname = os.path.abspath(filename_split[0]+'_FC_matrix.png')
 
-    from rabies.analysis_pkg.analysis_functions import parcellated_FC_matrix, voxelwise_FC_matrix, plot_matrix
+    from rabies.analysis_pkg.analysis_functions import parcellated_FC_matrix, voxelwise_FC_matrix, plot_matrix, load_masked_timeseries, recover_3D
     if roi_type == 'parcellated':
-        corr_matrix = parcellated_FC_matrix(bold_file, atlas)
+        corr_matrix = parcellated_FC_matrix(bold_file, atlas, store_file=store_file)
+        plot_matrix(figname, corr_matrix)
+
+        data_file = os.path.abspath(filename_split[0]+'_FC_matrix.pkl')
+        with open(data_file, 'wb') as handle:
+            pickle.dump(corr_matrix, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        return data_file, figname, None, None
     elif roi_type == 'voxelwise':
-        corr_matrix = voxelwise_FC_matrix(bold_file, mask_file)
+        extension = {'pkl': 'pkl', 'npy': 'npy',
+                     'h5': 'h5', 'sparse': 'npz'}[voxelwise_format]
+        data_file = os.path.abspath(filename_split[0]+'_FC_matrix.'+extension)
+        sub_timeseries = load_masked_timeseries(
+            bold_file, mask_file, store_file=store_file)
+        degree, GBC, sample_matrix = voxelwise_FC_matrix(
+            sub_timeseries, data_file, output_format=voxelwise_format, top_k=top_k, threshold=threshold)
+        # the figure displays the correlations among a regular subsample of the voxels
+        plot_matrix(figname, sample_matrix)
+
+        degree_file = os.path.abspath(filename_split[0]+'_FC_degree.nii.gz')
+        recover_3D(mask_file, degree).to_filename(degree_file)
+        GBC_file = os.path.abspath(filename_split[0]+'_FC_GBC.nii.gz')
+        recover_3D(mask_file, GBC).to_filename(GBC_file)
+        return data_file, figname, degree_file, GBC_file
     else:
         raise ValueError(
             "Invalid --ROI_type provided: %s. Must be either 'parcellated' or 'voxelwise.'" % (roi_type))
-    plot_matrix(figname, corr_matrix)
-
-    data_file = os.path.abspath(filename_split[0]+'_FC_matrix.pkl')
-    with open(data_file, 'wb') as handle:
-        pickle.dump(corr_matrix, handle, protocol=pickle.HIGHEST_PROTOCOL)
-    return data_file, figname
-
-
-def voxelwise_FC_matrix(bold_file, mask_file):
-    brain_mask = np.asarray(nb.load(mask_file).dataobj)
-    volume_indices = brain_mask.astype(bool)
-
-    timeseries_array = np.asarray(nb.load(bold_file).dataobj)
-    sub_timeseries = np.zeros(
-        [timeseries_array.shape[3], volume_indices.sum()])
-    for t in range(timeseries_array.shape[3]):
-        sub_timeseries[t, :] = timeseries_array[:, :, :, t][volume_indices]
-
-    corr_matrix = np.corrcoef(sub_timeseries.T)
-    return corr_matrix
 
 
-def extract_timeseries(bold_file, atlas):
-    from nilearn.input_data import NiftiMasker
-    atlas_img = nb.load(atlas)
-    atlas_data = np.asarray(atlas_img.dataobj)
-    max_int = atlas_data.max()
+def voxelwise_FC_matrix(sub_timeseries, out_file, output_format='npy', top_k=0, threshold=0.25, block_size=None, max_sample=1000):
+    '''
+    Computes the correlation matrix between all voxels of a timepoint X voxel timeseries, in blocks of rows
+    from the z-scored timeseries, and streams the blocks to out_file. The output_format is either a float32
+    memory-mapped .npy ('npy') or HDF5 ('h5') matrix, a dense float32 pickled matrix ('pkl'), which is
+    held in memory, or a sparse CSR
+    matrix saved with scipy.sparse.save_npz ('sparse'), which keeps the top_k strongest edges of each
+    voxel, or all edges with |r| >= threshold if top_k is 0.
+    The degree (number of edges with r >= threshold) and global brain connectivity (GBC; mean
+    correlation with all other voxels) of each voxel are derived during the same pass, and are returned
+    together with the correlation matrix among a subsample of at most max_sample voxels.
+    '''
+    import pickle
+    from scipy import sparse
+
+    num_voxels = sub_timeseries.shape[1]
+    if block_size is None:
+        # blocks of rows of about 256MB
+        block_size = max(1, int(2**25/num_voxels))
+
+    # correlations are the products of the centered, unit-norm timeseries
+    Z = sub_timeseries-sub_timeseries.mean(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Z /= np.sqrt((Z**2).sum(axis=0))
+
+    if output_format == 'pkl':
+        corr_matrix = np.zeros([num_voxels, num_voxels], dtype='float32')
+    elif output_format == 'npy':
+        corr_matrix = np.lib.format.open_memmap(
+            out_file, mode='w+', dtype='float32', shape=(num_voxels, num_voxels))
+    elif output_format == 'h5':
+        import h5py
+        store = h5py.File(out_file, 'w')
+        corr_matrix = store.create_dataset('FC_matrix', shape=(num_voxels, num_voxels), dtype='float32',
+                                           chunks=(min(block_size, num_voxels), num_voxels))
+    elif output_format == 'sparse':
+        data = []
+        indices = []
+        indptr = [np.zeros(1, dtype=int)]
+    else:
+        raise ValueError(
+            "Invalid voxelwise FC output format: %s. Must be one of 'pkl', 'npy', 'h5' or 'sparse'." % (output_format))
+
+    degree = np.zeros(num_voxels)
+    GBC = np.zeros(num_voxels)
+    for start in range(0, num_voxels, block_size):
+        end = min(start+block_size, num_voxels)
+        block = Z[:, start:end].T.dot(Z)
+        np.clip(block, -1, 1, out=block)
+
+        if output_format == 'sparse':
+            edges = np.nan_to_num(block)
+            # self-connections are excluded
+            edges[np.arange(end-start), np.arange(start, end)] = 0
+            if top_k > 0:
+                # a voxel has at most num_voxels-1 edges, and none within a single-voxel mask
+                k = min(top_k, num_voxels-1)
+                if k > 0:
+                    cols = np.sort(np.argpartition(-np.abs(edges), k-1, axis=1)[:, :k], axis=1).reshape(-1)
+                else:
+                    cols = np.zeros(0, dtype=int)
+                rows = np.repeat(np.arange(end-start), k)
+            else:
+                rows, cols = np.nonzero(np.abs(edges) >= threshold)
+            data.append(edges[rows, cols].astype('float32'))
+            indices.append(cols)
+            indptr.append(indptr[-1][-1]+np.bincount(rows, minlength=end-start).cumsum())
+        else:
+            corr_matrix[start:end, :] = block
+
+        block = np.nan_to_num(block)
+        block[np.arange(end-start), np.arange(start, end)] = 0
+        degree[start:end] = (block >= threshold).sum(axis=1)
+        GBC[start:end] = block.sum(axis=1)/max(num_voxels-1, 1)
+        del block
+
+    if output_format == 'pkl':
+        with open(out_file, 'wb') as handle:
+            pickle.dump(corr_matrix, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        del corr_matrix
+    elif output_format == 'npy':
+        corr_matrix.flush()
+        del corr_matrix
+    elif output_format == 'h5':
+        store.close()
+    elif output_format == 'sparse':
+        sparse.save_npz(out_file, sparse.csr_matrix((np.concatenate(data), np.concatenate(indices), np.concatenate(indptr)),
+                                                    shape=(num_voxels, num_voxels)))
+
+    sample = np.arange(0, num_voxels, int(np.ceil(num_voxels/max_sample)))
+    sample_matrix = np.clip(Z[:, sample].T.dot(Z[:, sample]), -1, 1)
+    return degree, GBC, sample_matrix
+
+
+def extract_timeseries(bold_file, atlas, store_file=None):
+    # the mean timeseries of all atlas labels are extracted in a single pass over the bold
+    from rabies.preprocess_pkg.masking import label_reduction_matrix, extract_label_timeseries
+
+    label_timeseries = None
+    if store_file is not None:
+        from rabies.conf_reg_pkg.utils import read_timeseries_store
+        # read all labeled voxels at once, and average them within each ROI
+        reduction, label_ids, label_mask = label_reduction_matrix(atlas)
+        voxel_timeseries = read_timeseries_store(store_file, label_mask)
+        if voxel_timeseries is not None:
+            label_timeseries = reduction.dot(voxel_timeseries.T).T
+    if label_timeseries is None:
+        label_timeseries, label_ids = extract_label_timeseries(bold_file, atlas)
 
     timeseries_dict = {}
-    for i in range(1, max_int+1):
-        if np.max(i == atlas_data):  # taking a ROI only if it has labeled voxels
-            roi_mask = np.asarray(atlas_data == i, dtype=int)
-            roi_mask_nb = nb.Nifti1Image(roi_mask, nb.load(
-                atlas).affine, nb.load(atlas).header)
-            masker = NiftiMasker(mask_img=roi_mask_nb,
-                                 standardize=False, verbose=0)
-            # extract the voxel timeseries within the mask
-            voxel_timeseries = masker.fit_transform(bold_file)
-            # take the mean ROI timeseries
-            roi_timeseries = np.mean(voxel_timeseries, axis=1)
-            timeseries_dict[str(i)] = roi_timeseries
+    for i, label in enumerate(label_ids):
+        timeseries_dict[str(int(label))] = label_timeseries[:, i]
     return timeseries_dict
 
 
-def parcellated_FC_matrix(bold_file, atlas):
-    timeseries_dict = extract_timeseries(bold_file, atlas)
+def parcellated_FC_matrix(bold_file, atlas, store_file=None):
+    timeseries_dict = extract_timeseries(bold_file, atlas, store_file=store_file)
     roi_labels = timeseries_dict.keys()
     sub_timeseries = []
     for roi in roi_labels:
@@ -206,19 +357,186 @@ def plot_matrix(filename, corr_matrix):
     plt.savefig(filename, bbox_inches='tight', dpi=150)
 
 
+'''
+GROUP STATISTICS
+'''
+
+
+def scan_data_shape(filename):
+    '''
+    Returns the shape of a per-scan analysis output: a pickled array (.pkl), a .npy matrix, an HDF5 FC
+    matrix (.h5) or a NIfTI image.
+    '''
+    import pickle
+    if filename.endswith('.pkl'):
+        with open(filename, 'rb') as handle:
+            return np.asarray(pickle.load(handle)).shape
+    elif filename.endswith('.npy'):
+        return np.load(filename, mmap_mode='r').shape
+    elif filename.endswith('.h5'):
+        import h5py
+        with h5py.File(filename, 'r') as store:
+            return store['FC_matrix'].shape
+    elif filename.endswith('.nii') or filename.endswith('.nii.gz'):
+        return nb.load(filename).shape
+    else:
+        raise ValueError(
+            "Group statistics can't be derived from %s. Sparse voxelwise FC matrices are not supported." % (filename))
+
+
+def iter_scan_blocks(filename, block_size):
+    '''
+    Reads a per-scan analysis output once, yielding (start, end, block) for blocks of block_size rows
+    along its first axis. .npy and HDF5 (.h5) matrices are read one block at a time, whereas pickled arrays
+    (.pkl) and NIfTI images, which can't be sliced along their first axis without decoding the whole file,
+    are loaded once.
+    '''
+    import pickle
+    if filename.endswith('.h5'):
+        import h5py
+        with h5py.File(filename, 'r') as store:
+            data = store['FC_matrix']
+            for start in range(0, data.shape[0], block_size):
+                end = min(start+block_size, data.shape[0])
+                yield start, end, data[start:end]
+        return
+    elif filename.endswith('.pkl'):
+        with open(filename, 'rb') as handle:
+            data = np.asarray(pickle.load(handle))
+    elif filename.endswith('.npy'):
+        data = np.load(filename, mmap_mode='r')
+    elif filename.endswith('.nii') or filename.endswith('.nii.gz'):
+        data = np.asarray(nb.load(filename).dataobj)
+    else:
+        raise ValueError(
+            "Group statistics can't be derived from %s. Sparse voxelwise FC matrices are not supported." % (filename))
+    for start in range(0, data.shape[0], block_size):
+        end = min(start+block_size, data.shape[0])
+        yield start, end, data[start:end]
+
+
+def aggregate_group_stats(file_list, name, store_format='h5', fisher_z=False, block_size=None):
+    '''
+    Streams the per-scan outputs from file_list into a single group store, then derives the group mean and
+    variance (sample variance, ddof=1) with Welford's algorithm over the scans, together with the group mean
+    of the Fisher z-transformed values if fisher_z is True (for correlation matrices). Each scan is read once
+    and copied to the store by blocks of block_size rows along its first axis (see iter_scan_blocks), and the
+    statistics are then computed by blocks of rows read back from the store, so that only one block of the
+    data and statistics is held in memory. The stacked data and statistics are written in float32.
+    With store_format 'h5', the stacked data, the statistics and the scan list are saved in one HDF5 file.
+    With 'npy', the stacked data is a memory-mappable .npy file, and the statistics and scan list are
+    saved next to it in a .npz file.
+    Returns the store file, and the statistics file for 'npy' (None for 'h5').
+    '''
+    import os
+    from rabies.preprocess_pkg.utils import flatten_list
+    from rabies.analysis_pkg.analysis_functions import scan_data_shape, iter_scan_blocks
+
+    file_list = [str(filename) for filename in flatten_list(list(file_list))]
+    num_scans = len(file_list)
+    shape = tuple(scan_data_shape(file_list[0]))
+    row_size = int(np.prod(shape[1:]))
+    if block_size is None:
+        # blocks of rows of about 128MB for each float64 statistic
+        block_size = max(1, int(2**24/row_size))
+
+    stat_keys = ['mean', 'variance']
+    if fisher_z:
+        stat_keys.append('fisher_z_mean')
+    if store_format == 'h5':
+        import h5py
+        store_file = os.path.abspath('%s_group_store.h5' % (name,))
+        stats_file = None
+        store = h5py.File(store_file, 'w')
+        # HDF5 chunks are limited to 4GB, so each chunk covers a bounded number of rows from a single scan
+        chunk_rows = max(1, min(shape[0], int(2**22/row_size)))
+        stacked = store.create_dataset('data', shape=(num_scans,)+shape, dtype='float32',
+                                       chunks=(1, chunk_rows)+shape[1:])
+        store.create_dataset('scans', data=np.array(file_list, dtype='S'))
+        stats = {key: store.create_dataset(key, shape=shape, dtype='float32', chunks=(chunk_rows,)+shape[1:])
+                 for key in stat_keys}
+    elif store_format == 'npy':
+        store_file = os.path.abspath('%s_group_store.npy' % (name,))
+        stats_file = os.path.abspath('%s_group_stats.npz' % (name,))
+        stacked = np.lib.format.open_memmap(
+            store_file, mode='w+', dtype='float32', shape=(num_scans,)+shape)
+        # the statistics are gathered in temporary memory-mapped files, which are then streamed to the .npz
+        stats = {key: np.lib.format.open_memmap(os.path.abspath('%s_group_%s.npy' % (name, key)),
+                                                mode='w+', dtype='float32', shape=shape)
+                 for key in stat_keys}
+    else:
+        raise ValueError(
+            "Invalid group store format: %s. Must be either 'h5' or 'npy'." % (store_format))
+
+    for i, filename in enumerate(file_list):
+        num_rows = 0
+        for start, end, block in iter_scan_blocks(filename, block_size):
+            if not tuple(block.shape[1:]) == shape[1:] or end > shape[0]:
+                raise ValueError("%s doesn't match the shape of the other scans %s." % (filename, shape))
+            stacked[i, start:end] = block
+            num_rows = end
+        if not num_rows == shape[0]:
+            raise ValueError("%s doesn't match the shape of the other scans %s." % (filename, shape))
+
+    for start in range(0, shape[0], block_size):
+        end = min(start+block_size, shape[0])
+        mean = np.zeros((end-start,)+shape[1:])
+        M2 = np.zeros((end-start,)+shape[1:])
+        if fisher_z:
+            z_mean = np.zeros((end-start,)+shape[1:])
+        for i in range(num_scans):
+            data = np.asarray(stacked[i, start:end], dtype='float64')
+            # Welford's update of the running mean and sum of squared deviations
+            delta = data-mean
+            mean += delta/(i+1)
+            M2 += delta*(data-mean)
+            if fisher_z:
+                z = np.arctanh(np.clip(data, -1+1e-7, 1-1e-7))
+                z_mean += (z-z_mean)/(i+1)
+            del data
+
+        stats['mean'][start:end] = mean
+        stats['variance'][start:end] = M2/(num_scans-1) if num_scans > 1 else 0
+        if fisher_z:
+            stats['fisher_z_mean'][start:end] = z_mean
+
+    if store_format == 'h5':
+        store.close()
+    else:
+        stacked.flush()
+        del stacked
+        for key in stat_keys:
+            stats[key].flush()
+        np.savez(stats_file, scans=np.array(file_list), **stats)
+        for key in stat_keys:
+            stat_file = stats[key].filename
+            del stats[key]
+            os.remove(stat_file)
+    return store_file, stats_file
+
+
 '''
 ICA
 '''
 
 
-def run_group_ICA(bold_file_list, mask_file, dim, tr):
+def run_group_ICA(bold_file_list, mask_file, dim, tr, engine='melodic'):
     import os
     import pandas as pd
 
-    # create a filelist.txt
-    file_path = os.path.abspath('filelist.txt')
     from rabies.preprocess_pkg.utils import flatten_list
     merged = flatten_list(list(bold_file_list))
+    if engine == 'native':
+        from rabies.analysis_pkg.analysis_functions import native_group_ICA, recover_3D_mutiple
+        out_dir = os.path.abspath('group_melodic.ica')
+        os.makedirs(out_dir, exist_ok=True)
+        IC_file = out_dir+'/melodic_IC.nii.gz'
+        recover_3D_mutiple(mask_file, native_group_ICA(
+            merged, mask_file, dim)).to_filename(IC_file)
+        return out_dir, IC_file
+
+    # create a filelist.txt
+    file_path = os.path.abspath('filelist.txt')
     df = pd.DataFrame(data=merged)
     df.to_csv(file_path, header=False, sep=',', index=False)
 
@@ -231,46 +549,147 @@ def run_group_ICA(bold_file_list, mask_file, dim, tr):
     return out_dir, IC_file
 
 
-def run_DR_ICA(bold_file, mask_file, IC_file):
+def migp(bold_files, mask_file, internal_dim):
+    '''
+    MELODIC's Incremental Group-PCA (MIGP; Smith et al. 2014). The scans are streamed from disk one at a
+    time, with each voxel timeseries centered (the cleaned timeseries are already variance normalized by
+    confound regression), and appended to a running internal_dim X num_voxel matrix, which is reduced back
+    to its top internal_dim eigenvectors (scaled by their singular values) after each scan. Memory thus
+    depends on internal_dim, and not on the total number of frames.
+    '''
+    from rabies.preprocess_pkg.masking import extract_masked
+
+    W = None
+    for bold_file in bold_files:
+        timeseries = extract_masked(bold_file, mask_file)
+        timeseries -= timeseries.mean(axis=0)
+
+        W = timeseries if W is None else np.concatenate((W, timeseries), axis=0)
+        del timeseries
+        if W.shape[0] > internal_dim:
+            # the eigenvectors of the small frame X frame matrix provide the temporal reduction
+            eigenvalues, eigenvectors = np.linalg.eigh(W.dot(W.T))
+            W = eigenvectors[:, ::-1][:, :internal_dim].T.dot(W)
+    return W
+
+
+def native_group_ICA(bold_files, mask_file, dim, internal_dim=None, random_state=1):
+    '''
+    Spatial group-ICA conducted in-process: the group data is reduced with MIGP (see migp), from which the
+    top dim spatial eigenvectors are decomposed with FastICA. A dim of 0 defaults to 20 components, as
+    no automatic dimensionality estimation is conducted. Returns the num_IC X num_voxel IC maps,
+    normalized to unit standard deviation, with signs set such that each map has positive skewness.
+    '''
+    from sklearn.decomposition import FastICA
+
+    if dim == 0:
+        dim = 20
+    if internal_dim is None:
+        internal_dim = max(5*dim, 100)
+    W = migp(bold_files, mask_file, internal_dim)
+    if dim > W.shape[0]:
+        raise ValueError(
+            "Can't derive %s components from data with %s frames." % (dim, W.shape[0]))
+
+    # top spatial eigenvectors of the reduced group data
+    eigenvalues, eigenvectors = np.linalg.eigh(W.dot(W.T))
+    eigenvectors = eigenvectors[:, ::-1][:, :dim]
+    X = eigenvectors.T.dot(W).T
+    del W
+
+    # spatial centering and whitening of the components, on which FastICA is run without further reduction
+    X -= X.mean(axis=0)
+    cov_eigenvalues, cov_eigenvectors = np.linalg.eigh(X.T.dot(X)/X.shape[0])
+    X = X.dot(cov_eigenvectors/np.sqrt(cov_eigenvalues))
+
+    ica = FastICA(whiten=False, max_iter=1000, random_state=random_state)
+    IC_maps = ica.fit_transform(X).T
+
+    IC_maps = (IC_maps.T-IC_maps.mean(axis=1)).T
+    IC_maps = (IC_maps.T/IC_maps.std(axis=1)).T
+    skewness = (IC_maps**3).mean(axis=1)
+    IC_maps[skewness < 0] *= -1
+    return IC_maps
+
+
+def run_DR_ICA(bold_file, mask_file, IC_file, store_file=None, cache_dir=None):
     import os
     import pickle
+    import pandas as pd
     import pathlib  # Better path manipulation
     filename_split = pathlib.Path(bold_file).name.rsplit(".nii")
 
     from rabies.analysis_pkg.analysis_functions import sub_DR_ICA, recover_3D_mutiple
-    sub_ICs = sub_DR_ICA(bold_file, mask_file, IC_file)
+    sub_timecourses, sub_ICs = sub_DR_ICA(
+        bold_file, mask_file, IC_file, store_file=store_file, cache_dir=cache_dir)
 
     data_file = os.path.abspath(filename_split[0]+'_DR_ICA.pkl')
     with open(data_file, 'wb') as handle:
         pickle.dump(sub_ICs, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
+    # save the subjects' component timecourses from the first regression
+    timecourse_file = os.path.abspath(filename_split[0]+'_DR_timecourse.csv')
+    pd.DataFrame(sub_timecourses, columns=['IC%i' % (i+1) for i in range(sub_timecourses.shape[1])]).to_csv(
+        timecourse_file, index=False)
+
     # save the subjects' IC maps as .nii file
     nii_file = os.path.abspath(filename_split[0]+'_DR_ICA.nii.gz')
     recover_3D_mutiple(mask_file, sub_ICs).to_filename(nii_file)
-    return data_file, nii_file
+    return data_file, nii_file, timecourse_file
 
 
-def sub_DR_ICA(bold_file, mask_file, IC_file):
-    brain_mask = np.asarray(nb.load(mask_file).dataobj)
-    volume_indices = brain_mask.astype(bool)
+def sub_DR_ICA(bold_file, mask_file, IC_file, store_file=None, cache_dir=None):
+    from rabies.analysis_pkg.analysis_functions import cached_group_IC_pinv
+    sub_timeseries = load_masked_timeseries(
+        bold_file, mask_file, store_file=store_file)
+    IC_pinv = np.load(cached_group_IC_pinv(IC_file, mask_file, cache_dir=cache_dir))['IC_pinv']
 
-    timeseries_array = np.asarray(nb.load(bold_file).dataobj)
-    sub_timeseries = np.zeros(
-        [timeseries_array.shape[3], volume_indices.sum()])
-    for t in range(timeseries_array.shape[3]):
-        sub_timeseries[t, :] = timeseries_array[:, :, :, t][volume_indices]
+    return dual_regression(None, sub_timeseries, IC_pinv=IC_pinv)
 
-    all_IC_array = np.asarray(nb.load(IC_file).dataobj)
-    all_IC_vectors = np.zeros([all_IC_array.shape[3], volume_indices.sum()])
-    for i in range(all_IC_array.shape[3]):
-        all_IC_vectors[i, :] = (all_IC_array[:, :, :, i])[volume_indices]
 
-    sub_ICs = dual_regression(all_IC_vectors, sub_timeseries)
-    return sub_ICs
+def group_IC_pinv(IC_vectors):
+    # IC_vectors is of shape num_ICxnum_voxels
+    # returns the pseudo-inverse of the spatially centered group ICs, of shape num_ICxnum_voxels,
+    # which is shared by the first regression of every subject
+    X = IC_vectors.transpose()
+    X = X-X.mean(axis=0)
+    return np.linalg.pinv(X)
+
+
+def cached_group_IC_pinv(IC_file, mask_file, cache_dir=None):
+    '''
+    Computes the pseudo-inverse of the group ICs within the mask (see group_IC_pinv), which is stored in
+    cache_dir under a key derived from the content of the IC and mask files, so that it is computed once
+    for the whole dataset. Without cache_dir, it is stored in the working directory.
+    '''
+    import os
+    import hashlib
+    from rabies.preprocess_pkg.utils import file_hash
+    from rabies.preprocess_pkg.masking import extract_masked
+    from rabies.analysis_pkg.analysis_functions import group_IC_pinv
+
+    key = hashlib.sha1(('%s,%s' % (file_hash(IC_file), file_hash(mask_file))).encode())
+    pinv_name = 'group_IC_pinv_%s.npz' % (key.hexdigest(),)
+    if cache_dir is None:
+        cache_dir = os.getcwd()
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    pinv_file = '%s/%s' % (cache_dir, pinv_name)
+
+    if os.path.isfile(pinv_file):
+        print("Using cached group IC pseudo-inverse %s" % (pinv_file,))
+    else:
+        IC_pinv = group_IC_pinv(extract_masked(IC_file, mask_file))
+        # write under a temporary name to avoid exposing partial files to concurrent nodes
+        tmp_file = '%s/.%s_%s.npz' % (cache_dir,
+                                      pinv_name.rsplit('.npz')[0], os.getpid())
+        np.savez(tmp_file, IC_pinv=IC_pinv)
+        os.replace(tmp_file, pinv_file)
+    return pinv_file
 
 
 '''
-LINEAR REGRESSION --- CLOSED-FORM SOLUTION
+LINEAR REGRESSION --- LEAST-SQUARES SOLUTION
 '''
 
 # functions that computes the Least Squares Estimates
@@ -279,7 +698,7 @@ LINEAR REGRESSION --- CLOSED-FORM SOLUTION
 def closed_form(X, Y, intercept=False):
     if intercept:
         X = np.concatenate((X, np.ones([X.shape[0], 1])), axis=1)
-    return np.linalg.inv(X.transpose().dot(X)).dot(X.transpose()).dot(Y)
+    return np.linalg.lstsq(X, Y, rcond=None)[0]
 
 # functions that computes the Mean Square Error (MSE)
 
@@ -288,29 +707,28 @@ def mse(X, Y, w):
     return np.mean((Y-np.matmul(X, w))**2)
 
 
-def dual_regression(IC_vectors, timeseries):
+def dual_regression(IC_vectors, timeseries, IC_pinv=None):
     # IC_vectors is of shape num_ICxnum_voxels
     # timeseries is of shape num_timepointsxnum_voxels
-    X = IC_vectors.transpose()
+    # the pseudo-inverse of the centered group ICs can be provided as IC_pinv (see group_IC_pinv) to avoid recomputing it
+    if IC_pinv is None:
+        IC_pinv = group_IC_pinv(IC_vectors)
     Y = timeseries.transpose()
 
     # spatial and temporal centering of the matrices as suggested here https://mandymejia.com/2018/03/29/the-role-of-centering-in-dual-regression/#:~:text=Dual%20regression%20requires%20centering%20across%20time%20and%20space&text=time%20points.,each%20time%20course%20at%20zero).
-    # spatial centering of the group ICs
-    X = X-X.mean(axis=0)
-    # spatial and temporal centering of the timeseries
-    Y = Y-Y.mean(axis=0)
-    Y = (Y.T-Y.mean(axis=1)).T
-
+    # the group ICs are spatially centered within IC_pinv, whose rows are thus orthogonal to constant
+    # voxel vectors; spatial centering of the timeseries is then implicit, and temporal centering amounts
+    # to centering the resulting timecourses.
     # for one given volume, it's values can be expressed through a linear combination of the components ()
-    w = closed_form(X, Y, intercept=False)
+    w = IC_pinv.dot(Y)
+    w -= w.mean(axis=1)[:, np.newaxis]
 
     # normalize the component timecourses to unit variance
-    std = w.std(axis=1)
-    for i in range(w.shape[0]):
-        w[i, :] = w[i, :]/std[i]
+    w /= w.std(axis=1)[:, np.newaxis]
 
     # for a given voxel timeseries, it's signal can be explained a linear combination of the component timecourses
     X = w.transpose()
     Y = timeseries
-    # return recovered components of dim num_ICsxnum_voxels
-    return closed_form(X, Y, intercept=False)
+    # return the component timecourses of dim num_timepointsxnum_ICs, and the
+    # recovered components of dim num_ICsxnum_voxels
+    return X, closed_form(X, Y, intercept=False)
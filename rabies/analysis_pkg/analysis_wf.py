@@ -10,11 +10,11 @@ def init_analysis_wf(opts, commonspace_cr=False, seed_list=[], name="analysis_wf
 
     workflow = pe.Workflow(name=name)
     subject_inputnode = pe.Node(niu.IdentityInterface(
-        fields=['bold_file', 'mask_file', 'atlas_file', 'token']), name='subject_inputnode')
+        fields=['bold_file', 'mask_file', 'atlas_file', 'store_file', 'token']), name='subject_inputnode')
     group_inputnode = pe.Node(niu.IdentityInterface(
         fields=['bold_file_list', 'commonspace_mask', 'token']), name='group_inputnode')
     outputnode = pe.Node(niu.IdentityInterface(fields=['group_ICA_dir', 'IC_file', 'DR_data_file',
-                                                       'DR_nii_file', 'matrix_data_file', 'matrix_fig', 'corr_map_file', 'sub_token', 'group_token']), name='outputnode')
+                                                       'DR_nii_file', 'DR_timecourse_file', 'matrix_data_file', 'matrix_fig', 'FC_degree_file', 'FC_GBC_file', 'corr_map_file', 'sub_token', 'group_token']), name='outputnode')
 
     # connect the nodes so that they exist even without running analysis
     workflow.connect([
@@ -30,16 +30,19 @@ def init_analysis_wf(opts, commonspace_cr=False, seed_list=[], name="analysis_wf
         if not commonspace_cr:
             raise ValueError(
                 'Outputs from confound regression must be in commonspace to run seed-based analysis. Try running confound regression again with --commonspace_bold.')
-        seed_based_FC_node = pe.Node(Function(input_names=['bold_file', 'brain_mask', 'seed_list'],
+        seed_based_FC_node = pe.Node(Function(input_names=['bold_file', 'brain_mask', 'seed_list', 'store_file', 'cache_dir'],
                                               output_names=['corr_map_file'],
                                               function=seed_based_FC),
                                      name='seed_based_FC', mem_gb=1)
         seed_based_FC_node.inputs.seed_list = seed_list
+        # seeds are resampled once for a given mask grid, and shared across scans
+        seed_based_FC_node.inputs.cache_dir = os.path.abspath(str(opts.output_dir))+'/seed_cache'
 
         workflow.connect([
             (subject_inputnode, seed_based_FC_node, [
                 ("bold_file", "bold_file"),
                 ("mask_file", "brain_mask"),
+                ("store_file", "store_file"),
                 ]),
             (seed_based_FC_node, outputnode, [
                 ("corr_map_file", "corr_map_file"),
@@ -53,19 +56,23 @@ def init_analysis_wf(opts, commonspace_cr=False, seed_list=[], name="analysis_wf
             raise ValueError(
                 'Outputs from confound regression must be in commonspace to run dual regression. Try running confound regression again with --commonspace_bold.')
 
-        DR_ICA = pe.Node(Function(input_names=['bold_file', 'mask_file', 'IC_file'],
-                                  output_names=['data_file', 'nii_file'],
+        DR_ICA = pe.Node(Function(input_names=['bold_file', 'mask_file', 'IC_file', 'store_file', 'cache_dir'],
+                                  output_names=['data_file', 'nii_file', 'timecourse_file'],
                                   function=run_DR_ICA),
                          name='DR_ICA', mem_gb=1)
+        # the pseudo-inverse of the group ICs is computed once, and shared across scans
+        DR_ICA.inputs.cache_dir = os.path.abspath(str(opts.output_dir))+'/DR_cache'
 
         workflow.connect([
             (subject_inputnode, DR_ICA, [
                 ("bold_file", "bold_file"),
                 ("mask_file", "mask_file"),
+                ("store_file", "store_file"),
                 ]),
             (DR_ICA, outputnode, [
                 ("data_file", "DR_data_file"),
                 ("nii_file", "DR_nii_file"),
+                ("timecourse_file", "DR_timecourse_file"),
                 ]),
             ])
 
@@ -82,12 +89,13 @@ def init_analysis_wf(opts, commonspace_cr=False, seed_list=[], name="analysis_wf
         if not commonspace_cr:
             raise ValueError(
                 'Outputs from confound regression must be in commonspace to run group-ICA. Try running confound regression again with --commonspace_bold.')
-        group_ICA = pe.Node(Function(input_names=['bold_file_list', 'mask_file', 'dim', 'tr'],
+        group_ICA = pe.Node(Function(input_names=['bold_file_list', 'mask_file', 'dim', 'tr', 'engine'],
                                      output_names=['out_dir', 'IC_file'],
                                      function=run_group_ICA),
                             name='group_ICA', mem_gb=1)
         group_ICA.inputs.tr = float(opts.TR.split('s')[0])
         group_ICA.inputs.dim = opts.dim
+        group_ICA.inputs.engine = opts.group_ICA_engine
 
         workflow.connect([
             (group_inputnode, group_ICA, [
@@ -108,21 +116,27 @@ def init_analysis_wf(opts, commonspace_cr=False, seed_list=[], name="analysis_wf
                 ])
 
     if opts.FC_matrix:
-        FC_matrix = pe.Node(Function(input_names=['bold_file', 'mask_file', 'atlas', 'roi_type'],
-                                     output_names=['data_file', 'figname'],
+        FC_matrix = pe.Node(Function(input_names=['bold_file', 'mask_file', 'atlas', 'roi_type', 'store_file', 'voxelwise_format', 'top_k', 'threshold'],
+                                     output_names=['data_file', 'figname', 'degree_file', 'GBC_file'],
                                      function=run_FC_matrix),
                             name='FC_matrix', mem_gb=1)
         FC_matrix.inputs.roi_type = opts.ROI_type
+        FC_matrix.inputs.voxelwise_format = opts.voxelwise_FC_format
+        FC_matrix.inputs.top_k = opts.voxelwise_FC_top_k
+        FC_matrix.inputs.threshold = opts.voxelwise_FC_threshold
 
         workflow.connect([
             (subject_inputnode, FC_matrix, [
                 ("bold_file", "bold_file"),
                 ("mask_file", "mask_file"),
                 ("atlas_file", "atlas"),
+                ("store_file", "store_file"),
                 ]),
             (FC_matrix, outputnode, [
                 ("data_file", "matrix_data_file"),
                 ("figname", "matrix_fig"),
+                ("degree_file", "FC_degree_file"),
+                ("GBC_file", "FC_GBC_file"),
                 ]),
             ])
 
@@ -6,19 +6,20 @@ from .utils import regress, data_diagnosis, select_timeseries, exec_ICA_AROMA
 
 
 def init_confound_regression_wf(lowpass=None, highpass=None, smoothing_filter=0.3, run_aroma=False, aroma_dim=0, conf_list=[],
-                                TR='1.0s', apply_scrubbing=False, scrubbing_threshold=0.1, timeseries_interval='all', diagnosis_output=False, name="confound_regression_wf"):
+                                TR='1.0s', apply_scrubbing=False, scrubbing_threshold=0.1, timeseries_interval='all', diagnosis_output=False, timeseries_store=False, local_threads=1, name="confound_regression_wf"):
 
     workflow = pe.Workflow(name=name)
     inputnode = pe.Node(niu.IdentityInterface(fields=[
                         'bold_file', 'brain_mask', 'csf_mask', 'confounds_file', 'FD_file']), name='inputnode')
     outputnode = pe.Node(niu.IdentityInterface(fields=[
-                         'cleaned_path', 'VE_file', 'aroma_out', 'mel_out', 'tSNR_file']), name='outputnode')
+                         'cleaned_path', 'VE_file', 'timeseries_store', 'aroma_out', 'mel_out', 'tSNR_file']), name='outputnode')
 
+    regress_n_procs = int(local_threads/4)+1
     regress_node = pe.Node(Function(input_names=['bold_file', 'brain_mask_file', 'confounds_file', 'csf_mask', 'FD_file', 'conf_list',
-                                                 'TR', 'lowpass', 'highpass', 'smoothing_filter', 'apply_scrubbing', 'scrubbing_threshold', 'timeseries_interval'],
-                                    output_names=['cleaned_path', 'bold_file', 'VE_file'],
+                                                 'TR', 'lowpass', 'highpass', 'smoothing_filter', 'apply_scrubbing', 'scrubbing_threshold', 'timeseries_interval', 'timeseries_store', 'n_procs'],
+                                    output_names=['cleaned_path', 'bold_file', 'VE_file', 'store_file'],
                                     function=regress),
-                           name='regress', mem_gb=1)
+                           name='regress', mem_gb=1, n_procs=regress_n_procs)
     regress_node.inputs.conf_list = conf_list
     regress_node.inputs.TR = float(TR.split('s')[0])
     regress_node.inputs.lowpass = lowpass
@@ -27,6 +28,8 @@ def init_confound_regression_wf(lowpass=None, highpass=None, smoothing_filter=0.
     regress_node.inputs.apply_scrubbing = apply_scrubbing
     regress_node.inputs.scrubbing_threshold = scrubbing_threshold
     regress_node.inputs.timeseries_interval = timeseries_interval
+    regress_node.inputs.timeseries_store = timeseries_store
+    regress_node.inputs.n_procs = regress_n_procs
 
     select_timeseries_node = pe.Node(Function(input_names=['bold_file', 'timeseries_interval'],
                                               output_names=['bold_file'],
@@ -46,6 +49,7 @@ def init_confound_regression_wf(lowpass=None, highpass=None, smoothing_filter=0.
         (regress_node, outputnode, [
             ("cleaned_path", "cleaned_path"),
             ("VE_file", "VE_file"),
+            ("store_file", "timeseries_store"),
             ]),
         ])
 
@@ -120,8 +120,202 @@ def select_timeseries(bold_file, timeseries_interval):
         return bold_file
 
 
+def write_timeseries_store(timeseries, mask_file, out_file, chunk_voxels=4096):
+    '''
+    Writes a timepoint X in-mask voxel timeseries matrix to an HDF5 store, chunked along voxels so that
+    any subset of voxels can be read back without decoding the rest. The flat (C-order) indices of the
+    voxels within the mask are saved alongside, together with the volume shape and affine.
+    '''
+    import h5py
+    import numpy as np
+    import nibabel as nb
+    mask_img = nb.load(mask_file)
+    mask_indices = np.flatnonzero(np.asarray(mask_img.dataobj).astype(bool))
+    if not timeseries.shape[1] == len(mask_indices):
+        raise ValueError(
+            "The timeseries matrix doesn't match the number of voxels within the mask.")
+
+    with h5py.File(out_file, 'w') as store:
+        store.create_dataset('timeseries', data=np.asarray(timeseries, dtype='float32'),
+                             chunks=(max(timeseries.shape[0], 1), max(min(chunk_voxels, timeseries.shape[1]), 1)))
+        store.create_dataset('mask_indices', data=mask_indices.astype('int64'))
+        store.attrs['shape'] = mask_img.shape[:3]
+        store.attrs['affine'] = mask_img.affine
+    return out_file
+
+
+def read_timeseries_store(store_file, mask_array):
+    '''
+    Reads from a timeseries store the timepoint X voxel matrix for the voxels selected by mask_array,
+    in the same order as mask_array[mask_array.astype(bool)]. Returns None if the store doesn't match
+    the volume shape or doesn't include all of the selected voxels, in which case the timeseries
+    must be extracted from the image instead.
+    '''
+    import h5py
+    import numpy as np
+    with h5py.File(store_file, 'r') as store:
+        if not tuple(store.attrs['shape']) == tuple(mask_array.shape[:3]):
+            return None
+        store_indices = store['mask_indices'][:]
+        indices = np.flatnonzero(mask_array.astype(bool))
+        positions = np.searchsorted(store_indices, indices)
+        positions[positions == len(store_indices)] = 0
+        if not (store_indices[positions] == indices).all():
+            return None
+        timeseries = store['timeseries']
+        if len(positions) == len(store_indices):
+            return timeseries[:]
+        elif len(positions) > len(store_indices)/10:
+            # for large selections, reading whole chunks is faster than point selection
+            return timeseries[:][:, positions]
+        else:
+            return timeseries[:, positions]
+
+
+def standardize_confounds(confounds_array, TR, lowpass, highpass):
+    '''
+    Prepares the confounds for cleaning as in nilearn.signal.clean: the confounds are filtered with
+    the same temporal filter as the timeseries, detrended and normalized. Returns an orthonormal basis
+    (from a pivoted QR decomposition) of the space spanned by the confounds, excluding collinear ones.
+    '''
+    import numpy as np
+    from scipy import linalg
+    import nilearn.signal
+    from rabies.conf_reg_pkg.utils import detrend_timeseries
+    confounds = np.array(confounds_array, dtype='float64', ndmin=2)
+    if confounds.shape[0] == 1:
+        confounds = confounds.T
+    if lowpass is not None or highpass is not None:
+        confounds = nilearn.signal.butterworth(confounds, sampling_rate=1. / TR,
+                                               low_pass=lowpass, high_pass=highpass, copy=True)
+    confounds = detrend_timeseries(confounds)
+    std = np.sqrt((confounds ** 2).sum(axis=0))
+    std[std < np.finfo(np.float64).eps] = 1.
+    confounds /= std
+
+    Q, R, _ = linalg.qr(confounds, mode='economic', pivoting=True)
+    return Q[:, np.abs(np.diag(R)) > np.finfo(np.float64).eps * 100.]
+
+
+def detrend_timeseries(timeseries):
+    '''
+    Removes the mean and linear trend of each column of a timepoint X feature array, in place.
+    '''
+    import numpy as np
+    timeseries -= timeseries.mean(axis=0)
+    regressor = np.arange(timeseries.shape[0], dtype=timeseries.dtype)
+    regressor -= regressor.mean()
+    std = np.sqrt((regressor ** 2).sum())
+    if not std < np.finfo(np.float64).eps:
+        regressor /= std
+    timeseries -= np.outer(regressor, regressor.dot(timeseries))
+    return timeseries
+
+
+def regression_engine(timeseries, confounds_array, TR, lowpass=None, highpass=None, regress_confounds=True, n_procs=1, block_size=10000):
+    '''
+    Evaluates the variance explained (VE) by each confound, and cleans the timepoint X voxel
+    timeseries in place through detrending, temporal filtering, confound regression and standardization
+    (in the same order as nilearn.signal.clean). The timeseries is processed in blocks of voxels
+    distributed across n_procs threads, so that all steps are conducted in a single pass over the
+    voxels. Returns the VE by each confound across the whole data and within each voxel.
+    '''
+    import numpy as np
+    from scipy import linalg
+    import nilearn.signal
+    from multiprocessing.pool import ThreadPool
+    from rabies.conf_reg_pkg.utils import standardize_confounds, detrend_timeseries
+
+    num_timepoints, num_voxels = timeseries.shape
+    confounds_array = np.array(confounds_array, dtype='float64').reshape(num_timepoints, -1)
+    num_confounds = confounds_array.shape[1]
+
+    # the VE model regresses the standardized timeseries on the standardized confounds with an intercept,
+    # through a pivoted QR decomposition of the predictors
+    with np.errstate(divide='ignore', invalid='ignore'):
+        X = (confounds_array-confounds_array.mean(axis=0))/confounds_array.std(axis=0)
+    # remove null values which may result from 0 in the array
+    X[np.isnan(X)] = 0
+    X_i = np.concatenate((X, np.ones([num_timepoints, 1])), axis=1)
+    Q_ve, R_ve, P_ve = linalg.qr(X_i, mode='economic', pivoting=True)
+    rank = int((np.abs(np.diag(R_ve)) > np.finfo(np.float64).eps * 100.).sum())
+    Q_ve = Q_ve[:, :rank]
+
+    if regress_confounds and num_confounds > 0:
+        Q_clean = standardize_confounds(confounds_array, TR, lowpass, highpass)
+    else:
+        Q_clean = None
+
+    w = np.zeros([num_confounds+1, num_voxels])
+    VE = np.zeros(num_voxels)
+
+    def process_block(start):
+        end = min(start+block_size, num_voxels)
+        Y = timeseries[:, start:end].astype('float64')
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            Y_std = (Y-Y.mean(axis=0))/Y.std(axis=0)
+        Y_std[np.isnan(Y_std)] = 0
+        # for each observation, the betas are solved from the same factorization which provides the residuals
+        QtY = Q_ve.T.dot(Y_std)
+        w_block = np.zeros([num_confounds+1, end-start])
+        w_block[P_ve[:rank], :] = linalg.solve_triangular(R_ve[:rank, :rank], QtY)
+        w[:, start:end] = w_block
+        # the residuals after regressing out the predictors
+        residuals = Y_std-Q_ve.dot(QtY)
+        # mean square error after regression, for each observation independently
+        MSE = np.mean((residuals**2), axis=0)
+        # Original variance in each observation before regression
+        TV = np.mean((Y_std-Y_std.mean(axis=0))**2, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            VE[start:end] = MSE/TV  # total variance explained in each observation
+
+        # cleaning includes detrending, filtering, confound regression and standardization
+        Y = detrend_timeseries(Y)
+        if lowpass is not None or highpass is not None:
+            Y = nilearn.signal.butterworth(Y, sampling_rate=1. / TR,
+                                           low_pass=lowpass, high_pass=highpass, copy=True)
+        if Q_clean is not None:
+            Y -= Q_clean.dot(Q_clean.T.dot(Y))
+        Y -= Y.mean(axis=0)
+        std = np.sqrt((Y ** 2).sum(axis=0))
+        std[std < np.finfo(np.float64).eps] = 1.
+        Y *= np.sqrt(num_timepoints)/std  # for unit variance
+        timeseries[:, start:end] = Y
+        return MSE.sum(), TV.sum()
+
+    pool = ThreadPool(n_procs)
+    sums = pool.map(process_block, range(0, num_voxels, block_size))
+    pool.close()
+    pool.join()
+
+    VE[np.isnan(VE)] = 0
+    # mean square error after regression, relative to the original variance, across all observations
+    VE_tot = np.sum([block_sums[0] for block_sums in sums]) / \
+        np.sum([block_sums[1] for block_sums in sums])
+
+    w = w[:-1, :]  # take out the intercept
+    # now evaluate the portion of variance explained by each predictor,
+    # scale all beta values to relative percentages of variance explained,
+    # with the assumption that each beta value represents directly the relative contribution of each predictor
+    # (guaranteed by the standardization of across feature)
+    TV = np.sum((w-w.mean(axis=0))**2, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pred_VE = (w-w.mean(axis=0))**2/TV
+    pred_VE[np.isnan(pred_VE)] = 0
+    VE_observations = pred_VE*VE  # scale by the proportion of total variance explained
+
+    # evaluate also variance explained from the entire data
+    pred_variance = w.var(axis=1)  # variance along each dimension
+    # evaluate the sum of variance present in this new dimensional space
+    TV = pred_variance.sum()
+    pred_VE = pred_variance/TV  # portion of variance explained from each dimension
+    total_VE = pred_VE*VE_tot
+    return total_VE, VE_observations
+
+
 def regress(bold_file, brain_mask_file, confounds_file, FD_file, conf_list, TR, lowpass, highpass, smoothing_filter,
-            apply_scrubbing, scrubbing_threshold, timeseries_interval):
+            apply_scrubbing, scrubbing_threshold, timeseries_interval, timeseries_store=False, n_procs=1):
     import os
     import numpy as np
     import pandas as pd
@@ -157,79 +351,21 @@ def regress(bold_file, brain_mask_file, confounds_file, FD_file, conf_list, TR,
 
     confounds_array = np.asarray(confounds[conf_keys])
 
-    '''
-    Evaluate the variance explained (VE) by each regressor
-    '''
-    # functions that computes the Least Squares Estimates
-    def closed_form(X, Y, intercept=False):
-        if intercept:
-            X = np.concatenate((X, np.ones([X.shape[0], 1])), axis=1)
-        return np.linalg.inv(X.transpose().dot(X)).dot(X.transpose()).dot(Y)
-
-    def linear_regression_var_explained(X, Y):
-        X = (X-X.mean(axis=0))/X.std(axis=0)
-        Y = (Y-Y.mean(axis=0))/Y.std(axis=0)
-        # remove null values which may result from 0 in the array`
-        X[np.isnan(X)] = 0
-        Y[np.isnan(Y)] = 0
-        # for each observation, it's values can be expressed through a linear combination of the predictors
-        # take a bias into account in the model
-        w = closed_form(X, Y, intercept=True)
-
-        # add an intercept
-        X_i = np.concatenate((X, np.ones([X.shape[0], 1])), axis=1)
-        # the residuals after regressing out the predictors
-        residuals = (Y-np.matmul(X_i, w))
-        # mean square error after regression, for each observation independently
-        MSE = np.mean((residuals**2), axis=0)
-        # Original variance in each observation before regression
-        TV = np.mean((Y-Y.mean(axis=0))**2, axis=0)
-
-        VE = MSE/TV  # total variance explained in each observation
-        VE[np.isnan(VE)] = 0
-
-        # mean square error after regression, for each observation independently
-        MSE = np.mean((residuals**2))
-        # Original variance in each observation before regression
-        TV = np.mean((Y-Y.mean(axis=0))**2)
-        VE_tot = MSE/TV
-
-        w = w[:-1, :]  # take out the intercept
-        # now evaluate the portion of variance explained by each predictor,
-        # scale all beta values to relative percentages of variance explained,
-        # with the assumption that each beta value represents directly the relative contribution of each predictor
-        # (guaranteed by the standardization of across feature)
-        # Original variance in each observation before regression
-        TV = np.sum((w-w.mean(axis=0))**2, axis=0)
-        pred_VE = (w-w.mean(axis=0))**2/TV
-        pred_VE[np.isnan(pred_VE)] = 0
-        VE_observations = pred_VE*VE  # scale by the proportion of total variance explained
-
-        # evaluate also variance explained from the entire data
-        pred_variance = w.var(axis=1)  # variance along each dimension
-        # evaluate the sum of variance present in this new dimensional space
-        TV = pred_variance.sum()
-        pred_VE = pred_variance/TV  # portion of variance explained from each dimension
-        total_VE = pred_VE*VE_tot
-        return total_VE, VE_observations, residuals
-
     import nibabel as nb
-    brain_mask = np.asarray(nb.load(brain_mask_file).dataobj)
-    volume_indices = brain_mask.astype(bool)
-
-    data_array = np.asarray(nb.load(bold_file).dataobj)
-    timeseries = np.zeros([data_array.shape[3], volume_indices.sum()])
-    for i in range(data_array.shape[3]):
-        timeseries[i, :] = (data_array[:, :, :, i])[volume_indices]
-
+    from rabies.preprocess_pkg.masking import extract_masked, scatter_masked
+    from rabies.conf_reg_pkg.utils import regression_engine
+    bold_img = nb.load(bold_file)
+    # the bold file is already restricted to the timeseries_interval, only the confounds are selected here
     if not timeseries_interval == 'all':
         lowcut = int(timeseries_interval.split(',')[0])
         highcut = int(timeseries_interval.split(',')[1])
         confounds_array = confounds_array[lowcut:highcut, :]
-        timeseries = timeseries[lowcut:highcut, :]
 
-    total_VE, VE_observations, residuals = linear_regression_var_explained(
-        confounds_array, timeseries)
+    # the voxel timeseries are masked once, and cleaned in place by the regression engine
+    data_dtype = np.result_type(bold_img.get_data_dtype(), np.float32)
+    timeseries = extract_masked(bold_img, brain_mask_file, dtype=data_dtype)
+    total_VE, VE_observations = regression_engine(timeseries, confounds_array, TR=TR, lowpass=lowpass,
+                                                  highpass=highpass, regress_confounds=len(conf_list) > 0, n_procs=n_procs)
 
     VE_dict = {}
     i = 0
@@ -243,13 +379,11 @@ def regress(bold_file, brain_mask_file, confounds_file, FD_file, conf_list, TR,
     with open(VE_file, 'wb') as handle:
         pickle.dump(VE_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
-    # cleaning includes detrending, standardization
-    if len(conf_list) > 0:
-        cleaned = nilearn.image.clean_img(bold_file, detrend=True, standardize=True, low_pass=lowpass,
-                                          high_pass=highpass, confounds=confounds_array, t_r=TR, mask_img=brain_mask_file)
-    else:
-        cleaned = nilearn.image.clean_img(bold_file, detrend=True, standardize=True,
-                                          low_pass=lowpass, high_pass=highpass, confounds=None, t_r=TR, mask_img=brain_mask_file)
+    header = bold_img.header.copy()
+    header.set_data_dtype(data_dtype)
+    cleaned = nb.Nifti1Image(scatter_masked(timeseries, brain_mask_file, dtype=data_dtype),
+                             bold_img.affine, header)
+    del timeseries
 
     if apply_scrubbing:
         cleaned = scrubbing(
@@ -260,7 +394,15 @@ def regress(bold_file, brain_mask_file, confounds_file, FD_file, conf_list, TR,
 
     cleaned_path = cr_out+'/'+filename_split[0]+'_cleaned.nii.gz'
     cleaned.to_filename(cleaned_path)
-    return cleaned_path, bold_file, VE_file
+
+    if timeseries_store:
+        from rabies.conf_reg_pkg.utils import write_timeseries_store
+        cleaned_timeseries = extract_masked(cleaned, brain_mask_file)
+        store_file = write_timeseries_store(cleaned_timeseries, brain_mask_file,
+                                            cr_out+'/'+filename_split[0]+'_cleaned.h5')
+    else:
+        store_file = None
+    return cleaned_path, bold_file, VE_file, store_file
 
 
 class data_diagnosisInputSpec(BaseInterfaceInputSpec):
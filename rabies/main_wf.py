@@ -5,7 +5,7 @@ from .preprocess_pkg.anat_preproc import init_anat_preproc_wf
 from .preprocess_pkg.commonspace import ANTsDBM
 from .preprocess_pkg.bold_main_wf import init_bold_main_wf
 from .preprocess_pkg.registration import run_antsRegistration
-from .preprocess_pkg.utils import BIDSDataGraber, prep_bids_iter, convert_to_RAS
+from .preprocess_pkg.utils import BIDSDataGraber, prep_bids_iter, convert_to_RAS, CompressedDataSink
 from .QC_report import PlotOverlap, PlotMotionTrace
 from nipype.interfaces.io import DataSink
 
@@ -86,11 +86,11 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
         FD_voxelwise
             Voxelwise framewise displacement (FD) measures that can be integrated
             to future confound regression.
-            These measures are computed from antsMotionCorrStats.
+            These measures are computed from the rigid body parameters, as in antsMotionCorrStats.
         pos_voxelwise
             Voxel distancing across time based on rigid body movement parameters,
             which can be integrated for a voxelwise motion regression
-            These measures are computed from antsMotionCorrStats.
+            These measures are computed from the rigid body parameters, as in antsMotionCorrStats.
         FD_csv
             .csv file with global framewise displacement (FD) measures
         bold_brain_mask
@@ -138,10 +138,11 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
                                'bold', 'cbv']), name='bold_selectfiles')
 
     # node to conver input image to consistent RAS orientation
-    bold_convert_to_RAS_node = pe.Node(Function(input_names=['img_file'],
+    bold_convert_to_RAS_node = pe.Node(Function(input_names=['img_file', 'intermediate_format'],
                                                 output_names=['RAS_file'],
                                                 function=convert_to_RAS),
                                        name='bold_convert_to_RAS')
+    bold_convert_to_RAS_node.inputs.intermediate_format = opts.intermediate_format
 
     # Resample the anatomical template according to the resolution of the provided input data
     from rabies.preprocess_pkg.utils import resample_template
@@ -299,19 +300,20 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
                                    'T2w', 'T1w']), name='anat_selectfiles')
         anat_selectfiles.inputs.run = None
 
-        anat_convert_to_RAS_node = pe.Node(Function(input_names=['img_file'],
+        anat_convert_to_RAS_node = pe.Node(Function(input_names=['img_file', 'intermediate_format'],
                                                     output_names=['RAS_file'],
                                                     function=convert_to_RAS),
                                            name='anat_convert_to_RAS')
+        anat_convert_to_RAS_node.inputs.intermediate_format = opts.intermediate_format
 
         # setting anat preprocessing nodes
         anat_preproc_wf = init_anat_preproc_wf(reg_script=opts.anat_reg_script,
                                                disable_anat_preproc=opts.disable_anat_preproc, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory)
         anat_preproc_wf.inputs.inputnode.template_mask = str(opts.brain_mask)
 
-        transform_masks = pe.Node(Function(input_names=['brain_mask_in', 'WM_mask_in', 'CSF_mask_in', 'vascular_mask_in', 'atlas_labels_in', 'reference_image', 'anat_to_template_inverse_warp', 'anat_to_template_affine', 'template_to_common_affine', 'template_to_common_inverse_warp'],
+        transform_masks = pe.Node(Function(input_names=['brain_mask_in', 'WM_mask_in', 'CSF_mask_in', 'vascular_mask_in', 'atlas_labels_in', 'reference_image', 'anat_to_template_inverse_warp', 'anat_to_template_affine', 'template_to_common_affine', 'template_to_common_inverse_warp', 'transforms_cache'],
                                            output_names=[
-                                               'brain_mask', 'WM_mask', 'CSF_mask', 'vascular_mask', 'anat_labels'],
+                                               'brain_mask', 'WM_mask', 'CSF_mask', 'vascular_mask', 'anat_labels', 'composite_warp'],
                                            function=transform_masks_anat),
                                   name='transform_masks')
         transform_masks.inputs.brain_mask_in = str(opts.brain_mask)
@@ -319,6 +321,8 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
         transform_masks.inputs.CSF_mask_in = str(opts.CSF_mask)
         transform_masks.inputs.vascular_mask_in = str(opts.vascular_mask)
         transform_masks.inputs.atlas_labels_in = str(opts.labels)
+        transform_masks.inputs.transforms_cache = os.path.abspath(
+            str(opts.output_dir))+'/transforms_cache'
 
         workflow.connect([
             (main_split, run_split, [
@@ -387,6 +391,7 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
                 ("transitionnode.bold_file", "transitionnode.bold_file"),
                 ("transitionnode.bold_ref", "transitionnode.bold_ref"),
                 ("transitionnode.corrected_EPI", "transitionnode.corrected_EPI"),
+                ("transitionnode.motion_estimates", "transitionnode.motion_estimates"),
                 ]),
             (bias_cor_bold_main_wf, commonspace_reg, [
              ("transitionnode.corrected_EPI", "moving_image")]),
@@ -468,20 +473,20 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
 
     elif opts.rabies_step == 'preprocess':
         # Datasink - creates output folder for important outputs
-        bold_datasink = pe.Node(DataSink(base_directory=output_folder,
-                                         container="bold_datasink"),
+        bold_datasink = pe.Node(CompressedDataSink(base_directory=output_folder,
+                                                   container="bold_datasink"),
                                 name="bold_datasink")
 
-        commonspace_datasink = pe.Node(DataSink(base_directory=output_folder,
-                                                container="commonspace_datasink"),
+        commonspace_datasink = pe.Node(CompressedDataSink(base_directory=output_folder,
+                                                          container="commonspace_datasink"),
                                        name="commonspace_datasink")
 
-        transforms_datasink = pe.Node(DataSink(base_directory=output_folder,
-                                               container="transforms_datasink"),
+        transforms_datasink = pe.Node(CompressedDataSink(base_directory=output_folder,
+                                                         container="transforms_datasink"),
                                       name="transforms_datasink")
 
-        confounds_datasink = pe.Node(DataSink(base_directory=output_folder,
-                                              container="confounds_datasink"),
+        confounds_datasink = pe.Node(CompressedDataSink(base_directory=output_folder,
+                                                        container="confounds_datasink"),
                                      name="confounds_datasink")
 
         workflow.connect([
@@ -539,8 +544,8 @@ def init_main_wf(data_dir_path, output_folder, opts, cr_opts=None, analysis_opts
             ])
 
         if not opts.bold_only:
-            anat_datasink = pe.Node(DataSink(base_directory=output_folder,
-                                             container="anat_datasink"),
+            anat_datasink = pe.Node(CompressedDataSink(base_directory=output_folder,
+                                                       container="anat_datasink"),
                                     name="anat_datasink")
 
             workflow.connect([
@@ -563,7 +568,8 @@ def integrate_confound_regression(workflow, outputnode, cr_opts, bold_only):
     from rabies.conf_reg_pkg.confound_regression import init_confound_regression_wf
     confound_regression_wf = init_confound_regression_wf(lowpass=cr_opts.lowpass, highpass=cr_opts.highpass,
                                                          smoothing_filter=cr_opts.smoothing_filter, run_aroma=cr_opts.run_aroma, aroma_dim=cr_opts.aroma_dim, conf_list=cr_opts.conf_list, TR=cr_opts.TR, apply_scrubbing=cr_opts.apply_scrubbing,
-                                                         scrubbing_threshold=cr_opts.scrubbing_threshold, timeseries_interval=cr_opts.timeseries_interval, diagnosis_output=cr_opts.diagnosis_output, name=cr_opts.wf_name)
+                                                         scrubbing_threshold=cr_opts.scrubbing_threshold, timeseries_interval=cr_opts.timeseries_interval, diagnosis_output=cr_opts.diagnosis_output,
+                                                         timeseries_store=cr_opts.timeseries_store, local_threads=cr_opts.local_threads, name=cr_opts.wf_name)
 
     workflow.connect([
         (outputnode, confound_regression_wf, [
@@ -601,6 +607,7 @@ def integrate_confound_regression(workflow, outputnode, cr_opts, bold_only):
             (confound_regression_wf, confound_regression_datasink, [
                 ("outputnode.cleaned_path", "cleaned_timeseries"),
                 ("outputnode.VE_file", "VE_file"),
+                ("outputnode.timeseries_store", "timeseries_store"),
                 ("outputnode.mel_out", "subject_melodic_ICA"),
                 ("outputnode.tSNR_file", "tSNR_map"),
                 ]),
@@ -649,6 +656,7 @@ def integrate_analysis(workflow, outputnode, confound_regression_wf, analysis_op
     workflow.connect([
         (confound_regression_wf, analysis_wf, [
             ("outputnode.cleaned_path", "subject_inputnode.bold_file"),
+            ("outputnode.timeseries_store", "subject_inputnode.store_file"),
             ]),
         (analysis_joinnode_main, analysis_wf, [
             ("file_list", "group_inputnode.bold_file_list"),
@@ -659,8 +667,11 @@ def integrate_analysis(workflow, outputnode, confound_regression_wf, analysis_op
             ("outputnode.IC_file", "group_IC_file"),
             ("outputnode.DR_data_file", "DR_data_file"),
             ("outputnode.DR_nii_file", "DR_nii_file"),
+            ("outputnode.DR_timecourse_file", "DR_timecourse_file"),
             ("outputnode.matrix_data_file", "matrix_data_file"),
             ("outputnode.matrix_fig", "matrix_fig"),
+            ("outputnode.FC_degree_file", "FC_degree_map"),
+            ("outputnode.FC_GBC_file", "FC_GBC_map"),
             ("outputnode.corr_map_file", "seed_correlation_maps"),
             ]),
         ])
@@ -691,6 +702,61 @@ def integrate_analysis(workflow, outputnode, confound_regression_wf, analysis_op
                 ("mask_file", "mask_file"),
                 ]),
             ])
+
+    if analysis_opts.group_stats:
+        from rabies.analysis_pkg.analysis_functions import aggregate_group_stats
+        group_outputs = []
+        if analysis_opts.FC_matrix:
+            if analysis_opts.ROI_type == 'voxelwise' and analysis_opts.voxelwise_FC_format == 'sparse':
+                raise ValueError(
+                    'Group statistics are not supported for sparse voxelwise FC matrices. Select another --voxelwise_FC_format.')
+            # FC matrices are correlations, and are also averaged in Fisher z space
+            group_outputs.append(('FC', 'outputnode.matrix_data_file', True))
+        if analysis_opts.DR_ICA:
+            group_outputs.append(('DR', 'outputnode.DR_nii_file', False))
+
+        for name, output, fisher_z in group_outputs:
+            group_stats_node = pe.Node(Function(input_names=['file_list', 'name', 'store_format', 'fisher_z'],
+                                                output_names=['store_file', 'stats_file'],
+                                                function=aggregate_group_stats),
+                                       name='%s_group_stats' % (name,), mem_gb=1)
+            group_stats_node.inputs.name = name
+            group_stats_node.inputs.store_format = analysis_opts.group_store_format
+            group_stats_node.inputs.fisher_z = fisher_z
+
+            # the per-scan outputs are joined across scans, as for the group analysis inputs
+            joinnode_main = pe.JoinNode(niu.IdentityInterface(fields=['file_list']),
+                                        name='%s_joinnode_main' % (name,),
+                                        joinsource='main_split',
+                                        joinfield=['file_list'])
+            if bold_only:
+                workflow.connect([
+                    (analysis_wf, joinnode_main, [
+                        (output, "file_list"),
+                        ]),
+                    ])
+            else:
+                joinnode_run = pe.JoinNode(niu.IdentityInterface(fields=['file_list']),
+                                           name='%s_joinnode_run' % (name,),
+                                           joinsource='run_split',
+                                           joinfield=['file_list'])
+                workflow.connect([
+                    (analysis_wf, joinnode_run, [
+                        (output, "file_list"),
+                        ]),
+                    (joinnode_run, joinnode_main, [
+                        ("file_list", "file_list"),
+                        ]),
+                    ])
+            workflow.connect([
+                (joinnode_main, group_stats_node, [
+                    ("file_list", "file_list"),
+                    ]),
+                (group_stats_node, analysis_datasink, [
+                    ("store_file", "%s_group_store" % (name,)),
+                    ("stats_file", "%s_group_stats" % (name,)),
+                    ]),
+                ])
     return workflow
 
 
@@ -704,61 +770,35 @@ def select_commonspace_outputs(filename, affine_list, warp_list, inverse_warp_li
     return anat_to_template_affine, anat_to_template_warp, anat_to_template_inverse_warp, warped_anat
 
 
-def transform_masks_anat(brain_mask_in, WM_mask_in, CSF_mask_in, vascular_mask_in, atlas_labels_in, reference_image, anat_to_template_inverse_warp, anat_to_template_affine, template_to_common_affine, template_to_common_inverse_warp):
+def transform_masks_anat(brain_mask_in, WM_mask_in, CSF_mask_in, vascular_mask_in, atlas_labels_in, reference_image, anat_to_template_inverse_warp, anat_to_template_affine, template_to_common_affine, template_to_common_inverse_warp, transforms_cache=None):
     # function to transform atlas masks to individual anatomical scans
+    # the inverse transform chain is composed once into a cached displacement field, through which all masks are resampled
     import os
-    from rabies.preprocess_pkg.utils import run_command
+    import SimpleITK as sitk
+    from rabies.preprocess_pkg.utils import cached_displacement_field, resample_label_images
     cwd = os.getcwd()
 
     import pathlib  # Better path manipulation
     filename_template = pathlib.Path(reference_image).name.rsplit(".nii")[0]
 
-    input_image = brain_mask_in
+    reference = sitk.ReadImage(reference_image)
+    if transforms_cache is None:
+        transforms_cache = cwd
+    composite_warp = cached_displacement_field([anat_to_template_inverse_warp, anat_to_template_affine, template_to_common_inverse_warp, template_to_common_affine],
+                                               [0, 1, 0, 1], reference, transforms_cache)
+
     brain_mask = '%s/%s_%s' % (cwd,
                                filename_template, 'anat_mask.nii.gz')
-    command = 'antsApplyTransforms -d 3 -i %s -t %s -t [%s,1] -t %s -t [%s,1] -r %s -o %s --verbose -n GenericLabel' % (
-        input_image, anat_to_template_inverse_warp, anat_to_template_affine, template_to_common_inverse_warp, template_to_common_affine, reference_image, brain_mask,)
-    rc = run_command(command)
-    if not os.path.isfile(brain_mask):
-        raise ValueError(
-            "Missing output mask. Transform call failed: "+command)
-
-    input_image = WM_mask_in
     WM_mask = '%s/%s_%s' % (cwd, filename_template, 'WM_mask.nii.gz')
-    command = 'antsApplyTransforms -d 3 -i %s -t %s -t [%s,1] -t %s -t [%s,1] -r %s -o %s --verbose -n GenericLabel' % (
-        input_image, anat_to_template_inverse_warp, anat_to_template_affine, template_to_common_inverse_warp, template_to_common_affine, reference_image, WM_mask,)
-    rc = run_command(command)
-    if not os.path.isfile(WM_mask):
-        raise ValueError(
-            "Missing output mask. Transform call failed: "+command)
-
-    input_image = CSF_mask_in
     CSF_mask = '%s/%s_%s' % (cwd, filename_template, 'CSF_mask.nii.gz')
-    command = 'antsApplyTransforms -d 3 -i %s -t %s -t [%s,1] -t %s -t [%s,1] -r %s -o %s --verbose -n GenericLabel' % (
-        input_image, anat_to_template_inverse_warp, anat_to_template_affine, template_to_common_inverse_warp, template_to_common_affine, reference_image, CSF_mask,)
-    rc = run_command(command)
-    if not os.path.isfile(CSF_mask):
-        raise ValueError(
-            "Missing output mask. Transform call failed: "+command)
-
-    input_image = vascular_mask_in
     vascular_mask = '%s/%s_%s' % (cwd,
                                   filename_template, 'vascular_mask.nii.gz')
-    command = 'antsApplyTransforms -d 3 -i %s -t %s -t [%s,1] -t %s -t [%s,1] -r %s -o %s --verbose -n GenericLabel' % (
-        input_image, anat_to_template_inverse_warp, anat_to_template_affine, template_to_common_inverse_warp, template_to_common_affine, reference_image, vascular_mask,)
-    rc = run_command(command)
-    if not os.path.isfile(vascular_mask):
-        raise ValueError(
-            "Missing output mask. Transform call failed: "+command)
-
-    input_image = atlas_labels_in
     anat_labels = '%s/%s_%s' % (cwd,
                                 filename_template, 'atlas_labels.nii.gz')
-    command = 'antsApplyTransforms -d 3 -i %s -t %s -t [%s,1] -t %s -t [%s,1] -r %s -o %s --verbose -n GenericLabel' % (
-        input_image, anat_to_template_inverse_warp, anat_to_template_affine, template_to_common_inverse_warp, template_to_common_affine, reference_image, anat_labels,)
-    rc = run_command(command)
-    if not os.path.isfile(anat_labels):
-        raise ValueError(
-            "Missing output mask. Transform call failed: "+command)
 
-    return brain_mask, WM_mask, CSF_mask, vascular_mask, anat_labels
+    transform = sitk.DisplacementFieldTransform(
+        sitk.ReadImage(composite_warp, sitk.sitkVectorFloat64))
+    resample_label_images([brain_mask_in, WM_mask_in, CSF_mask_in, vascular_mask_in, atlas_labels_in], reference,
+                          [brain_mask, WM_mask, CSF_mask, vascular_mask, anat_labels], transform=transform)
+
+    return brain_mask, WM_mask, CSF_mask, vascular_mask, anat_labels, composite_warp
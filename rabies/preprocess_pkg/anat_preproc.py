@@ -63,8 +63,8 @@ class AnatPreproc(BaseInterface):
     def _run_interface(self, runtime):
         import os
         import numpy as np
-        import SimpleITK as sitk
         from rabies.preprocess_pkg.utils import resample_image_spacing, run_command
+        from rabies.preprocess_pkg.image_io import read_image, read_image_information, write_image, cast_image_file
 
         cwd = os.getcwd()
         out_dir = '%s/anat_preproc/' % (cwd,)
@@ -77,31 +77,30 @@ class AnatPreproc(BaseInterface):
         output_anat = '%s%s_preproc.nii.gz' % (out_dir, filename_split[0],)
 
         # resample the anatomical image to the resolution of the provided template
-        anat_image = sitk.ReadImage(
-            self.inputs.nii_anat, self.inputs.rabies_data_type)
-        anat_dim = anat_image.GetSpacing()
-
-        template_image = sitk.ReadImage(
-            self.inputs.template_anat, self.inputs.rabies_data_type)
-        template_dim = template_image.GetSpacing()
+        anat_dim = read_image_information(self.inputs.nii_anat).GetSpacing()
+        template_dim = read_image_information(
+            self.inputs.template_anat).GetSpacing()
         if not (np.array(anat_dim) == np.array(template_dim)).sum() == 3:
             print('Anat image will be resampled to the template resolution.')
+            anat_image = read_image(
+                self.inputs.nii_anat, self.inputs.rabies_data_type)
             resampled_anat = resample_image_spacing(anat_image, template_dim)
             input_anat = out_dir+filename_split[0]+'_resampled.nii.gz'
-            sitk.WriteImage(resampled_anat, input_anat)
+            write_image(resampled_anat, input_anat,
+                        self.inputs.rabies_data_type)
         else:
             input_anat = self.inputs.nii_anat
 
         if self.inputs.disable_anat_preproc:
             # resample image to specified data format
-            sitk.WriteImage(sitk.ReadImage(input_anat, self.inputs.rabies_data_type), output_anat)
+            cast_image_file(input_anat, self.inputs.rabies_data_type, out_file=output_anat)
         else:
             command = 'bash %s/../shell_scripts/anat_preproc.sh %s %s %s %s %s' % (
                 dir_path, input_anat, self.inputs.template_anat, self.inputs.template_mask, output_anat, self.inputs.reg_script)
             rc = run_command(command)
 
             # resample image to specified data format
-            sitk.WriteImage(sitk.ReadImage(output_anat, self.inputs.rabies_data_type), output_anat)
+            cast_image_file(output_anat, self.inputs.rabies_data_type)
 
         setattr(self, 'preproc_anat', output_anat)
         return runtime
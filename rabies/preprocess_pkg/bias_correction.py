@@ -86,6 +86,7 @@ class OtsuEPIBiasCorrection(BaseInterface):
 
         import rabies
         from rabies.preprocess_pkg.utils import run_command, resample_image_spacing
+        from rabies.preprocess_pkg.image_io import read_image, read_image_information, write_image, cast_image_file
         dir_path = os.path.dirname(os.path.realpath(rabies.__file__))
         reg_script_path=dir_path+'/shell_scripts/antsRegistration_rigid.sh'
 
@@ -123,14 +124,13 @@ class OtsuEPIBiasCorrection(BaseInterface):
         otsu_bias_cor(target=bias_cor_input, otsu_ref='corrected_iter2.nii.gz', out_name=cwd+'/final_otsu.nii.gz', b_value=b_value, mask=resampled_mask)
 
         # resample to anatomical image resolution
-        dim = sitk.ReadImage(self.inputs.anat, self.inputs.rabies_data_type).GetSpacing()
+        dim = read_image_information(self.inputs.anat).GetSpacing()
         low_dim = np.asarray(dim).min()
-        sitk.WriteImage(resample_image_spacing(sitk.ReadImage(cwd+'/final_otsu.nii.gz',
-                                                              self.inputs.rabies_data_type), (low_dim, low_dim, low_dim)), biascor_EPI)
+        write_image(resample_image_spacing(read_image(cwd+'/final_otsu.nii.gz',
+                                                      self.inputs.rabies_data_type), (low_dim, low_dim, low_dim)), biascor_EPI, self.inputs.rabies_data_type)
 
-        sitk.WriteImage(sitk.ReadImage(biascor_EPI, self.inputs.rabies_data_type), biascor_EPI)
-        sitk.WriteImage(sitk.ReadImage(warped_image, self.inputs.rabies_data_type), warped_image)
-        sitk.WriteImage(sitk.ReadImage(resampled_mask, self.inputs.rabies_data_type), resampled_mask)
+        cast_image_file(warped_image, self.inputs.rabies_data_type)
+        cast_image_file(resampled_mask, self.inputs.rabies_data_type)
 
         setattr(self, 'corrected_EPI', biascor_EPI)
         setattr(self, 'warped_EPI', warped_image)
@@ -244,6 +244,7 @@ class EPIBiasCorrection(BaseInterface):
 
         import rabies
         from rabies.preprocess_pkg.utils import run_command, resample_image_spacing
+        from rabies.preprocess_pkg.image_io import read_image, read_image_information, write_image, cast_image_file
         dir_path = os.path.dirname(os.path.realpath(rabies.__file__))
         reg_script_path=dir_path+'/shell_scripts/antsRegistration_rigid.sh'
         bias_cor_script_path = dir_path+'/shell_scripts/iter_bias_cor.sh'
@@ -270,14 +271,13 @@ class EPIBiasCorrection(BaseInterface):
         rc = run_command(command)
 
         # resample to anatomical image resolution
-        dim = sitk.ReadImage(self.inputs.anat, self.inputs.rabies_data_type).GetSpacing()
+        dim = read_image_information(self.inputs.anat).GetSpacing()
         low_dim = np.asarray(dim).min()
-        sitk.WriteImage(resample_image_spacing(sitk.ReadImage(cwd+'/iter_corrected.nii.gz',
-                                                              self.inputs.rabies_data_type), (low_dim, low_dim, low_dim)), biascor_EPI)
+        write_image(resample_image_spacing(read_image(cwd+'/iter_corrected.nii.gz',
+                                                      self.inputs.rabies_data_type), (low_dim, low_dim, low_dim)), biascor_EPI, self.inputs.rabies_data_type)
 
-        sitk.WriteImage(sitk.ReadImage(biascor_EPI, self.inputs.rabies_data_type), biascor_EPI)
-        sitk.WriteImage(sitk.ReadImage(warped_image, self.inputs.rabies_data_type), warped_image)
-        sitk.WriteImage(sitk.ReadImage(resampled_mask, self.inputs.rabies_data_type), resampled_mask)
+        cast_image_file(warped_image, self.inputs.rabies_data_type)
+        cast_image_file(resampled_mask, self.inputs.rabies_data_type)
 
         setattr(self, 'corrected_EPI', biascor_EPI)
         setattr(self, 'warped_EPI', warped_image)
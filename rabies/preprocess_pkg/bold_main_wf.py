@@ -94,11 +94,11 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
         FD_voxelwise
             Voxelwise framewise displacement (FD) measures that can be integrated
             to future confound regression.
-            These measures are computed from antsMotionCorrStats.
+            These measures are computed from the rigid body parameters, as in antsMotionCorrStats.
         pos_voxelwise
             Voxel distancing across time based on rigid body movement parameters,
             which can be integrated for a voxelwise motion regression
-            These measures are computed from antsMotionCorrStats.
+            These measures are computed from the rigid body parameters, as in antsMotionCorrStats.
         FD_csv
             .csv file with global framewise displacement (FD) measures
         EPI_brain_mask
@@ -121,6 +121,7 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
         commonspace_labels
             EPI anatomical labels for commonspace bold
     """
+    import os
 
     workflow = pe.Workflow(name=name)
 
@@ -136,12 +137,12 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
                          name="boldbuffer")
 
     # this node will serve as a relay of outputs from the bias_cor main_wf to the inputs for the rest of the main_wf for bold_only
-    transitionnode = pe.Node(niu.IdentityInterface(fields=['bold_file', 'bold_ref', 'corrected_EPI']),
+    transitionnode = pe.Node(niu.IdentityInterface(fields=['bold_file', 'bold_ref', 'corrected_EPI', 'motion_estimates']),
                              name="transitionnode")
 
     if bias_cor_only or (not opts.bold_only):
         bold_reference_wf = init_bold_reference_wf(
-            detect_dummy=opts.detect_dummy, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc)
+            detect_dummy=opts.detect_dummy, motion_engine=opts.motion_engine, intermediate_format=opts.intermediate_format, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc)
         bias_cor_wf = bias_correction_wf(
             bias_cor_method=opts.bias_cor_method, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory)
 
@@ -185,6 +186,7 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
                 ]),
             (bold_reference_wf, transitionnode, [
                 ('outputnode.ref_image', 'bold_ref'),
+                ('outputnode.motion_estimates', 'motion_estimates'),
                 ]),
             (bias_cor_wf, transitionnode, [
                 ('outputnode.corrected_EPI', 'corrected_EPI'),
@@ -195,12 +197,15 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
         return workflow
 
     bold_stc_wf = init_bold_stc_wf(
-        no_STC=opts.no_STC, tr=opts.TR, tpattern=opts.tpattern, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc)
+        no_STC=opts.no_STC, tr=opts.TR, tpattern=opts.tpattern, stc_engine=opts.stc_engine, intermediate_format=opts.intermediate_format, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc, local_threads=opts.local_threads)
 
     # HMC on the BOLD
-    bold_hmc_wf = init_bold_hmc_wf(slice_mc=opts.apply_slice_mc, rabies_data_type=opts.data_type,
+    bold_hmc_wf = init_bold_hmc_wf(slice_mc=opts.apply_slice_mc, slice_mc_engine=opts.slice_mc_engine, motion_engine=opts.motion_engine, intermediate_format=opts.intermediate_format, rabies_data_type=opts.data_type,
                                    rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc, local_threads=opts.local_threads)
 
+    # composed transforms are cached in the output folder to be shared across resampling passes and re-runs
+    transforms_cache = os.path.abspath(str(opts.output_dir))+'/transforms_cache'
+
     if not opts.bold_only:
         def commonspace_transforms(template_to_common_warp, template_to_common_affine, anat_to_template_warp, anat_to_template_affine, warp_bold2anat, affine_bold2anat):
             # transforms_list,inverses
@@ -221,10 +226,10 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
                                               name='commonspace_transforms_prep')
 
     bold_commonspace_trans_wf = init_bold_commonspace_trans_wf(resampling_dim=opts.commonspace_resampling, brain_mask=str(opts.brain_mask), WM_mask=str(opts.WM_mask), CSF_mask=str(opts.CSF_mask), vascular_mask=str(opts.vascular_mask), atlas_labels=str(opts.labels),
-        slice_mc=opts.apply_slice_mc, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc)
+        slice_mc=opts.apply_slice_mc, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc, local_threads=opts.local_threads, transforms_cache=transforms_cache, motion_engine=opts.motion_engine, intermediate_format=opts.intermediate_format)
 
     bold_confs_wf = init_bold_confs_wf(
-        aCompCor_method=aCompCor_method, name="bold_confs_wf", rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc)
+        aCompCor_method=aCompCor_method, intermediate_format=opts.intermediate_format, name="bold_confs_wf", rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc)
 
     # MAIN WORKFLOW STRUCTURE #######################################################
     workflow.connect([
@@ -246,6 +251,7 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
             ]),
         (transitionnode, bold_hmc_wf, [
             ('bold_ref', 'inputnode.ref_image'),
+            ('motion_estimates', 'inputnode.motion_estimates'),
             ]),
         (bold_hmc_wf, outputnode, [
             ('outputnode.motcorr_params', 'motcorr_params')]),
@@ -301,7 +307,7 @@ def init_bold_main_wf(opts, bias_cor_only=False, aCompCor_method='50%', name='bo
 
         # Apply transforms in 1 shot
         bold_bold_trans_wf = init_bold_preproc_trans_wf(
-            resampling_dim=opts.nativespace_resampling, slice_mc=opts.apply_slice_mc, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc)
+            resampling_dim=opts.nativespace_resampling, slice_mc=opts.apply_slice_mc, rabies_data_type=opts.data_type, rabies_mem_scale=opts.scale_min_memory, min_proc=opts.min_proc, local_threads=opts.local_threads, transforms_cache=transforms_cache, motion_engine=opts.motion_engine, intermediate_format=opts.intermediate_format)
 
         workflow.connect([
             (inputnode, bold_reg_wf, [
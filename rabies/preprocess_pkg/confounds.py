@@ -7,7 +7,7 @@ from nipype.interfaces.base import (
 )
 
 
-def init_bold_confs_wf(aCompCor_method='50%', rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, name="bold_confs_wf"):
+def init_bold_confs_wf(aCompCor_method='50%', intermediate_format='nii.gz', rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, name="bold_confs_wf"):
 
     inputnode = pe.Node(niu.IdentityInterface(
         fields=['bold', 'ref_bold', 'movpar_file', 't1_mask', 't1_labels', 'WM_mask', 'CSF_mask', 'vascular_mask', 'name_source']),
@@ -16,70 +16,50 @@ def init_bold_confs_wf(aCompCor_method='50%', rabies_data_type=8, rabies_mem_sca
         fields=['cleaned_bold', 'GSR_cleaned_bold', 'brain_mask', 'WM_mask', 'CSF_mask', 'EPI_labels', 'confounds_csv', 'FD_csv', 'FD_voxelwise', 'pos_voxelwise']),
         name='outputnode')
 
-    WM_mask_to_EPI = pe.Node(MaskEPI(), name='WM_mask_EPI')
-    WM_mask_to_EPI.inputs.name_spec = 'WM_mask'
+    # the WM, CSF, vascular, brain masks and the labels are resampled together onto the EPI
+    merge_masks = pe.Node(niu.Merge(5), name='merge_masks')
+    masks_to_EPI = pe.Node(MultiMaskEPI(), name='masks_to_EPI')
+    masks_to_EPI.inputs.name_specs = [
+        'WM_mask', 'CSF_mask', 'vascular_mask', 'brain_mask', 'anat_labels']
+    split_masks = pe.Node(niu.Split(
+        splits=[1, 1, 1, 1, 1], squeeze=True), name='split_masks')
 
-    CSF_mask_to_EPI = pe.Node(MaskEPI(), name='CSF_mask_EPI')
-    CSF_mask_to_EPI.inputs.name_spec = 'CSF_mask'
-
-    vascular_mask_to_EPI = pe.Node(MaskEPI(), name='vascular_mask_EPI')
-    vascular_mask_to_EPI.inputs.name_spec = 'vascular_mask'
-
-    brain_mask_to_EPI = pe.Node(MaskEPI(), name='Brain_mask_EPI')
-    brain_mask_to_EPI.inputs.name_spec = 'brain_mask'
-
-    propagate_labels = pe.Node(MaskEPI(), name='prop_labels_EPI')
-    propagate_labels.inputs.name_spec = 'anat_labels'
-
-    estimate_confounds = pe.Node(EstimateConfounds(aCompCor_method=aCompCor_method, rabies_data_type=rabies_data_type),
+    estimate_confounds = pe.Node(EstimateConfounds(aCompCor_method=aCompCor_method, intermediate_format=intermediate_format, rabies_data_type=rabies_data_type),
                                  name='estimate_confounds', mem_gb=2.3*rabies_mem_scale)
     estimate_confounds.plugin_args = {
         'qsub_args': '-pe smp %s' % (str(2*min_proc)), 'overwrite': True}
 
     workflow = pe.Workflow(name=name)
     workflow.connect([
-        (inputnode, WM_mask_to_EPI, [
-            ('WM_mask', 'mask'),
-            ('ref_bold', 'ref_EPI'),
-            ('name_source', 'name_source')]),
-        (inputnode, CSF_mask_to_EPI, [
-            ('CSF_mask', 'mask'),
-            ('ref_bold', 'ref_EPI'),
-            ('name_source', 'name_source')]),
-        (inputnode, vascular_mask_to_EPI, [
-            ('vascular_mask', 'mask'),
-            ('ref_bold', 'ref_EPI'),
-            ('name_source', 'name_source')]),
-        (inputnode, brain_mask_to_EPI, [
-            ('t1_mask', 'mask'),
-            ('ref_bold', 'ref_EPI'),
-            ('name_source', 'name_source')]),
-        (inputnode, propagate_labels, [
-            ('t1_labels', 'mask'),
+        (inputnode, merge_masks, [
+            ('WM_mask', 'in1'),
+            ('CSF_mask', 'in2'),
+            ('vascular_mask', 'in3'),
+            ('t1_mask', 'in4'),
+            ('t1_labels', 'in5')]),
+        (merge_masks, masks_to_EPI, [
+            ('out', 'masks')]),
+        (inputnode, masks_to_EPI, [
             ('ref_bold', 'ref_EPI'),
             ('name_source', 'name_source')]),
+        (masks_to_EPI, split_masks, [
+            ('EPI_masks', 'inlist')]),
         (inputnode, estimate_confounds, [
             ('movpar_file', 'movpar_file'),
             ]),
         (inputnode, estimate_confounds, [
             ('bold', 'bold'),
             ]),
-        (WM_mask_to_EPI, estimate_confounds, [
-            ('EPI_mask', 'WM_mask')]),
-        (WM_mask_to_EPI, outputnode, [
-            ('EPI_mask', 'WM_mask')]),
-        (CSF_mask_to_EPI, estimate_confounds, [
-            ('EPI_mask', 'CSF_mask')]),
-        (CSF_mask_to_EPI, outputnode, [
-            ('EPI_mask', 'CSF_mask')]),
-        (vascular_mask_to_EPI, estimate_confounds, [
-            ('EPI_mask', 'vascular_mask')]),
-        (brain_mask_to_EPI, estimate_confounds, [
-            ('EPI_mask', 'brain_mask')]),
-        (brain_mask_to_EPI, outputnode, [
-            ('EPI_mask', 'brain_mask')]),
-        (propagate_labels, outputnode, [
-            ('EPI_mask', 'EPI_labels')]),
+        (split_masks, estimate_confounds, [
+            ('out1', 'WM_mask'),
+            ('out2', 'CSF_mask'),
+            ('out3', 'vascular_mask'),
+            ('out4', 'brain_mask')]),
+        (split_masks, outputnode, [
+            ('out1', 'WM_mask'),
+            ('out2', 'CSF_mask'),
+            ('out4', 'brain_mask'),
+            ('out5', 'EPI_labels')]),
         (estimate_confounds, outputnode, [
             ('confounds_csv', 'confounds_csv'),
             ('FD_csv', 'FD_csv'),
@@ -105,6 +85,10 @@ class EstimateConfoundsInputSpec(BaseInterfaceInputSpec):
                          desc="EPI-formated vascular mask")
     aCompCor_method = traits.Str(
         desc="The type of evaluation for the number of aCompCor components: either '50%' or 'first_5'.")
+    voxelwise_motion = traits.Bool(True, usedefault=True,
+        desc="Whether to write the voxelwise maps of positioning and framewise displacement.")
+    intermediate_format = traits.Enum('nii.gz', 'nii', usedefault=True,
+                                      desc="Format of the 4D images written in the working directory. Uncompressed .nii avoids the gzip compression of intermediates.")
     rabies_data_type = traits.Int(mandatory=True,
         desc="Integer specifying SimpleITK data type.")
 
@@ -125,43 +109,48 @@ class EstimateConfounds(BaseInterface):
     def _run_interface(self, runtime):
         import numpy as np
         import os
-        from rabies.preprocess_pkg.utils import run_command
         import pathlib  # Better path manipulation
         filename_split = pathlib.Path(self.inputs.bold).name.rsplit(".nii")
 
-        # generate a .nii file representing the positioning or framewise displacement for each voxel within the brain_mask
-        # first the voxelwise positioning map
-        command = 'antsMotionCorrStats -m %s -o %s_pos_file.csv -x %s \
-                    -d %s -s %s_pos_voxelwise.nii.gz' % (self.inputs.movpar_file, filename_split[0], self.inputs.brain_mask, self.inputs.bold, filename_split[0])
-        rc = run_command(command)
-        pos_voxelwise = os.path.abspath(
-            "%s_pos_file.nii.gz" % filename_split[0])
-
-        # then the voxelwise framewise displacement map
-        command = 'antsMotionCorrStats -m %s -o %s_FD_file.csv -x %s \
-                    -d %s -s %s_FD_voxelwise.nii.gz -f 1' % (self.inputs.movpar_file, filename_split[0], self.inputs.brain_mask, self.inputs.bold, filename_split[0])
-        rc = run_command(command)
-
-        FD_csv = os.path.abspath("%s_FD_file.csv" % filename_split[0])
-        FD_voxelwise = os.path.abspath("%s_FD_file.nii.gz" % filename_split[0])
+        # the displacement of each voxel within the brain_mask is computed from the rigid parameters, both relative to
+        # the reference (positioning) and relative to the previous frame (framewise displacement)
+        [pos_displacement, FD_displacement] = rigid_displacement(
+            self.inputs.movpar_file, self.inputs.brain_mask)
+        FD_csv = write_displacement_csv(FD_displacement, os.path.abspath(
+            "%s_FD_file.csv" % filename_split[0]))
+
+        if self.inputs.voxelwise_motion:
+            import nibabel as nb
+            TR = nb.load(self.inputs.bold).header.get_zooms()[3]
+            pos_voxelwise = write_voxelwise_displacement(pos_displacement, self.inputs.brain_mask, TR, os.path.abspath(
+                "%s_pos_voxelwise.%s" % (filename_split[0], self.inputs.intermediate_format)))
+            FD_voxelwise = write_voxelwise_displacement(FD_displacement, self.inputs.brain_mask, TR, os.path.abspath(
+                "%s_FD_voxelwise.%s" % (filename_split[0], self.inputs.intermediate_format)))
+        else:
+            from nipype.interfaces.base import Undefined
+            pos_voxelwise = Undefined
+            FD_voxelwise = Undefined
 
         confounds = []
         csv_columns = []
-        WM_signal = extract_mask_trace(self.inputs.bold, self.inputs.WM_mask)
+        # the bold series is read once to extract the mean trace of each mask, and the WM/CSF voxel timeseries for aCompCor
+        [mask_traces, noise_timeseries] = extract_mask_signals(self.inputs.bold, [
+            self.inputs.WM_mask, self.inputs.CSF_mask, self.inputs.vascular_mask, self.inputs.brain_mask],
+            noise_masks=[self.inputs.WM_mask, self.inputs.CSF_mask])
+        [WM_signal, CSF_signal, vascular_signal, global_signal] = mask_traces
+
         confounds.append(WM_signal)
         csv_columns += ['WM_signal']
 
-        CSF_signal = extract_mask_trace(self.inputs.bold, self.inputs.CSF_mask)
         confounds.append(CSF_signal)
         csv_columns += ['CSF_signal']
 
-        vascular_signal = extract_mask_trace(
-            self.inputs.bold, self.inputs.vascular_mask)
         confounds.append(vascular_signal)
         csv_columns += ['vascular_signal']
 
         [aCompCor, num_comp] = compute_aCompCor(
-            self.inputs.bold, self.inputs.WM_mask, self.inputs.CSF_mask, method=self.inputs.aCompCor_method, rabies_data_type=self.inputs.rabies_data_type)
+            noise_timeseries, method=self.inputs.aCompCor_method)
+        del noise_timeseries
         for param in range(aCompCor.shape[1]):
             confounds.append(aCompCor[:, param])
         comp_column = []
@@ -169,8 +158,6 @@ class EstimateConfounds(BaseInterface):
             comp_column.append('aCompCor'+str(comp+1))
         csv_columns += comp_column
 
-        global_signal = extract_mask_trace(
-            self.inputs.bold, self.inputs.brain_mask)
         confounds.append(global_signal)
         csv_columns += ['global_signal']
         motion_24 = motion_24_params(self.inputs.movpar_file)
@@ -195,6 +182,107 @@ class EstimateConfounds(BaseInterface):
                 'FD_voxelwise': getattr(self, 'FD_voxelwise')}
 
 
+def rigid_params_to_affines(rigid_params):
+    '''
+    Converts an array of 6 rigid parameters per frame, with the Euler3D convention of the antsMotionCorr .csv
+    (3 rotation angles in radians followed by the translation, centered on the origin), into the corresponding
+    rotation matrices and translations of shape (num_frames,3,3) and (num_frames,3).
+    '''
+    import numpy as np
+    rigid_params = np.asarray(rigid_params, dtype='float64')
+    num_frames = rigid_params.shape[0]
+    [cos_x, cos_y, cos_z] = np.cos(rigid_params[:, :3]).T
+    [sin_x, sin_y, sin_z] = np.sin(rigid_params[:, :3]).T
+    zeros = np.zeros(num_frames)
+    ones = np.ones(num_frames)
+    rot_x = np.stack([ones, zeros, zeros, zeros, cos_x, -sin_x, zeros, sin_x, cos_x], axis=1).reshape(-1, 3, 3)
+    rot_y = np.stack([cos_y, zeros, sin_y, zeros, ones, zeros, -sin_y, zeros, cos_y], axis=1).reshape(-1, 3, 3)
+    rot_z = np.stack([cos_z, -sin_z, zeros, sin_z, cos_z, zeros, zeros, zeros, ones], axis=1).reshape(-1, 3, 3)
+    # ITK's Euler3DTransform composes the rotations in the Z*X*Y order
+    rotations = np.matmul(rot_z, np.matmul(rot_x, rot_y))
+    return rotations, rigid_params[:, 3:]
+
+
+def mask_physical_points(mask_file):
+    '''
+    Returns the physical coordinates (in the ITK space of the motion parameters) of the voxels within a mask,
+    as an array of shape (num_voxels,3), together with the (z,y,x) indices of these voxels.
+    '''
+    import numpy as np
+    import SimpleITK as sitk
+    mask_img = sitk.ReadImage(mask_file, sitk.sitkInt16)
+    voxel_indices = np.nonzero(sitk.GetArrayViewFromImage(mask_img))
+    direction = np.asarray(mask_img.GetDirection()).reshape(3, 3)
+    index_to_physical = direction.dot(np.diag(mask_img.GetSpacing()))
+    # the array indices are (z,y,x) whereas ITK indices are (x,y,z)
+    points = np.stack(voxel_indices[::-1], axis=1).dot(
+        index_to_physical.T)+np.asarray(mask_img.GetOrigin())
+    return points, voxel_indices
+
+
+def rigid_displacement(movpar_csv, mask_file, chunk_size=100):
+    '''
+    Computes for each frame the displacement of each voxel within the mask given the rigid motion parameters,
+    as done by antsMotionCorrStats. Returns two arrays of shape (num_frames,num_voxels): the displacement
+    relative to the reference (positioning), and relative to the previous frame (framewise displacement,
+    set to 0 for the first frame). Frames are processed in chunks with a batched matrix product.
+    '''
+    import numpy as np
+    [rotations, translations] = rigid_params_to_affines(
+        extract_rigid_movpar(movpar_csv))
+    [points, voxel_indices] = mask_physical_points(mask_file)
+
+    num_frames = rotations.shape[0]
+    pos_displacement = np.zeros([num_frames, points.shape[0]], dtype='float32')
+    FD_displacement = np.zeros([num_frames, points.shape[0]], dtype='float32')
+    previous_points = None
+    for start in range(0, num_frames, chunk_size):
+        end = min(start+chunk_size, num_frames)
+        # (frames,3,3) x (3,voxels) -> (frames,voxels,3)
+        moved_points = np.matmul(rotations[start:end], points.T).transpose(
+            0, 2, 1)+translations[start:end, np.newaxis, :]
+        pos_displacement[start:end] = np.linalg.norm(
+            moved_points-points, axis=2)
+        FD_displacement[start+1:end] = np.linalg.norm(
+            moved_points[1:]-moved_points[:-1], axis=2)
+        if previous_points is not None:
+            FD_displacement[start] = np.linalg.norm(
+                moved_points[0]-previous_points, axis=1)
+        previous_points = moved_points[-1]
+    return pos_displacement, FD_displacement
+
+
+def write_displacement_csv(displacement, out_file):
+    '''
+    Writes the mean and max across voxels of the displacement at each frame, in the format of the
+    antsMotionCorrStats .csv.
+    '''
+    import numpy as np
+    stats = np.stack([displacement.mean(axis=1), displacement.max(axis=1)], axis=1)
+    np.savetxt(out_file, stats, delimiter=',',
+               header='Mean,Max', comments='', fmt='%g')
+    return out_file
+
+
+def write_voxelwise_displacement(displacement, mask_file, TR, out_file):
+    '''
+    Writes a 4D map of the displacement of the voxels within the mask, one frame at a time.
+    '''
+    import numpy as np
+    import SimpleITK as sitk
+    from .utils import init_4D_memmap, close_4D_memmap
+    [points, voxel_indices] = mask_physical_points(mask_file)
+    mask_img = sitk.ReadImage(mask_file, sitk.sitkInt16)
+    voxelwise = init_4D_memmap(
+        out_file, mask_img, displacement.shape[0], TR, sitk.sitkFloat32)
+    # the (x,y,z,t) nifti layout is viewed with the (t,z,y,x) array layout
+    voxelwise_view = voxelwise.T
+    for i in range(displacement.shape[0]):
+        voxelwise_view[(i,)+voxel_indices] = displacement[i]
+    close_4D_memmap(voxelwise, out_file)
+    return out_file
+
+
 def write_confound_csv(confound_array, column_names, filename_template):
     import pandas as pd
     df = pd.DataFrame(confound_array)
@@ -204,47 +292,41 @@ def write_confound_csv(confound_array, column_names, filename_template):
     return csv_path
 
 
-def compute_aCompCor(bold, WM_mask, CSF_mask, method='50%', rabies_data_type=8):
+def compute_aCompCor(mask_timeseries, method='50%'):
     '''
     Compute the anatomical comp corr through PCA over a defined ROI (mask) within
     the EPI, and retain either the first 5 components' time series or up to 50% of
     the variance explained as in Muschelli et al. 2014.
+    mask_timeseries is the n_timepoints x n_voxels matrix of the ROI voxels, as
+    extracted by extract_mask_signals.
     '''
-    import SimpleITK as sitk
-    from sklearn.decomposition import PCA
-
-    WM_data = sitk.GetArrayFromImage(sitk.ReadImage(
-        WM_mask, rabies_data_type))
-    CSF_data = sitk.GetArrayFromImage(sitk.ReadImage(
-        CSF_mask, rabies_data_type))
-    combined = (WM_data+CSF_data) > 0
-    from .utils import copyInfo_3DImage
-    noise_mask = copyInfo_3DImage(sitk.GetImageFromArray(combined.astype(
-        int), isVector=False), sitk.ReadImage(WM_mask, sitk.sitkInt16))
-    sitk.WriteImage(noise_mask, 'noise_mask.nii.gz')
-
-    from nilearn.input_data import NiftiMasker
+    import numpy as np
+    from nilearn.signal import clean
+
     # detrend and standardize the voxel time series before PCA
-    masker = NiftiMasker(mask_img='noise_mask.nii.gz',
-                         standardize=True, detrend=True)
-    mask_timeseries = masker.fit_transform(
-        bold)  # shape n_timepoints x n_voxels
+    mask_timeseries = clean(mask_timeseries, detrend=True, standardize=True)
+    mask_timeseries -= mask_timeseries.mean(axis=0)
+
+    # a single decomposition of the n_timepoints x n_timepoints Gram matrix provides both the variance
+    # explained by every component and their timecourses, since the left singular vectors of the
+    # timeseries are the eigenvectors of the Gram matrix
+    [eigenvalues, eigenvectors] = np.linalg.eigh(
+        mask_timeseries.dot(mask_timeseries.T))
+    eigenvalues = np.clip(eigenvalues[::-1], 0, None)
+    eigenvectors = eigenvectors[:, ::-1]
 
     if method == '50%':
-        pca = PCA()
-        pca.fit(mask_timeseries)
-        explained_variance = pca.explained_variance_ratio_
-        cum_var = 0
-        num_comp = 0
+        explained_variance = eigenvalues/eigenvalues.sum()
         # evaluate the # of components to explain 50% of the variance
-        while(cum_var <= 0.5):
-            cum_var += explained_variance[num_comp]
-            num_comp += 1
+        num_comp = int(np.searchsorted(
+            np.cumsum(explained_variance), 0.5, side='right'))+1
     elif method == 'first_5':
         num_comp = 5
 
-    pca = PCA(n_components=num_comp)
-    comp_timeseries = pca.fit_transform(mask_timeseries)
+    # component timecourses scaled by their singular value, with the sign convention of sklearn's PCA
+    comp_timeseries = eigenvectors[:, :num_comp]*np.sqrt(eigenvalues[:num_comp])
+    max_abs_rows = np.argmax(np.abs(comp_timeseries), axis=0)
+    comp_timeseries *= np.sign(comp_timeseries[max_abs_rows, range(num_comp)])
     print("Extracting "+str(num_comp)+" components for aCompCorr.")
     return comp_timeseries, num_comp
 
@@ -284,6 +366,39 @@ def extract_rigid_movpar(movpar_csv):
     return movpar
 
 
+def extract_mask_signals(bold, masks, noise_masks=[], chunk_size=100):
+    '''
+    Reads the bold series once, in chunks of frames, to extract the mean trace of each mask in masks,
+    together with the n_timepoints x n_voxels matrix of the voxels within the union of noise_masks.
+    The masks are indexed jointly, so that only voxels within at least one mask are kept from each chunk.
+    '''
+    import numpy as np
+    from rabies.preprocess_pkg.masking import get_mask_indices, iter_masked_chunks, load_4D_image
+
+    # the chunks of frames of a .nii.gz are read in a single pass over the compressed stream
+    bold_img = load_4D_image(bold)
+    num_frames = bold_img.shape[3]
+    mask_arrays = [get_mask_indices(mask)[0] for mask in masks]
+    noise_array = np.zeros(bold_img.shape[:3], dtype=bool)
+    for mask in noise_masks:
+        noise_array |= get_mask_indices(mask)[0]
+
+    # the chunks list the voxels within any of the masks, and each mask selects its voxels among those
+    union = noise_array.copy()
+    for mask_array in mask_arrays:
+        union |= mask_array
+    union_masks = [mask_array[union] for mask_array in mask_arrays]
+    union_noise = noise_array[union]
+
+    mask_traces = np.zeros([len(masks), num_frames])
+    noise_timeseries = np.zeros([num_frames, union_noise.sum()], dtype='float32')
+    for start, end, chunk in iter_masked_chunks(bold_img, union, chunk_size=chunk_size):
+        for i, union_mask in enumerate(union_masks):
+            mask_traces[i, start:end] = chunk[union_mask].mean(axis=0)
+        noise_timeseries[start:end] = chunk[union_noise].T
+    return mask_traces, noise_timeseries
+
+
 def extract_mask_trace(bold, mask):
     import numpy as np
     import nilearn.masking
@@ -336,11 +451,59 @@ class MaskEPI(BaseInterface):
         from rabies.preprocess_pkg.utils import run_command
         rc = run_command(command)
 
-        sitk.WriteImage(sitk.ReadImage(
-            new_mask_path, sitk.sitkInt16), new_mask_path)
+        from rabies.preprocess_pkg.image_io import cast_image_file
+        cast_image_file(new_mask_path, sitk.sitkInt16)
 
         setattr(self, 'EPI_mask', new_mask_path)
         return runtime
 
     def _list_outputs(self):
         return {'EPI_mask': getattr(self, 'EPI_mask')}
+
+
+class MultiMaskEPIInputSpec(BaseInterfaceInputSpec):
+    masks = traits.List(File(exists=True), mandatory=True,
+                        desc="Masks and labels to transfer to EPI space.")
+    name_specs = traits.List(traits.Str, mandatory=True,
+                             desc="Name of each mask, in the same order as masks.")
+    ref_EPI = File(exists=True, mandatory=True,
+                   desc="Motion-realigned and SDC-corrected reference 3D EPI.")
+    name_source = File(exists=True, mandatory=True,
+                       desc='Reference BOLD file for naming the output.')
+
+
+class MultiMaskEPIOutputSpec(TraitedSpec):
+    EPI_masks = traits.List(File(exists=True), desc="The generated EPI masks, in the order of the inputs.")
+
+
+class MultiMaskEPI(BaseInterface):
+    """
+    Same as MaskEPI for a list of masks, which are all resampled onto the reference EPI in-process
+    with a single resampling setup.
+    """
+
+    input_spec = MultiMaskEPIInputSpec
+    output_spec = MultiMaskEPIOutputSpec
+
+    def _run_interface(self, runtime):
+        import os
+        import SimpleITK as sitk
+        from rabies.preprocess_pkg.utils import resample_label_images
+
+        import pathlib  # Better path manipulation
+        filename_split = pathlib.Path(
+            self.inputs.name_source).name.rsplit(".nii")
+
+        if not len(self.inputs.masks) == len(self.inputs.name_specs):
+            raise ValueError("A name_spec must be provided for each mask.")
+
+        EPI_masks = [os.path.abspath('%s_%s.nii.gz' % (filename_split[0], name_spec,))
+                     for name_spec in self.inputs.name_specs]
+        resample_label_images(self.inputs.masks, sitk.ReadImage(
+            self.inputs.ref_EPI), EPI_masks)
+
+        setattr(self, 'EPI_masks', EPI_masks)
+        return runtime
+
+    def _list_outputs(self):
+        return {'EPI_masks': getattr(self, 'EPI_masks')}
@@ -7,7 +7,7 @@ from nipype.interfaces.base import (
 from .utils import SliceMotionCorrection
 
 
-def init_bold_hmc_wf(slice_mc=False, rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, local_threads=1, name='bold_hmc_wf'):
+def init_bold_hmc_wf(slice_mc=False, slice_mc_engine='sitk', motion_engine='ants', intermediate_format='nii.gz', rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, local_threads=1, name='bold_hmc_wf'):
     """
     This workflow estimates the motion parameters to perform HMC over the BOLD image.
 
@@ -15,6 +15,8 @@ def init_bold_hmc_wf(slice_mc=False, rabies_data_type=8, rabies_mem_scale=1.0, m
 
         name : str
             Name of workflow (default: ``bold_hmc_wf``)
+        intermediate_format : str
+            'nii.gz' or 'nii', the format of the motion corrected series
 
     **Inputs**
 
@@ -22,6 +24,9 @@ def init_bold_hmc_wf(slice_mc=False, rabies_data_type=8, rabies_mem_scale=1.0, m
             BOLD series NIfTI file
         ref_image
             Reference image to which BOLD series is motion corrected
+        motion_estimates
+            Rigid parameters estimated during the generation of the reference image, which
+            are used to warm-start the estimation with motion_engine='native'
 
     **Outputs**
 
@@ -31,7 +36,7 @@ def init_bold_hmc_wf(slice_mc=False, rabies_data_type=8, rabies_mem_scale=1.0, m
     import os
 
     workflow = pe.Workflow(name=name)
-    inputnode = pe.Node(niu.IdentityInterface(fields=['bold_file', 'ref_image']),
+    inputnode = pe.Node(niu.IdentityInterface(fields=['bold_file', 'ref_image', 'motion_estimates']),
                         name='inputnode')
     outputnode = pe.Node(
         niu.IdentityInterface(
@@ -39,20 +44,24 @@ def init_bold_hmc_wf(slice_mc=False, rabies_data_type=8, rabies_mem_scale=1.0, m
         name='outputnode')
 
     # Head motion correction (hmc)
-    motion_estimation = pe.Node(EstimateMotion(rabies_data_type=rabies_data_type), name='ants_MC', mem_gb=1.1*rabies_mem_scale)
+    # with the ants engine, chunks of frames are realigned by parallel antsMotionCorr processes
+    hmc_n_procs = int(local_threads/4)+1
+    motion_estimation = pe.Node(EstimateMotion(motion_engine=motion_engine, n_chunks=hmc_n_procs, n_procs=hmc_n_procs, intermediate_format=intermediate_format, rabies_data_type=rabies_data_type),
+                                name='ants_MC', mem_gb=1.1*rabies_mem_scale, n_procs=hmc_n_procs)
     motion_estimation.plugin_args = {
         'qsub_args': '-pe smp %s' % (str(3*min_proc)), 'overwrite': True}
 
     workflow.connect([
         (inputnode, motion_estimation, [('ref_image', 'ref_file'),
-                                        ('bold_file', 'in_file')]),
+                                        ('bold_file', 'in_file'),
+                                        ('motion_estimates', 'motion_estimates')]),
         (motion_estimation, outputnode, [
          ('motcorr_params', 'motcorr_params')]),
     ])
 
     if slice_mc:
         slice_mc_n_procs = int(local_threads/4)+1
-        slice_mc_node = pe.Node(SliceMotionCorrection(n_procs=slice_mc_n_procs),
+        slice_mc_node = pe.Node(SliceMotionCorrection(n_procs=slice_mc_n_procs, engine=slice_mc_engine, intermediate_format=intermediate_format),
                                 name='slice_mc', mem_gb=1*slice_mc_n_procs, n_procs=slice_mc_n_procs)
         slice_mc_node.plugin_args = {
             'qsub_args': '-pe smp %s' % (str(3*min_proc)), 'overwrite': True}
@@ -74,6 +83,16 @@ class EstimateMotionInputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True, mandatory=True, desc="4D EPI file")
     ref_file = File(exists=True, mandatory=True,
                     desc="Reference image to which timeseries are realigned for motion estimation")
+    motion_engine = traits.Enum('ants', 'native', usedefault=True,
+                                desc="Whether motion is estimated with antsMotionCorr, or in-process with SimpleITK.")
+    motion_estimates = File(exists=True,
+                            desc="Earlier motion estimates from the generation of the reference image, used to warm-start "
+                            "the native engine.")
+    n_chunks = traits.Int(1, usedefault=True,
+                          desc="Number of chunks of frames realigned in parallel by the ants engine.")
+    n_procs = traits.Int(desc="Number of threads allocated to the node, which are shared among the antsMotionCorr processes.")
+    intermediate_format = traits.Enum('nii.gz', 'nii', usedefault=True,
+                                      desc="Format of the 4D images written in the working directory. Uncompressed .nii avoids the gzip compression of intermediates.")
     rabies_data_type = traits.Int(mandatory=True,
         desc="Integer specifying SimpleITK data type.")
 
@@ -86,7 +105,11 @@ class EstimateMotionOutputSpec(TraitedSpec):
 
 class EstimateMotion(BaseInterface):
     """
-    Runs ants motion correction interface and returns the motion estimation
+    Runs ants motion correction interface and returns the motion estimation.
+    With the native engine, the rigid registrations are instead conducted in-process,
+    and the estimates obtained for a subset of volumes during the generation of the
+    reference image serve as initialization for the registration of these volumes, while
+    the other volumes are initialized from the previous volume's estimate.
     """
 
     input_spec = EstimateMotionInputSpec
@@ -94,17 +117,173 @@ class EstimateMotion(BaseInterface):
 
     def _run_interface(self, runtime):
         import os
-        from .utils import antsMotionCorr
-        res = antsMotionCorr(in_file=self.inputs.in_file,
-                             ref_file=self.inputs.ref_file, second=False, rabies_data_type=self.inputs.rabies_data_type).run()
-        csv_params = os.path.abspath(res.outputs.csv_params)
+        if self.inputs.motion_engine == 'native':
+            [csv_params, mc_corrected_bold] = self.native_motion_estimation()
+        else:
+            from .utils import antsMotionCorr
+            res = antsMotionCorr(in_file=self.inputs.in_file,
+                                 ref_file=self.inputs.ref_file, second=False, n_chunks=self.inputs.n_chunks, n_procs=self.inputs.n_procs, intermediate_format=self.inputs.intermediate_format, rabies_data_type=self.inputs.rabies_data_type).run()
+            csv_params = os.path.abspath(res.outputs.csv_params)
+            mc_corrected_bold = os.path.abspath(res.outputs.mc_corrected_bold)
 
         setattr(self, 'csv_params', csv_params)
-        setattr(self, 'mc_corrected_bold', os.path.abspath(
-            res.outputs.mc_corrected_bold))
+        setattr(self, 'mc_corrected_bold', mc_corrected_bold)
 
         return runtime
 
+    def native_motion_estimation(self):
+        import os
+        import numpy as np
+        import SimpleITK as sitk
+        from nipype.interfaces.base import isdefined
+        from .utils import copyInfo_3DImage, init_4D_memmap, close_4D_memmap
+
+        ref_image = sitk.ReadImage(self.inputs.ref_file, sitk.sitkFloat32)
+        timeseries_image = sitk.ReadImage(self.inputs.in_file, sitk.sitkFloat32)
+        timeseries_array = sitk.GetArrayViewFromImage(timeseries_image)
+        num_volumes = timeseries_array.shape[0]
+
+        initial_params = None
+        if isdefined(self.inputs.motion_estimates):
+            estimates = np.load(self.inputs.motion_estimates)
+            frames = estimates['frames']
+            if len(frames) > 0 and frames.max() < num_volumes:
+                # the estimates were obtained against an earlier reference, so they only serve as initialization
+                print("Warm-starting the motion estimation from earlier estimates.")
+                initial_params = np.full([num_volumes, 6], np.nan)
+                initial_params[frames] = estimates['params']
+
+        mc_corrected_bold = os.path.abspath(
+            'motcorr.%s' % (self.inputs.intermediate_format,))
+        ref_3d = copyInfo_3DImage(sitk.GetImageFromArray(
+            timeseries_array[0, :, :, :], isVector=False), timeseries_image)
+        corrected = init_4D_memmap(
+            mc_corrected_bold, ref_3d, num_volumes, timeseries_image.GetSpacing()[3], sitk.sitkFloat32)
+        # the (x,y,z,t) nifti layout is viewed with the (t,z,y,x) array layout
+        corrected_view = corrected.T
+
+        [params, metrics, corrected_view] = motion_correct_array(timeseries_array, ref_image, initial_params=initial_params,
+                                                                 out=corrected_view)
+        close_4D_memmap(corrected, mc_corrected_bold)
+
+        csv_params = write_motcorr_params(
+            params, metrics, os.path.abspath('motcorrMOCOparams.csv'))
+        return csv_params, mc_corrected_bold
+
     def _list_outputs(self):
         return {'mc_corrected_bold': getattr(self, 'mc_corrected_bold'),
                 'motcorr_params': getattr(self, 'csv_params')}
+
+
+def register_rigid(fixed_image, moving_image, initial_params=None, shrinking_factor=4, num_iterations=100, seed=1):
+    '''
+    In-process rigid registration of a volume to a reference, with the parameters of the antsMotionCorr
+    call from antsMotionCorr in utils.py: Mattes mutual information with 20 bins over a regular
+    sampling of 20% of the voxels, a gradient step of 0.1 with scales estimated from physical shifts, and
+    a 3-level pyramid with shrink factors of shrinking_factor x2x1 and smoothing sigmas of 2x1x0 voxels.
+    Transforms are handled as Euler3D parameters centered on the origin, which is the convention of the
+    antsMotionCorr .csv parameters; initial_params allows to warm-start from a previous estimate.
+    Returns the parameters, and the metric values before and after registration.
+    '''
+    import numpy as np
+    import SimpleITK as sitk
+
+    # the optimization is conducted with a transform centered on the reference, for better conditioning
+    center = np.asarray(fixed_image.TransformContinuousIndexToPhysicalPoint(
+        [(s-1)/2 for s in fixed_image.GetSize()]))
+    transform = sitk.Euler3DTransform()
+    transform.SetCenter([float(c) for c in center])
+    if initial_params is not None:
+        transform.SetRotation(*[float(a) for a in initial_params[:3]])
+        rotation = np.asarray(transform.GetMatrix()).reshape(3, 3)
+        transform.SetTranslation(
+            [float(t) for t in np.asarray(initial_params[3:])-center+rotation.dot(center)])
+
+    registration_method = sitk.ImageRegistrationMethod()
+    registration_method.SetMetricAsMattesMutualInformation(
+        numberOfHistogramBins=20)
+    registration_method.SetMetricSamplingStrategy(registration_method.REGULAR)
+    registration_method.SetMetricSamplingPercentage(0.2, seed)
+    registration_method.SetInterpolator(sitk.sitkLinear)
+    registration_method.SetOptimizerAsGradientDescent(learningRate=0.1, numberOfIterations=num_iterations,
+                                                      convergenceMinimumValue=1e-6, convergenceWindowSize=10,
+                                                      estimateLearningRate=registration_method.Once,
+                                                      maximumStepSizeInPhysicalUnits=0.1)
+    registration_method.SetOptimizerScalesFromPhysicalShift()
+    registration_method.SetShrinkFactorsPerLevel(
+        shrinkFactors=[shrinking_factor, 2, 1])
+    registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[2, 1, 0])
+    registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOff()
+    registration_method.SetInitialTransform(transform, inPlace=True)
+
+    fixed_image = sitk.Cast(fixed_image, sitk.sitkFloat32)
+    moving_image = sitk.Cast(moving_image, sitk.sitkFloat32)
+    metric_pre = registration_method.MetricEvaluate(fixed_image, moving_image)
+    registration_method.Execute(fixed_image, moving_image)
+    metric_post = registration_method.MetricEvaluate(
+        fixed_image, moving_image)
+
+    # convert back to a transform centered on the origin
+    rotation = np.asarray(transform.GetMatrix()).reshape(3, 3)
+    translation = np.asarray(transform.GetTranslation()) + \
+        center-rotation.dot(center)
+    params = np.asarray([transform.GetAngleX(), transform.GetAngleY(),
+                         transform.GetAngleZ()]+list(translation))
+    return params, metric_pre, metric_post
+
+
+def motion_correct_array(timeseries_array, ref_image, initial_params=None, shrinking_factor=None, out=None):
+    '''
+    Realigns each volume of a timeseries array, with the (t,z,y,x) SimpleITK layout and the geometry
+    of ref_image, to the reference with register_rigid. initial_params (n_volumes x 6) warm-start the
+    registration of each volume, and volumes without initial parameters (missing or NaN) are warm-started from
+    the previous volume's estimate. Returns the rigid parameters (n_volumes x 6), the metric values before
+    and after registration (n_volumes x 2), and the realigned array, which is written to out if provided.
+    '''
+    import numpy as np
+    import SimpleITK as sitk
+
+    if shrinking_factor is None:
+        # make sure that the first shrinking factor allow for at least 4 slices, as for antsMotionCorr
+        shrinking_factor = min(4, int(np.asarray(ref_image.GetSize()).min()/4))
+    shrinking_factor = max(shrinking_factor, 1)
+
+    num_volumes = timeseries_array.shape[0]
+    params = np.zeros([num_volumes, 6])
+    metrics = np.zeros([num_volumes, 2])
+    if out is None:
+        out = np.zeros(timeseries_array.shape, dtype=np.float32)
+    for i in range(num_volumes):
+        moving_image = sitk.GetImageFromArray(
+            timeseries_array[i, :, :, :].astype(np.float32), isVector=False)
+        moving_image.CopyInformation(ref_image)
+        if initial_params is not None and not np.isnan(initial_params[i]).any():
+            init = initial_params[i]
+        elif i > 0:
+            init = params[i-1]
+        else:
+            init = None
+
+        params[i, :], metrics[i, 0], metrics[i, 1] = register_rigid(
+            ref_image, moving_image, initial_params=init, shrinking_factor=shrinking_factor)
+
+        transform = sitk.Euler3DTransform()
+        transform.SetParameters([float(p) for p in params[i, :]])
+        out[i, :, :, :] = sitk.GetArrayFromImage(sitk.Resample(
+            moving_image, ref_image, transform, sitk.sitkLinear, 0.0, sitk.sitkFloat32))
+    return params, metrics, out
+
+
+def write_motcorr_params(params, metrics, out_file):
+    '''
+    Writes rigid parameters in the antsMotionCorr MOCOparams.csv format, which is expected by
+    extract_rigid_movpar and antsMotionCorrStats.
+    '''
+    import csv
+    with open(out_file, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter=',')
+        writer.writerow(['MetricPre', 'MetricPost']+['MOCOparam%s' %
+                                                     (i,) for i in range(params.shape[1])])
+        for metric, param in zip(metrics, params):
+            writer.writerow(['%g' % m for m in metric]+['%g' % p for p in param])
+    return out_file
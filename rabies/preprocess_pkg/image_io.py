@@ -0,0 +1,57 @@
+'''
+Image reading and writing helpers shared by the interfaces. Writes carry the target data type, so that
+an image is cast in memory before being written once, and files which already have the target data
+type are left untouched instead of going through a decode/re-encode round trip.
+'''
+
+
+def read_image(filename, rabies_data_type=None):
+    '''
+    Reads an image, cast to rabies_data_type if provided, otherwise with its stored pixel type.
+    '''
+    import SimpleITK as sitk
+    if rabies_data_type is None:
+        return sitk.ReadImage(filename)
+    return sitk.ReadImage(filename, rabies_data_type)
+
+
+def read_image_information(filename):
+    '''
+    Reads only the header of an image. The returned reader provides the geometry (GetSize, GetSpacing,
+    GetOrigin, GetDirection, GetDimension) and GetPixelID without decoding the voxel data.
+    '''
+    import SimpleITK as sitk
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(filename)
+    reader.ReadImageInformation()
+    return reader
+
+
+def write_image(image, filename, rabies_data_type=None):
+    '''
+    Writes an image, cast in memory to rabies_data_type if provided and if it differs from the
+    current pixel type of the image.
+    '''
+    import SimpleITK as sitk
+    if rabies_data_type is not None and not image.GetPixelID() == rabies_data_type:
+        image = sitk.Cast(image, rabies_data_type)
+    sitk.WriteImage(image, filename)
+    return filename
+
+
+def cast_image_file(filename, rabies_data_type, out_file=None):
+    '''
+    Converts an image file to rabies_data_type, overwriting it unless out_file is provided. Only the
+    header is read if the file is already stored with that data type, in which case the file is
+    left as is (or copied to out_file).
+    '''
+    import shutil
+    from rabies.preprocess_pkg.image_io import read_image_information, read_image, write_image
+    if out_file is None:
+        out_file = filename
+    same_format = filename.endswith('.gz') == out_file.endswith('.gz')
+    if same_format and read_image_information(filename).GetPixelID() == rabies_data_type:
+        if not out_file == filename:
+            shutil.copyfile(filename, out_file)
+        return out_file
+    return write_image(read_image(filename, rabies_data_type), out_file)
@@ -0,0 +1,156 @@
+'''
+Masked data helpers shared across the pipeline. The voxels of a mask are taken in the order of
+mask_array[mask_array.astype(bool)], and are read from a 4D image as one reshape+index on chunks of
+frames instead of indexing each frame separately. Uncompressed images are read from a memory map,
+and compressed images through a persistent file handle (see load_4D_image), so that the file is
+only decoded once.
+'''
+
+_mask_index_cache = {}
+
+
+def get_mask_indices(mask):
+    '''
+    Returns the boolean mask array, together with the flat indices of its voxels within a
+    Fortran-ordered (on-disk NIfTI layout) volume. mask can be a filename, a nibabel image or an
+    array; indices derived from files are cached, keyed on the path and modification time.
+    '''
+    import os
+    import numpy as np
+    import nibabel as nb
+
+    key = None
+    if isinstance(mask, str):
+        key = (os.path.abspath(mask), os.path.getmtime(mask))
+        if key in _mask_index_cache:
+            return _mask_index_cache[key]
+        mask = nb.load(mask)
+    if hasattr(mask, 'dataobj'):
+        mask = np.asarray(mask.dataobj)
+
+    mask_array = np.asarray(mask).astype(bool)
+    if mask_array.ndim > 3:
+        mask_array = mask_array.reshape(mask_array.shape[:3])
+    indices = np.ravel_multi_index(np.nonzero(mask_array), mask_array.shape, order='F')
+    if key is not None:
+        _mask_index_cache[key] = (mask_array, indices)
+    return mask_array, indices
+
+
+def load_4D_image(image):
+    '''
+    Returns a nibabel image from which consecutive chunks of frames are read in a single pass over the
+    file. Uncompressed images are memory-mapped; for compressed images, each slice of a default proxy
+    reopens the file and inflates it from its start, so they are opened with a persistent file handle,
+    and consecutive chunks are then sequential reads from one compressed stream. image can be a filename,
+    or a nibabel image which is reopened from its file if it is compressed.
+    '''
+    import nibabel as nb
+
+    if isinstance(image, str):
+        return nb.load(image, keep_file_open=True)
+    filename = image.get_filename()
+    if filename is not None and filename.endswith('.gz') and nb.is_proxy(image.dataobj):
+        return nb.load(filename, keep_file_open=True)
+    return image
+
+
+def iter_masked_chunks(image, mask, chunk_size=100):
+    '''
+    Iterates over the frames of a 4D image in chunks of chunk_size, yielding (start, end, chunk) with
+    chunk the voxel X frame array of the voxels within the mask. Only one chunk of frames is loaded at a
+    time, and the file is read in a single pass (see load_4D_image).
+    '''
+    import numpy as np
+    from rabies.preprocess_pkg.masking import load_4D_image
+
+    image = load_4D_image(image)
+    mask_array, indices = get_mask_indices(mask)
+    if not tuple(image.shape[:3]) == mask_array.shape:
+        raise ValueError("The mask doesn't match the dimensions of the image.")
+
+    num_frames = image.shape[3]
+    if chunk_size is None:
+        chunk_size = num_frames
+    for start in range(0, num_frames, chunk_size):
+        end = min(start+chunk_size, num_frames)
+        frames = np.asarray(image.dataobj[..., start:end])
+        yield start, end, frames.reshape(-1, end-start, order='F')[indices]
+        del frames
+
+
+def extract_masked(image, mask, chunk_size=100, dtype='float64'):
+    '''
+    Returns the frame X voxel matrix of the voxels within the mask from a 4D image, which can be
+    provided as a filename or nibabel image.
+    '''
+    import numpy as np
+    from rabies.preprocess_pkg.masking import load_4D_image
+
+    image = load_4D_image(image)
+    mask_array, indices = get_mask_indices(mask)
+    timeseries = np.zeros([image.shape[3], len(indices)], dtype=dtype)
+    for start, end, chunk in iter_masked_chunks(image, mask, chunk_size=chunk_size):
+        timeseries[start:end, :] = chunk.T
+    return timeseries
+
+
+def scatter_masked(vectors, mask, dtype='float64'):
+    '''
+    Inverse of extract_masked: places the voxel values of vectors (of shape num_volume X num_voxel,
+    or a single num_voxel vector) back into volumes of the mask shape, with zeros outside the mask.
+    Returns a 4D array, or a 3D array for a single vector.
+    '''
+    import numpy as np
+
+    mask_array, indices = get_mask_indices(mask)
+    vectors = np.asarray(vectors)
+    single = vectors.ndim == 1
+    vectors = vectors.reshape(-1, len(indices))
+
+    volumes = np.zeros(mask_array.shape+(vectors.shape[0],), dtype=dtype, order='F')
+    # the Fortran-ordered reshape is a view on the volumes, which receives the voxel values
+    volumes.reshape(-1, vectors.shape[0], order='F')[indices] = vectors.T
+    if single:
+        return volumes[:, :, :, 0]
+    return volumes
+
+
+def label_reduction_matrix(labels):
+    '''
+    Builds the sparse num_label X num_voxel matrix which averages the voxels within each label of a
+    label image (filename, nibabel image or array), with voxels taken in the order of the mask of all
+    labeled voxels (label > 0). Returns the matrix, the label ids and the mask.
+    '''
+    import numpy as np
+    import nibabel as nb
+    from scipy import sparse
+
+    if isinstance(labels, str):
+        labels = nb.load(labels)
+    if hasattr(labels, 'dataobj'):
+        labels = np.asarray(labels.dataobj)
+    labels = np.asarray(labels)
+    mask_array = labels > 0
+    label_ids, inverse, counts = np.unique(
+        labels[mask_array], return_inverse=True, return_counts=True)
+    reduction = sparse.csr_matrix((1./counts[inverse], (inverse, np.arange(len(inverse)))),
+                                  shape=(len(label_ids), len(inverse)))
+    return reduction, label_ids, mask_array
+
+
+def extract_label_timeseries(image, labels, chunk_size=100):
+    '''
+    Returns the frame X label matrix of the mean timeseries within each label of a label image, together
+    with the label ids. The image is read once, and all label means of a chunk of frames are computed
+    with a single sparse matrix product.
+    '''
+    import numpy as np
+    from rabies.preprocess_pkg.masking import label_reduction_matrix, iter_masked_chunks, load_4D_image
+
+    image = load_4D_image(image)
+    reduction, label_ids, mask_array = label_reduction_matrix(labels)
+    label_timeseries = np.zeros([image.shape[3], len(label_ids)])
+    for start, end, chunk in iter_masked_chunks(image, mask_array, chunk_size=chunk_size):
+        label_timeseries[start:end, :] = reduction.dot(chunk).T
+    return label_timeseries, label_ids
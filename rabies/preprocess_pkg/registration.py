@@ -108,7 +108,7 @@ def run_antsRegistration(reg_script, moving_image='NULL', fixed_image='NULL', an
         warp = 'NULL'
         inverse_warp = 'NULL'
 
-    import SimpleITK as sitk
-    sitk.WriteImage(sitk.ReadImage(warped_image, rabies_data_type), warped_image)
+    from rabies.preprocess_pkg.image_io import cast_image_file
+    cast_image_file(warped_image, rabies_data_type)
 
     return [affine, warp, inverse_warp, warped_image]
@@ -1,10 +1,10 @@
 from nipype.pipeline import engine as pe
 from nipype.interfaces import utility as niu
 
-from .utils import slice_applyTransforms, init_bold_reference_wf, Merge
+from .utils import slice_applyTransforms, ComposeTransforms, init_bold_reference_wf
 
 
-def init_bold_preproc_trans_wf(resampling_dim, slice_mc=False, rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, name='bold_native_trans_wf'):
+def init_bold_preproc_trans_wf(resampling_dim, slice_mc=False, rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, local_threads=1, transforms_cache=None, motion_engine='ants', intermediate_format='nii.gz', name='bold_native_trans_wf'):
     """
     This workflow resamples the input fMRI in its native (original)
     space in a "single shot" from the original BOLD series.
@@ -19,31 +19,44 @@ def init_bold_preproc_trans_wf(resampling_dim, slice_mc=False, rabies_data_type=
         niu.IdentityInterface(fields=['bold', 'bold_ref']),
         name='outputnode')
 
+    # the static transforms are composed once into a single displacement field, shared through the cache
+    compose_transforms = pe.Node(ComposeTransforms(
+        rabies_data_type=rabies_data_type), name='compose_transforms', mem_gb=1*rabies_mem_scale)
+    compose_transforms.inputs.resampling_dim = resampling_dim
+    if transforms_cache is not None:
+        compose_transforms.inputs.cache_dir = transforms_cache
+
+    resampling_n_procs = int(local_threads/4)+1
     bold_transform = pe.Node(slice_applyTransforms(
-        rabies_data_type=rabies_data_type), name='bold_transform', mem_gb=1*rabies_mem_scale)
+        rabies_data_type=rabies_data_type, n_procs=resampling_n_procs, intermediate_format=intermediate_format), name='bold_transform', mem_gb=2*rabies_mem_scale, n_procs=resampling_n_procs)
     bold_transform.inputs.apply_motcorr = (not slice_mc)
     bold_transform.inputs.resampling_dim = resampling_dim
-
-    merge = pe.Node(Merge(rabies_data_type=rabies_data_type), name='merge', mem_gb=4*rabies_mem_scale)
-    merge.plugin_args = {
+    bold_transform.plugin_args = {
         'qsub_args': '-pe smp %s' % (str(3*min_proc)), 'overwrite': True}
 
     # Generate a new BOLD reference
     bold_reference_wf = init_bold_reference_wf(
-        rabies_data_type=rabies_data_type, rabies_mem_scale=rabies_mem_scale, min_proc=min_proc)
+        motion_engine=motion_engine, intermediate_format=intermediate_format, rabies_data_type=rabies_data_type, rabies_mem_scale=rabies_mem_scale, min_proc=min_proc)
 
     workflow.connect([
-        (inputnode, merge, [('name_source', 'header_source')]),
+        (inputnode, compose_transforms, [
+            ('bold_file', 'in_file'),
+            ('transforms_list', 'transforms'),
+            ('inverses', 'inverses'),
+            ('ref_file', 'ref_file'),
+            ]),
+        (compose_transforms, bold_transform, [
+            ('composite_warp', 'composite_warp')]),
         (inputnode, bold_transform, [
+            ('name_source', 'name_source'),
             ('bold_file', 'in_file'),
             ('motcorr_params', 'motcorr_params'),
             ('transforms_list', 'transforms'),
             ('inverses', 'inverses'),
             ('ref_file', 'ref_file'),
             ]),
-        (bold_transform, merge, [('out_files', 'in_files')]),
-        (merge, bold_reference_wf, [('out_file', 'inputnode.bold_file')]),
-        (merge, outputnode, [('out_file', 'bold')]),
+        (bold_transform, bold_reference_wf, [('out_file', 'inputnode.bold_file')]),
+        (bold_transform, outputnode, [('out_file', 'bold')]),
         (bold_reference_wf, outputnode, [
             ('outputnode.ref_image', 'bold_ref')]),
     ])
@@ -51,9 +64,9 @@ def init_bold_preproc_trans_wf(resampling_dim, slice_mc=False, rabies_data_type=
     return workflow
 
 
-def init_bold_commonspace_trans_wf(resampling_dim, brain_mask, WM_mask, CSF_mask, vascular_mask, atlas_labels, slice_mc=False, rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, name='bold_commonspace_trans_wf'):
+def init_bold_commonspace_trans_wf(resampling_dim, brain_mask, WM_mask, CSF_mask, vascular_mask, atlas_labels, slice_mc=False, rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, local_threads=1, transforms_cache=None, motion_engine='ants', intermediate_format='nii.gz', name='bold_commonspace_trans_wf'):
     import os
-    from .confounds import MaskEPI
+    from .confounds import MultiMaskEPI
 
     workflow = pe.Workflow(name=name)
     inputnode = pe.Node(niu.IdentityInterface(fields=[
@@ -66,76 +79,64 @@ def init_bold_commonspace_trans_wf(resampling_dim, brain_mask, WM_mask, CSF_mask
             fields=['bold', 'bold_ref', 'brain_mask', 'WM_mask', 'CSF_mask', 'vascular_mask', 'labels']),
         name='outputnode')
 
+    # the static transforms are composed once into a single displacement field, shared through the cache
+    compose_transforms = pe.Node(ComposeTransforms(
+        rabies_data_type=rabies_data_type), name='compose_transforms', mem_gb=1*rabies_mem_scale)
+    compose_transforms.inputs.resampling_dim = resampling_dim
+    if transforms_cache is not None:
+        compose_transforms.inputs.cache_dir = transforms_cache
+
+    resampling_n_procs = int(local_threads/4)+1
     bold_transform = pe.Node(slice_applyTransforms(
-        rabies_data_type=rabies_data_type), name='bold_transform', mem_gb=1*rabies_mem_scale)
+        rabies_data_type=rabies_data_type, n_procs=resampling_n_procs, intermediate_format=intermediate_format), name='bold_transform', mem_gb=2*rabies_mem_scale, n_procs=resampling_n_procs)
     bold_transform.inputs.apply_motcorr = (not slice_mc)
     bold_transform.inputs.resampling_dim = resampling_dim
-
-    merge = pe.Node(Merge(rabies_data_type=rabies_data_type), name='merge', mem_gb=4*rabies_mem_scale)
-    merge.plugin_args = {
+    bold_transform.plugin_args = {
         'qsub_args': '-pe smp %s' % (str(3*min_proc)), 'overwrite': True}
 
     # Generate a new BOLD reference
     bold_reference_wf = init_bold_reference_wf(
-        rabies_data_type=rabies_data_type, rabies_mem_scale=rabies_mem_scale, min_proc=min_proc)
-
-    WM_mask_to_EPI = pe.Node(MaskEPI(), name='WM_mask_EPI')
-    WM_mask_to_EPI.inputs.name_spec = 'commonspace_WM_mask'
-    WM_mask_to_EPI.inputs.mask = WM_mask
-
-    CSF_mask_to_EPI = pe.Node(MaskEPI(), name='CSF_mask_EPI')
-    CSF_mask_to_EPI.inputs.name_spec = 'commonspace_CSF_mask'
-    CSF_mask_to_EPI.inputs.mask = CSF_mask
+        motion_engine=motion_engine, intermediate_format=intermediate_format, rabies_data_type=rabies_data_type, rabies_mem_scale=rabies_mem_scale, min_proc=min_proc)
 
-    vascular_mask_to_EPI = pe.Node(MaskEPI(), name='vascular_mask_EPI')
-    vascular_mask_to_EPI.inputs.name_spec = 'commonspace_vascular_mask'
-    vascular_mask_to_EPI.inputs.mask = vascular_mask
-
-    brain_mask_to_EPI = pe.Node(MaskEPI(), name='Brain_mask_EPI')
-    brain_mask_to_EPI.inputs.name_spec = 'commonspace_brain_mask'
-    brain_mask_to_EPI.inputs.mask = brain_mask
-
-    propagate_labels = pe.Node(MaskEPI(), name='prop_labels_EPI')
-    propagate_labels.inputs.name_spec = 'commonspace_anat_labels'
-    propagate_labels.inputs.mask = atlas_labels
+    # the commonspace masks and labels are resampled together onto the new reference
+    masks_to_EPI = pe.Node(MultiMaskEPI(), name='masks_to_EPI')
+    masks_to_EPI.inputs.masks = [
+        WM_mask, CSF_mask, vascular_mask, brain_mask, atlas_labels]
+    masks_to_EPI.inputs.name_specs = ['commonspace_WM_mask', 'commonspace_CSF_mask',
+                                      'commonspace_vascular_mask', 'commonspace_brain_mask', 'commonspace_anat_labels']
+    split_masks = pe.Node(niu.Split(
+        splits=[1, 1, 1, 1, 1], squeeze=True), name='split_masks')
 
     workflow.connect([
-        (inputnode, merge, [('name_source', 'header_source')]),
+        (inputnode, compose_transforms, [
+            ('bold_file', 'in_file'),
+            ('transforms_list', 'transforms'),
+            ('inverses', 'inverses'),
+            ('ref_file', 'ref_file'),
+            ]),
+        (compose_transforms, bold_transform, [
+            ('composite_warp', 'composite_warp')]),
         (inputnode, bold_transform, [
+            ('name_source', 'name_source'),
             ('bold_file', 'in_file'),
             ('motcorr_params', 'motcorr_params'),
             ('transforms_list', 'transforms'),
             ('inverses', 'inverses'),
             ('ref_file', 'ref_file')
             ]),
-        (bold_transform, merge, [('out_files', 'in_files')]),
-        (merge, bold_reference_wf, [('out_file', 'inputnode.bold_file')]),
-        (merge, outputnode, [('out_file', 'bold')]),
-        (inputnode, WM_mask_to_EPI, [('name_source', 'name_source')]),
-        (bold_reference_wf, WM_mask_to_EPI, [
-            ('outputnode.ref_image', 'ref_EPI')]),
-        (WM_mask_to_EPI, outputnode, [
-            ('EPI_mask', 'WM_mask')]),
-        (inputnode, CSF_mask_to_EPI, [('name_source', 'name_source')]),
-        (bold_reference_wf, CSF_mask_to_EPI, [
-            ('outputnode.ref_image', 'ref_EPI')]),
-        (CSF_mask_to_EPI, outputnode, [
-            ('EPI_mask', 'CSF_mask')]),
-        (inputnode, vascular_mask_to_EPI, [('name_source', 'name_source')]),
-        (bold_reference_wf, vascular_mask_to_EPI, [
-            ('outputnode.ref_image', 'ref_EPI')]),
-        (vascular_mask_to_EPI, outputnode, [
-            ('EPI_mask', 'vascular_mask')]),
-        (inputnode, brain_mask_to_EPI, [('name_source', 'name_source')]),
-        (bold_reference_wf, brain_mask_to_EPI, [
-            ('outputnode.ref_image', 'ref_EPI')]),
-        (brain_mask_to_EPI, outputnode, [
-            ('EPI_mask', 'brain_mask')]),
-        (inputnode, propagate_labels, [('name_source', 'name_source')]),
-        (bold_reference_wf, propagate_labels, [
+        (bold_transform, bold_reference_wf, [('out_file', 'inputnode.bold_file')]),
+        (bold_transform, outputnode, [('out_file', 'bold')]),
+        (inputnode, masks_to_EPI, [('name_source', 'name_source')]),
+        (bold_reference_wf, masks_to_EPI, [
             ('outputnode.ref_image', 'ref_EPI')]),
-        (propagate_labels, outputnode, [
-            ('EPI_mask', 'labels')]),
+        (masks_to_EPI, split_masks, [
+            ('EPI_masks', 'inlist')]),
+        (split_masks, outputnode, [
+            ('out1', 'WM_mask'),
+            ('out2', 'CSF_mask'),
+            ('out3', 'vascular_mask'),
+            ('out4', 'brain_mask'),
+            ('out5', 'labels')]),
         (bold_reference_wf, outputnode, [
             ('outputnode.ref_image', 'bold_ref')]),
     ])
@@ -3,7 +3,7 @@ from nipype.interfaces.utility import Function
 from nipype.interfaces import utility as niu
 
 
-def init_bold_stc_wf(tr, tpattern, no_STC=False, rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, name='bold_stc_wf'):
+def init_bold_stc_wf(tr, tpattern, no_STC=False, stc_engine='afni', intermediate_format='nii.gz', rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, local_threads=1, name='bold_stc_wf'):
     """
     This workflow performs :abbr:`STC (slice-timing correction)` over the input
     :abbr:`BOLD (blood-oxygen-level dependent)` image.
@@ -12,6 +12,11 @@ def init_bold_stc_wf(tr, tpattern, no_STC=False, rabies_data_type=8, rabies_mem_
 
         name : str
             Name of workflow (default: ``bold_stc_wf``)
+        stc_engine : str
+            'afni' to apply AFNI's 3dTshift, or 'native' for the in-process
+            quintic interpolation of native_slice_timing_correction
+        intermediate_format : str
+            'nii.gz' or 'nii', the format of the corrected series
 
     **Inputs**
 
@@ -34,12 +39,24 @@ def init_bold_stc_wf(tr, tpattern, no_STC=False, rabies_data_type=8, rabies_mem_
         fields=['stc_file']), name='outputnode')
 
     if not no_STC:
-        slice_timing_correction_node = pe.Node(Function(input_names=['in_file', 'tr', 'tpattern', 'rabies_data_type'],
-                                                        output_names=[
-                                                            'out_file'],
-                                                        function=slice_timing_correction),
-                                               name='slice_timing_correction', mem_gb=1.5*rabies_mem_scale)
+        if stc_engine == 'native':
+            stc_n_procs = int(local_threads/4)+1
+            slice_timing_correction_node = pe.Node(Function(input_names=['in_file', 'tr', 'tpattern', 'rabies_data_type', 'n_procs', 'intermediate_format'],
+                                                            output_names=[
+                                                                'out_file'],
+                                                            function=native_slice_timing_correction),
+                                                   name='slice_timing_correction', mem_gb=1*rabies_mem_scale, n_procs=stc_n_procs)
+            slice_timing_correction_node.inputs.n_procs = stc_n_procs
+        else:
+            slice_timing_correction_node = pe.Node(Function(input_names=['in_file', 'tr', 'tpattern', 'rabies_data_type', 'intermediate_format'],
+                                                            output_names=[
+                                                                'out_file'],
+                                                            function=slice_timing_correction),
+                                                   name='slice_timing_correction', mem_gb=1.5*rabies_mem_scale)
+        slice_timing_correction_node.inputs.tr = tr
+        slice_timing_correction_node.inputs.tpattern = tpattern
         slice_timing_correction_node.inputs.rabies_data_type = rabies_data_type
+        slice_timing_correction_node.inputs.intermediate_format = intermediate_format
         slice_timing_correction_node.plugin_args = {
             'qsub_args': '-pe smp %s' % (str(3*min_proc)), 'overwrite': True}
 
@@ -56,7 +73,7 @@ def init_bold_stc_wf(tr, tpattern, no_STC=False, rabies_data_type=8, rabies_mem_
     return workflow
 
 
-def slice_timing_correction(in_file, tr='1.0s', tpattern='alt', rabies_data_type=8):
+def slice_timing_correction(in_file, tr='1.0s', tpattern='alt', rabies_data_type=8, intermediate_format='nii.gz'):
     '''
     This functions applies slice-timing correction on the anterior-posterior
     slice acquisition direction. The input image, assumed to be in RAS orientation
@@ -99,36 +116,144 @@ def slice_timing_correction(in_file, tr='1.0s', tpattern='alt', rabies_data_type
 
     img = sitk.ReadImage(in_file, rabies_data_type)
 
-    # get image data
-    img_array = sitk.GetArrayFromImage(img)
+    # swap the A and S dimensions, since 3dTshift is applied along the Z dimension
+    img_array = sitk.GetArrayViewFromImage(img)
+    image_out = sitk.GetImageFromArray(
+        np.swapaxes(img_array, 1, 2), isVector=False)
+    sitk.WriteImage(image_out, 'STC_temp.%s' % (intermediate_format,))
+    del image_out
 
-    shape = img_array.shape
-    new_array = np.zeros([shape[0], shape[2], shape[1], shape[3]])
-    for i in range(shape[2]):
-        new_array[:, i, :, :] = img_array[:, :, i, :]
-
-    image_out = sitk.GetImageFromArray(new_array, isVector=False)
-    sitk.WriteImage(image_out, 'STC_temp.nii.gz')
-
-    command = '3dTshift -quintic -prefix temp_tshift.nii.gz -tpattern %s -TR %s STC_temp.nii.gz' % (
-        tpattern, tr,)
+    command = '3dTshift -quintic -prefix temp_tshift.%s -tpattern %s -TR %s STC_temp.%s' % (
+        intermediate_format, tpattern, tr, intermediate_format,)
     from rabies.preprocess_pkg.utils import run_command
     rc = run_command(command)
 
     tshift_img = sitk.ReadImage(
-        'temp_tshift.nii.gz', rabies_data_type)
-    tshift_array = sitk.GetArrayFromImage(tshift_img)
-
-    new_array = np.zeros(shape)
-    for i in range(shape[2]):
-        new_array[:, :, i, :] = tshift_array[:, i, :, :]
-    image_out = sitk.GetImageFromArray(new_array, isVector=False)
+        'temp_tshift.%s' % (intermediate_format,), rabies_data_type)
+    image_out = sitk.GetImageFromArray(np.swapaxes(
+        sitk.GetArrayViewFromImage(tshift_img), 1, 2), isVector=False)
+    del tshift_img
 
     from rabies.preprocess_pkg.utils import copyInfo_4DImage
     image_out = copyInfo_4DImage(image_out, img, img)
 
     import pathlib  # Better path manipulation
     filename_split = pathlib.Path(in_file).name.rsplit(".nii")
-    out_file = os.path.abspath(filename_split[0]+'_tshift.nii.gz')
+    out_file = os.path.abspath(
+        '%s_tshift.%s' % (filename_split[0], intermediate_format))
     sitk.WriteImage(image_out, out_file)
     return out_file
+
+
+def get_slice_timings(num_slices, tr, tpattern):
+    '''
+    Returns the acquisition time of each slice within the TR, following the alt-z/seq-z
+    patterns of AFNI's 3dTshift, where slices are acquired in the minus direction:
+    alt-z is interleaved (num_slices-1, num_slices-3, ..., num_slices-2, num_slices-4, ...),
+    and seq-z is sequential (num_slices-1, num_slices-2, ..., 0).
+    '''
+    import numpy as np
+    if tpattern == "alt":
+        order = list(range(num_slices-1, -1, -2)) + \
+            list(range(num_slices-2, -1, -2))
+    elif tpattern == "seq":
+        order = list(range(num_slices-1, -1, -1))
+    else:
+        raise ValueError('Invalid --tpattern provided.')
+    slice_timings = np.zeros(num_slices)
+    slice_timings[order] = np.arange(num_slices)*tr/num_slices
+    return slice_timings
+
+
+def quintic_shift(timeseries, shift, out):
+    '''
+    Resamples timeseries (time along the first axis) at the fractional positions index+shift, with a
+    6-point Lagrange (quintic) interpolation as in 3dTshift -quintic. The edge values are repeated
+    beyond the ends of the timeseries. The result is written into out.
+    '''
+    import numpy as np
+    num_timepoints = timeseries.shape[0]
+    offset = int(np.floor(shift))
+    fraction = shift-offset
+    nodes = np.arange(-2, 4)
+    weights = [np.prod([(fraction-m)/(k-m) for m in nodes if not m == k])
+               for k in nodes]
+    indices = np.arange(num_timepoints)+offset
+    out[:] = 0
+    for k, weight in zip(nodes, weights):
+        out += weight*timeseries[np.clip(indices+k, 0, num_timepoints-1)]
+    return out
+
+
+def native_slice_timing_correction(in_file, tr='1.0s', tpattern='alt', rabies_data_type=8, n_procs=1, intermediate_format='nii.gz', slice_axis=1):
+    '''
+    In-process equivalent of slice_timing_correction. Each slice along slice_axis (0,1,2 for
+    the x,y,z axes of the RAS image; the anterior-posterior axis by default) is shifted to the
+    average slice timing with the quintic interpolation of 3dTshift. Slices are read from a view
+    of the input image in the configured data type and written into the output file as they
+    are corrected, with slices distributed across n_procs threads.
+
+    **Inputs**
+
+        in_file
+            BOLD series NIfTI file in RAS orientation.
+        tr
+            TR of the BOLD image, in seconds ('1.0s') or milliseconds ('1000ms').
+        tpattern
+            'alt' for interleaved or 'seq' for sequential slice acquisition.
+
+    **Outputs**
+
+        out_file
+            Slice-timing corrected BOLD series NIfTI file
+
+    '''
+
+    import os
+    import SimpleITK as sitk
+    import numpy as np
+    from multiprocessing.pool import ThreadPool
+    from rabies.preprocess_pkg.stc import get_slice_timings, quintic_shift
+    from rabies.preprocess_pkg.utils import copyInfo_3DImage, init_4D_memmap, close_4D_memmap
+
+    if tr.endswith('ms'):
+        tr_value = float(tr[:-2])/1000
+    else:
+        tr_value = float(tr.rstrip('s'))
+
+    img = sitk.ReadImage(in_file, rabies_data_type)
+    img_array = sitk.GetArrayViewFromImage(img)
+
+    import pathlib  # Better path manipulation
+    filename_split = pathlib.Path(in_file).name.rsplit(".nii")
+    out_file = os.path.abspath(
+        '%s_tshift.%s' % (filename_split[0], intermediate_format))
+    ref_3d = copyInfo_3DImage(sitk.GetImageFromArray(
+        img_array[0, :, :, :], isVector=False), img)
+    corrected = init_4D_memmap(
+        out_file, ref_3d, img_array.shape[0], img.GetSpacing()[3], rabies_data_type)
+    # the (x,y,z,t) nifti layout is viewed with the (t,z,y,x) array layout
+    corrected_view = corrected.T
+
+    # the (x,y,z) slice axis corresponds to axis 3-slice_axis of the (t,z,y,x) array
+    array_axis = 3-slice_axis
+    slice_timings = get_slice_timings(
+        img_array.shape[array_axis], tr_value, tpattern)
+    tzero = slice_timings.mean()
+
+    def correct_slice(i):
+        index = [slice(None)]*4
+        index[array_axis] = i
+        index = tuple(index)
+        slice_out = np.empty(img_array[index].shape, dtype='float64')
+        quintic_shift(img_array[index], (tzero-slice_timings[i])/tr_value, slice_out)
+        corrected_view[index] = slice_out
+        return i
+
+    pool = ThreadPool(n_procs)
+    pool.map(correct_slice, range(img_array.shape[array_axis]))
+    pool.close()
+    pool.join()
+
+    close_4D_memmap(corrected, out_file)
+    return out_file
@@ -3,8 +3,9 @@ import SimpleITK as sitk
 import numpy as np
 from nipype.interfaces.base import (
     traits, TraitedSpec, BaseInterfaceInputSpec,
-    File, InputMultiPath, BaseInterface
+    File, BaseInterface
 )
+from nipype.interfaces.io import DataSink, DataSinkInputSpec
 
 
 def prep_bids_iter(layout, bold_only=False):
@@ -149,7 +150,7 @@ class BIDSDataGraber(BaseInterface):
         return {'out_file': getattr(self, 'out_file')}
 
 
-def init_bold_reference_wf(detect_dummy=False, rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, name='gen_bold_ref'):
+def init_bold_reference_wf(detect_dummy=False, motion_engine='ants', intermediate_format='nii.gz', rabies_data_type=8, rabies_mem_scale=1.0, min_proc=1, name='gen_bold_ref'):
     """
     This workflow generates reference BOLD images for a series
 
@@ -158,6 +159,11 @@ def init_bold_reference_wf(detect_dummy=False, rabies_data_type=8, rabies_mem_sc
         detect_dummy : bool
             whether to detect and remove dummy volumes, and generate a BOLD ref
             volume based on the contrast enhanced dummy volumes.
+        motion_engine : str
+            'ants' to realign the subset of volumes with antsMotionCorr, or 'native'
+            to realign them in-process with SimpleITK.
+        intermediate_format : str
+            'nii.gz' or 'nii', the format of the BOLD file written without dummy volumes.
         name : str
             Name of workflow (default: 'gen_bold_ref')
 
@@ -172,6 +178,8 @@ def init_bold_reference_wf(detect_dummy=False, rabies_data_type=8, rabies_mem_sc
             Validated BOLD series NIfTI file
         ref_image
             Reference image generated by taking the median from the motion-realigned BOLD timeseries
+        motion_estimates
+            Rigid parameters estimated for the subset of volumes used to generate the reference
 
     """
     from nipype.pipeline import engine as pe
@@ -183,10 +191,10 @@ def init_bold_reference_wf(detect_dummy=False, rabies_data_type=8, rabies_mem_sc
         fields=['bold_file']), name='inputnode')
 
     outputnode = pe.Node(
-        niu.IdentityInterface(fields=['bold_file', 'ref_image']),
+        niu.IdentityInterface(fields=['bold_file', 'ref_image', 'motion_estimates']),
         name='outputnode')
 
-    gen_ref = pe.Node(EstimateReferenceImage(detect_dummy=detect_dummy, rabies_data_type=rabies_data_type),
+    gen_ref = pe.Node(EstimateReferenceImage(detect_dummy=detect_dummy, motion_engine=motion_engine, intermediate_format=intermediate_format, rabies_data_type=rabies_data_type),
                       name='gen_ref', mem_gb=2*rabies_mem_scale)
     gen_ref.plugin_args = {
         'qsub_args': '-pe smp %s' % (str(2*min_proc)), 'overwrite': True}
@@ -194,7 +202,8 @@ def init_bold_reference_wf(detect_dummy=False, rabies_data_type=8, rabies_mem_sc
     workflow.connect([
         (inputnode, gen_ref, [('bold_file', 'in_file')]),
         (gen_ref, outputnode, [('ref_image', 'ref_image'),
-                               ('bold_file', 'bold_file')]),
+                               ('bold_file', 'bold_file'),
+                               ('motion_estimates', 'motion_estimates')]),
     ])
 
     return workflow
@@ -204,6 +213,11 @@ class EstimateReferenceImageInputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True, mandatory=True, desc="4D EPI file")
     detect_dummy = traits.Bool(
         desc="specify if should detect and remove dummy scans, and use these volumes as reference image.")
+    motion_engine = traits.Enum('ants', 'native', usedefault=True,
+                                desc="Whether the realignment of the subset of volumes is conducted with antsMotionCorr, "
+                                "or in-process with SimpleITK.")
+    intermediate_format = traits.Enum('nii.gz', 'nii', usedefault=True,
+                                      desc="Format of the 4D images written in the working directory. Uncompressed .nii avoids the gzip compression of intermediates.")
     rabies_data_type = traits.Int(mandatory=True,
                                   desc="Integer specifying SimpleITK data type.")
 
@@ -212,6 +226,9 @@ class EstimateReferenceImageOutputSpec(TraitedSpec):
     ref_image = File(exists=True, desc="3D reference image")
     bold_file = File(
         exists=True, desc="Input bold file without dummy volumes if detect_dummy is True.")
+    motion_estimates = File(
+        exists=True, desc="Rigid parameters estimated for the subset of volumes during the last realignment round, "
+        "which can be reused by the head motion estimation.")
 
 
 class EstimateReferenceImage(BaseInterface):
@@ -224,6 +241,8 @@ class EstimateReferenceImage(BaseInterface):
     reference for motion correction, then a new median image is extracted from
     the corrected series, and the process is repeated one more time to generate
     a final image reference image.
+    Only the volumes needed are read from the EPI file, so that the runtime depends
+    on the size of the subset rather than on the length of the scan.
     """
 
     input_spec = EstimateReferenceImageInputSpec
@@ -233,29 +252,45 @@ class EstimateReferenceImage(BaseInterface):
 
         import SimpleITK as sitk
         import numpy as np
+        import nibabel as nb
+        from rabies.preprocess_pkg.utils import sitk_to_numpy_dtype, median_volume, trimmed_mean_volume
 
-        in_nii = sitk.ReadImage(self.inputs.in_file,
-                                self.inputs.rabies_data_type)
-        data_slice = sitk.GetArrayFromImage(in_nii)[:50, :, :, :]
+        # the header is read first, and volumes are only loaded when needed through the nibabel proxy
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(self.inputs.in_file)
+        reader.ReadImageInformation()
+        in_nii = nb.load(self.inputs.in_file)
+        num_volumes = in_nii.shape[3]
+        dtype = sitk_to_numpy_dtype(self.inputs.rabies_data_type)
 
-        n_volumes_to_discard = _get_vols_to_discard(in_nii)
+        def read_volumes(start, end):
+            # returns the volumes in the (t,z,y,x) SimpleITK layout
+            return np.array(in_nii.dataobj[:, :, :, start:end], dtype=dtype).transpose(3, 2, 1, 0)
+
+        data_slice = read_volumes(0, 50)
+        n_volumes_to_discard = _get_vols_to_discard(data_slice)
 
         import pathlib  # Better path manipulation
         filename_split = pathlib.Path(self.inputs.in_file).name.rsplit(".nii")
         out_ref_fname = os.path.abspath(
             '%s_bold_ref.nii.gz' % (filename_split[0],))
+        motion_estimates = os.path.abspath('motion_estimates.npz')
+        # no estimates are available by default
+        np.savez(motion_estimates, frames=np.zeros(0, dtype=int),
+                 params=np.zeros([0, 6]), metrics=np.zeros([0, 2]))
 
         if (not n_volumes_to_discard == 0) and self.inputs.detect_dummy:
             print("Detected "+str(n_volumes_to_discard)
                   + " dummy scans. Taking the median of these volumes as reference EPI.")
-            median_image_data = np.median(
-                data_slice[:n_volumes_to_discard, :, :, :], axis=0)
+            median_image_data = median_volume(
+                data_slice[:n_volumes_to_discard, :, :, :])
 
             out_bold_file = os.path.abspath(
-                '%s_cropped_dummy.nii.gz' % (filename_split[0],))
-            img_array = sitk.GetArrayFromImage(
-                in_nii)[n_volumes_to_discard:, :, :, :]
-            sitk.WriteImage(img_array, out_bold_file)
+                '%s_cropped_dummy.%s' % (filename_split[0], self.inputs.intermediate_format))
+            cropped_img = nb.Nifti1Image(np.asarray(
+                in_nii.dataobj[:, :, :, n_volumes_to_discard:], dtype=dtype), in_nii.affine, in_nii.header)
+            cropped_img.set_data_dtype(dtype)
+            cropped_img.to_filename(out_bold_file)
 
         else:
             out_bold_file = self.inputs.in_file
@@ -266,45 +301,36 @@ class EstimateReferenceImage(BaseInterface):
                     "Detected no dummy scans. Generating the ref EPI based on multiple volumes.")
             # if no dummy scans, will generate a median from a subset of max 100
             # slices of the time series
-            if in_nii.GetSize()[-1] > 100:
-                slice_fname = os.path.abspath("slice.nii.gz")
-                image_4d = copyInfo_4DImage(sitk.GetImageFromArray(
-                    data_slice[20:100, :, :, :], isVector=False), in_nii, in_nii)
-                sitk.WriteImage(image_4d, slice_fname)
-                median_fname = os.path.abspath("median.nii.gz")
-                image_3d = copyInfo_3DImage(sitk.GetImageFromArray(
-                    np.median(data_slice[20:100, :, :, :], axis=0), isVector=False), in_nii)
-                sitk.WriteImage(image_3d, median_fname)
+            if num_volumes > 100:
+                subset = read_volumes(20, 100)
             else:
-                slice_fname = self.inputs.in_file
-                median_fname = os.path.abspath("median.nii.gz")
-                image_3d = copyInfo_3DImage(sitk.GetImageFromArray(
-                    np.median(data_slice, axis=0), isVector=False), in_nii)
-                sitk.WriteImage(image_3d, median_fname)
+                subset = read_volumes(0, num_volumes)
+            del data_slice
+            median = median_volume(subset.copy())
 
             print("First iteration to generate reference image.")
-            res = antsMotionCorr(in_file=slice_fname,
-                                 ref_file=median_fname, second=False, rabies_data_type=self.inputs.rabies_data_type).run()
-            median = np.median(sitk.GetArrayFromImage(sitk.ReadImage(
-                res.outputs.mc_corrected_bold, self.inputs.rabies_data_type)), axis=0)
-            tmp_median_fname = os.path.abspath("tmp_median.nii.gz")
-            image_3d = copyInfo_3DImage(
-                sitk.GetImageFromArray(median, isVector=False), in_nii)
-            sitk.WriteImage(image_3d, tmp_median_fname)
+            [corrected, params, metrics] = self.realign_subset(
+                subset, median, reader, second=False)
+            median = median_volume(corrected)
 
             print("Second iteration to generate reference image.")
-            res = antsMotionCorr(in_file=slice_fname,
-                                 ref_file=tmp_median_fname, second=True,  rabies_data_type=self.inputs.rabies_data_type).run()
+            [corrected, params, metrics] = self.realign_subset(
+                subset, median, reader, second=True)
+            # the parameters from the last round are kept to warm-start head motion estimation
+            if num_volumes > 100:
+                frames = np.arange(20, 100)
+            else:
+                frames = np.arange(num_volumes)
+            np.savez(motion_estimates, frames=frames,
+                     params=params, metrics=metrics)
 
             # evaluate a trimmed mean instead of a median, trimming the 5% extreme values
-            from scipy import stats
-            median_image_data = stats.trim_mean(sitk.GetArrayFromImage(sitk.ReadImage(
-                res.outputs.mc_corrected_bold, self.inputs.rabies_data_type)), 0.05, axis=0)
+            median_image_data = trimmed_mean_volume(corrected, 0.05)
 
         # median_image_data is a 3D array of the median image, so creates a new nii image
         # saves it
         image_3d = copyInfo_3DImage(sitk.GetImageFromArray(
-            median_image_data, isVector=False), in_nii)
+            median_image_data, isVector=False), reader)
         sitk.WriteImage(image_3d, out_ref_fname)
 
         # denoise the resulting reference image through non-local mean denoising
@@ -316,21 +342,78 @@ class EstimateReferenceImage(BaseInterface):
 
         setattr(self, 'ref_image', out_ref_fname)
         setattr(self, 'bold_file', out_bold_file)
+        setattr(self, 'motion_estimates', motion_estimates)
 
         return runtime
 
+    def realign_subset(self, subset, median, reader, second):
+        '''
+        Realigns the subset of volumes to the median, either in-process or with antsMotionCorr on
+        uncompressed copies of the subset, and returns the realigned array together with the
+        rigid parameters and metric values in the antsMotionCorr convention.
+        '''
+        import numpy as np
+        import SimpleITK as sitk
+        median_image = copyInfo_3DImage(sitk.GetImageFromArray(
+            median, isVector=False), reader)
+
+        if self.inputs.motion_engine == 'native':
+            from rabies.preprocess_pkg.hmc import motion_correct_array
+            [params, metrics, corrected] = motion_correct_array(
+                subset, median_image)
+            return corrected, params, metrics
+
+        slice_fname = os.path.abspath("slice.nii")
+        if not os.path.isfile(slice_fname):
+            image_4d = copyInfo_4DImage(sitk.GetImageFromArray(
+                subset, isVector=False), median_image, reader)
+            sitk.WriteImage(image_4d, slice_fname)
+        median_fname = os.path.abspath(
+            "tmp_median.nii" if second else "median.nii")
+        sitk.WriteImage(median_image, median_fname)
+        res = antsMotionCorr(in_file=slice_fname,
+                             ref_file=median_fname, second=second, rabies_data_type=self.inputs.rabies_data_type).run()
+        moco_params = np.loadtxt(
+            res.outputs.csv_params, delimiter=',', skiprows=1, ndmin=2)
+        corrected = sitk.GetArrayFromImage(sitk.ReadImage(
+            res.outputs.mc_corrected_bold, self.inputs.rabies_data_type))
+        return corrected, moco_params[:, 2:], moco_params[:, :2]
+
     def _list_outputs(self):
         return {'ref_image': getattr(self, 'ref_image'),
-                'bold_file': getattr(self, 'bold_file')}
+                'bold_file': getattr(self, 'bold_file'),
+                'motion_estimates': getattr(self, 'motion_estimates')}
 
 
-def _get_vols_to_discard(img):
+def median_volume(array):
+    '''
+    Median along the first axis evaluated with an in-place partition, which avoids the copy and full
+    sort of np.median. The content of the input array is reordered.
+    '''
+    import numpy as np
+    return np.median(array, axis=0, overwrite_input=True)
+
+
+def trimmed_mean_volume(array, proportiontocut):
+    '''
+    Same as scipy.stats.trim_mean along the first axis, but the extreme values are found with an
+    in-place partition of the input array instead of a sorted copy.
     '''
-    Takes a nifti file, extracts the mean signal of the first 50 volumes and computes which are outliers.
+    import numpy as np
+    num = array.shape[0]
+    lowercut = int(proportiontocut * num)
+    uppercut = num - lowercut
+    if lowercut > 0:
+        array.partition((lowercut, uppercut - 1), axis=0)
+    return array[lowercut:uppercut].mean(axis=0)
+
+
+def _get_vols_to_discard(data_slice):
+    '''
+    Takes the first 50 volumes of a timeseries array, extracts the mean signal of each volume and computes which are outliers.
     is_outlier function: computes Modified Z-Scores (https://www.itl.nist.gov/div898/handbook/eda/section3/eda35h.htm) to determine which volumes are outliers.
     '''
     from nipype.algorithms.confounds import is_outlier
-    data_slice = sitk.GetArrayFromImage(img)[:50, :, :, :]
     global_signal = data_slice.mean(axis=-1).mean(axis=-1).mean(axis=-1)
     return is_outlier(global_signal)
 
@@ -340,6 +423,12 @@ class antsMotionCorrInputSpec(BaseInterfaceInputSpec):
     ref_file = File(exists=True, mandatory=True,
                     desc='ref file to realignment time series')
     second = traits.Bool(desc="specify if it is the second iteration")
+    n_chunks = traits.Int(1, usedefault=True,
+                          desc="Number of chunks of consecutive frames which are realigned by parallel antsMotionCorr calls.")
+    n_procs = traits.Int(desc="Number of threads shared among the antsMotionCorr calls. By default, the chunks "
+                         "get one thread each, and a single call uses all cores.")
+    intermediate_format = traits.Enum('nii.gz', 'nii', usedefault=True,
+                                      desc="Format of the 4D images written in the working directory. Uncompressed .nii avoids the gzip compression of intermediates.")
     rabies_data_type = traits.Int(mandatory=True,
                                   desc="Integer specifying SimpleITK data type.")
 
@@ -356,6 +445,8 @@ class antsMotionCorr(BaseInterface):
     """
     This interface performs motion realignment using antsMotionCorr function. It takes a reference volume to which
     EPI volumes from the input 4D file are realigned based on a Rigid registration.
+    Since each volume is realigned independently to the fixed reference, the frames can be split into n_chunks
+    which are realigned in parallel, and the outputs are then stitched back together in the original order.
     """
 
     input_spec = antsMotionCorrInputSpec
@@ -366,9 +457,10 @@ class antsMotionCorr(BaseInterface):
         import os
         import SimpleITK as sitk
         from rabies.preprocess_pkg.utils import run_command
+        from rabies.preprocess_pkg.image_io import read_image_information
         # check the size of the lowest dimension, and make sure that the first shrinking factor allow for at least 4 slices
         shrinking_factor = 4
-        img = sitk.ReadImage(self.inputs.in_file, self.inputs.rabies_data_type)
+        img = read_image_information(self.inputs.in_file)
         low_dim = np.asarray(img.GetSize()[:3]).min()
         if shrinking_factor > int(low_dim/4):
             shrinking_factor = int(low_dim/4)
@@ -381,13 +473,21 @@ class antsMotionCorr(BaseInterface):
         # make a tmp directory to store the files
         os.makedirs('ants_mc_tmp', exist_ok=True)
 
-        command = 'antsMotionCorr -d 3 -o [ants_mc_tmp/motcorr,ants_mc_tmp/motcorr.nii.gz,ants_mc_tmp/motcorr_avg.nii.gz] \
-                -m MI[ %s , %s , 1 , 20 , Regular, 0.2 ] -t Rigid[ 0.1 ] -i 100x50x30 -u 1 -e 1 -l 1 -s 2x1x0 -f %sx2x1 -n 10' % (self.inputs.ref_file, self.inputs.in_file, str(shrinking_factor))
-        rc = run_command(command)
+        num_volumes = img.GetSize()[3]
+        n_chunks = max(min(self.inputs.n_chunks, num_volumes), 1)
+        ext = self.inputs.intermediate_format
+        from nipype.interfaces.base import isdefined
+        n_procs = self.inputs.n_procs if isdefined(self.inputs.n_procs) else None
+        if n_chunks == 1:
+            run_antsMotionCorr(self.inputs.ref_file, self.inputs.in_file,
+                               'ants_mc_tmp/motcorr', shrinking_factor, ext=ext, num_threads=n_procs)
+        else:
+            chunked_antsMotionCorr(self.inputs.ref_file, self.inputs.in_file,
+                                   'ants_mc_tmp/motcorr', shrinking_factor, n_chunks, n_procs=n_procs, ext=ext)
 
         setattr(self, 'csv_params', 'ants_mc_tmp/motcorrMOCOparams.csv')
-        setattr(self, 'mc_corrected_bold', 'ants_mc_tmp/motcorr.nii.gz')
-        setattr(self, 'avg_image', 'ants_mc_tmp/motcorr_avg.nii.gz')
+        setattr(self, 'mc_corrected_bold', 'ants_mc_tmp/motcorr.%s' % (ext,))
+        setattr(self, 'avg_image', 'ants_mc_tmp/motcorr_avg.%s' % (ext,))
 
         return runtime
 
@@ -397,6 +497,95 @@ class antsMotionCorr(BaseInterface):
                 'avg_image': getattr(self, 'avg_image')}
 
 
+def run_antsMotionCorr(ref_file, in_file, out_prefix, shrinking_factor, ext='nii.gz', num_threads=None):
+    '''
+    Runs the rigid antsMotionCorr realignment of in_file to ref_file, generating <out_prefix>MOCOparams.csv,
+    <out_prefix>.<ext> and <out_prefix>_avg.<ext>. num_threads limits the number of ITK threads of the
+    process, which otherwise uses one thread per core.
+    '''
+    from rabies.preprocess_pkg.utils import run_command
+    command = 'antsMotionCorr -d 3 -o [%s,%s.%s,%s_avg.%s] \
+            -m MI[ %s , %s , 1 , 20 , Regular, 0.2 ] -t Rigid[ 0.1 ] -i 100x50x30 -u 1 -e 1 -l 1 -s 2x1x0 -f %sx2x1 -n 10' % (
+        out_prefix, out_prefix, ext, out_prefix, ext, ref_file, in_file, str(shrinking_factor))
+    if num_threads is not None:
+        command = 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=%i %s' % (
+            num_threads, command)
+    rc = run_command(command)
+    return out_prefix
+
+
+def chunked_antsMotionCorr(ref_file, in_file, out_prefix, shrinking_factor, n_chunks, n_procs=None, ext='nii.gz'):
+    '''
+    Splits the frames of in_file into n_chunks of consecutive volumes which are realigned by parallel
+    antsMotionCorr processes, then reassembles the outputs in the order of the original frames: a
+    single MOCOparams.csv with the rows of each chunk, the motion corrected series, and their average
+    weighted by the number of frames in each chunk. The outputs follow the same naming as run_antsMotionCorr.
+    The n_procs threads allocated to the node (n_chunks by default) are shared among the processes.
+    '''
+    import os
+    import numpy as np
+    import nibabel as nb
+    import SimpleITK as sitk
+    from multiprocessing.pool import ThreadPool
+    from rabies.preprocess_pkg.utils import run_antsMotionCorr, init_4D_memmap, close_4D_memmap
+
+    bold_img = nb.load(in_file)
+    num_volumes = bold_img.shape[3]
+    bounds = np.linspace(0, num_volumes, n_chunks+1).astype(int)
+    if n_procs is None:
+        n_procs = n_chunks
+    # the threads are split as evenly as possible among the processes, with at least one thread each
+    num_threads = [max(1, int(n_procs/n_chunks)+int(i < n_procs % n_chunks))
+                   for i in range(n_chunks)]
+    # the series is decoded once, since slicing the proxy of a .nii.gz re-inflates the file for each chunk
+    bold_data = np.asarray(bold_img.dataobj)
+
+    chunk_dir = os.path.dirname(os.path.abspath(out_prefix))
+    chunk_prefixes = []
+    for i in range(n_chunks):
+        chunk_file = '%s/chunk%i_input.%s' % (chunk_dir, i, ext)
+        nb.Nifti1Image(bold_data[..., bounds[i]:bounds[i+1]], bold_img.affine,
+                       bold_img.header).to_filename(chunk_file)
+        chunk_prefixes.append(('%s/chunk%i_motcorr' % (chunk_dir, i), chunk_file))
+    del bold_data
+
+    # each chunk is handled by a separate antsMotionCorr process, so threads are sufficient here
+    pool = ThreadPool(n_chunks)
+    pool.starmap(run_antsMotionCorr, [(ref_file, chunk_file, chunk_prefix, shrinking_factor, ext, num_threads[i])
+                                      for i, (chunk_prefix, chunk_file) in enumerate(chunk_prefixes)])
+    pool.close()
+    pool.join()
+
+    # the .csv rows are concatenated as is below a single header
+    with open('%sMOCOparams.csv' % (out_prefix), 'w') as out_csv:
+        for i, (chunk_prefix, chunk_file) in enumerate(chunk_prefixes):
+            with open('%sMOCOparams.csv' % (chunk_prefix)) as chunk_csv:
+                lines = chunk_csv.readlines()
+            if i == 0:
+                out_csv.write(lines[0])
+            out_csv.writelines(lines[1:])
+
+    avg_image = sitk.ReadImage('%s_avg.%s' %
+                               (chunk_prefixes[0][0], ext), sitk.sitkFloat32)
+    combined = init_4D_memmap('%s.%s' % (out_prefix, ext), avg_image, num_volumes,
+                              bold_img.header.get_zooms()[3], sitk.sitkFloat32)
+    avg_array = np.zeros(combined.shape[:3], dtype='float64')
+    for i, (chunk_prefix, chunk_file) in enumerate(chunk_prefixes):
+        chunk_data = np.asarray(nb.load('%s.%s' % (chunk_prefix, ext)).dataobj)
+        combined[..., bounds[i]:bounds[i+1]] = chunk_data.reshape(combined.shape[:3]+(-1,))
+        avg_array += chunk_data.reshape(combined.shape[:3]+(-1,)).sum(axis=3)
+        del chunk_data
+        os.remove(chunk_file)
+        os.remove('%s.%s' % (chunk_prefix, ext))
+    close_4D_memmap(combined, '%s.%s' % (out_prefix, ext))
+
+    avg = sitk.GetImageFromArray(
+        (avg_array/num_volumes).transpose(2, 1, 0).astype('float32'), isVector=False)
+    avg.CopyInformation(avg_image)
+    sitk.WriteImage(avg, '%s_avg.%s' % (out_prefix, ext))
+    return out_prefix
+
+
 def register_slice(fixed_image, moving_image):
     # function for 2D registration
     initial_transform = sitk.CenteredTransformInitializer(fixed_image,
@@ -432,14 +621,174 @@ def register_slice(fixed_image, moving_image):
     return final_transform
 
 
-def slice_specific_registration(i, ref_file, timeseries_file):
+def prepare_slice_reference(ref_image, smoothing_sigmas=[2, 1, 0], sampling_fraction=0.5, seed=1):
+    '''
+    Precomputes, once for every coronal slice of the reference, the quantities needed for the
+    inverse-compositional estimation of the 2D rigid transforms in register_slices_vectorized:
+    the smoothed and normalized reference intensities at a fixed random sample of pixels, and the
+    steepest descent images and Hessians of the Euler2D parameters, for each level of the pyramid.
+    Slices are handled in physical units, and rotations are centered on the slice geometric center.
+    '''
+    import numpy as np
+    from scipy.ndimage import gaussian_filter
+
+    ref_array = sitk.GetArrayFromImage(ref_image).astype(np.float64)
+    # stack of coronal slices, of shape (slices, z, x)
+    ref_stack = ref_array.transpose(1, 0, 2)
+    spacing = np.asarray(ref_image.GetSpacing())
+    slice_spacing = np.asarray([spacing[2], spacing[0]])
+    slice_shape = ref_stack.shape[1:]
+
+    rng = np.random.RandomState(seed)
+    num_points = max(int(np.prod(slice_shape)*sampling_fraction), 10)
+    flat_idx = rng.choice(int(np.prod(slice_shape)),
+                          size=num_points, replace=False)
+    rows, cols = np.unravel_index(flat_idx, slice_shape)
+    # physical coordinates of the sampled points relative to the slice center, as (row,col)
+    center = (np.asarray(slice_shape)-1)/2*slice_spacing
+    points = np.stack([rows*slice_spacing[0], cols *
+                       slice_spacing[1]], axis=1)-center
+
+    levels = []
+    for sigma in smoothing_sigmas:
+        # smoothing sigmas are in voxels
+        smoothed = gaussian_filter(ref_stack, sigma=[0, sigma, sigma])
+        values = smoothed[:, rows, cols]
+        mean = values.mean(axis=1, keepdims=True)
+        std = values.std(axis=1, keepdims=True)
+        std[std == 0] = 1
+        grad_r = np.gradient(smoothed, axis=1)[
+            :, rows, cols]/slice_spacing[0]/std
+        grad_c = np.gradient(smoothed, axis=2)[
+            :, rows, cols]/slice_spacing[1]/std
+        # jacobian of the warp for the parameters (angle, t_row, t_col)
+        steepest_descent = np.stack(
+            [grad_c*points[:, 0]-grad_r*points[:, 1], grad_r, grad_c], axis=2)
+        hessian = np.einsum('snk,snl->skl', steepest_descent, steepest_descent)
+        levels.append({'sigma': sigma, 'values': (values-mean)/std,
+                       'steepest_descent': steepest_descent, 'hessian': hessian})
+
+    return {'levels': levels, 'points': points, 'center': center, 'spacing': slice_spacing,
+            'valid': ref_stack.reshape(ref_stack.shape[0], -1).std(axis=1) > 0}
+
+
+def register_slices_vectorized(volume_array, ref_info, num_iterations=100, convergence=1e-4):
+    '''
+    Estimates the Euler2D transforms aligning every coronal slice of a volume to the reference in a single
+    batched Gauss-Newton optimization over all slices, with the normalized sum of squared differences as
+    metric, and returns the volume resampled with these transforms.
+    '''
+    import numpy as np
+    from scipy.ndimage import gaussian_filter, map_coordinates
+
+    moving_stack = volume_array.transpose(1, 0, 2).astype(np.float64)
+    num_slices = moving_stack.shape[0]
+    spacing = ref_info['spacing']
+    center = ref_info['center']
+    points = ref_info['points']
+    slice_idx = np.repeat(np.arange(num_slices)[:, np.newaxis], points.shape[0], axis=1)
+
+    active = ref_info['valid'] & (moving_stack.reshape(
+        num_slices, -1).sum(axis=1) != 0)
+    angle = np.zeros(num_slices)
+    translation = np.zeros([num_slices, 2])
+
+    def warp_points(points, angle, translation):
+        cos = np.cos(angle)[:, np.newaxis]
+        sin = np.sin(angle)[:, np.newaxis]
+        r = cos*points[..., 0]-sin*points[..., 1]+translation[:, [0]]
+        c = sin*points[..., 0]+cos*points[..., 1]+translation[:, [1]]
+        return r, c
+
+    for level in ref_info['levels']:
+        smoothed = gaussian_filter(moving_stack, sigma=[
+                                   0, level['sigma'], level['sigma']])
+        converged = ~active
+        previous_cost = np.full(num_slices, np.inf)
+        previous_angle = angle.copy()
+        previous_translation = translation.copy()
+        for i in range(num_iterations):
+            r, c = warp_points(points, angle, translation)
+            r = (r+center[0])/spacing[0]
+            c = (c+center[1])/spacing[1]
+            sampled = map_coordinates(smoothed, [slice_idx, r, c],
+                                      order=1, mode='nearest')
+            # as with ITK metrics, points mapped outside of the moving slice are excluded
+            inside = (r >= 0) & (r <= moving_stack.shape[1]-1) & (
+                c >= 0) & (c <= moving_stack.shape[2]-1)
+            num_inside = np.maximum(inside.sum(axis=1, keepdims=True), 1)
+            mean = (sampled*inside).sum(axis=1, keepdims=True)/num_inside
+            std = np.sqrt((((sampled-mean)*inside)**2).sum(axis=1,
+                                                         keepdims=True)/num_inside)
+            std[std == 0] = 1
+            error = ((sampled-mean)/std-level['values'])*inside
+
+            # steps which don't decrease the metric are reverted, and the slice is considered converged
+            cost = (error**2).sum(axis=1)/num_inside[:, 0]
+            diverged = (~converged) & (cost > previous_cost)
+            angle[diverged] = previous_angle[diverged]
+            translation[diverged] = previous_translation[diverged]
+            converged |= diverged
+            if converged.all():
+                break
+            previous_cost[~converged] = cost[~converged]
+            previous_angle[~converged] = angle[~converged]
+            previous_translation[~converged] = translation[~converged]
+
+            idx = np.where(~converged)[0]
+            delta = np.linalg.solve(level['hessian'][idx], np.einsum(
+                'snk,sn->sk', level['steepest_descent'][idx], error[idx])[:, :, np.newaxis])[:, :, 0]
+            # steps are limited to a displacement of one voxel
+            step = np.abs(delta[:, 0])*np.abs(points).max() + \
+                np.abs(delta[:, 1:]).max(axis=1)
+            delta *= np.minimum(1, spacing.max()/np.maximum(step, 1e-12))[:, np.newaxis]
+
+            # inverse compositional update of the rotation and translation
+            angle[idx] -= delta[:, 0]
+            cos = np.cos(angle[idx])
+            sin = np.sin(angle[idx])
+            translation[idx, 0] -= cos*delta[:, 1]-sin*delta[:, 2]
+            translation[idx, 1] -= sin*delta[:, 1]+cos*delta[:, 2]
+
+            step = np.abs(delta[:, 0])*np.abs(points).max() + \
+                np.abs(delta[:, 1:]).max(axis=1)
+            converged[idx[step < convergence*spacing.min()]] = True
+
+    # resample each slice on its full grid with the final transforms; the slice is prefiltered into 4th-order
+    # B-spline coefficients, as the sitk path, so that it isn't smoothed by the interpolation
+    rows, cols = np.indices(moving_stack.shape[1:])
+    grid = np.stack([rows*spacing[0], cols*spacing[1]], axis=-1)-center
+    for j in np.where(active)[0]:
+        r, c = warp_points(grid[np.newaxis], angle[[j]], translation[[j]])
+        volume_array[:, j, :] = map_coordinates(moving_stack[j], [(r[0]+center[0])/spacing[0], (c[0]+center[1])/spacing[1]],
+                                                order=4, mode='constant', cval=0.0, prefilter=True)
+    return volume_array
+
+
+def init_slice_mc_worker(timeseries_file, offset, shape, ref_file, engine='sitk'):
+    # each worker attaches once to the shared timeseries buffer and loads the reference
+    global slice_mc_timeseries, slice_mc_ref, slice_mc_engine
+    slice_mc_timeseries = np.memmap(
+        timeseries_file, dtype=np.float32, mode='r+', offset=offset, shape=shape)
+    slice_mc_ref = sitk.ReadImage(ref_file, sitk.sitkFloat32)
+    slice_mc_engine = engine
+    if engine == 'vectorized':
+        slice_mc_ref = prepare_slice_reference(slice_mc_ref)
+
+
+def slice_specific_registration(i):
     print('Slice-specific correction on volume '+str(i+1))
-    ref_image = sitk.ReadImage(ref_file, sitk.sitkFloat32)
-    timeseries_image = sitk.ReadImage(timeseries_file, sitk.sitkFloat32)
-    volume_array = sitk.GetArrayFromImage(timeseries_image)[i, :, :, :]
+    ref_image = slice_mc_ref
+    # the volume is a view on the shared buffer, and corrected slices are written back in place
+    volume_array = slice_mc_timeseries[i, :, :, :]
+
+    if slice_mc_engine == 'vectorized':
+        register_slices_vectorized(volume_array, ref_image)
+        volume_array[(volume_array < 0).astype(bool)] = 0
+        return i
 
     for j in range(volume_array.shape[1]):
-        slice_array = volume_array[:, j, :]
+        slice_array = np.array(volume_array[:, j, :])
         if slice_array.sum()==0:
             continue
         moving_image = sitk.GetImageFromArray(slice_array)
@@ -452,7 +801,9 @@ def slice_specific_registration(i, ref_file, timeseries_file):
 
         resampled_slice = sitk.GetArrayFromImage(moving_resampled)
         volume_array[:, j, :] = resampled_slice
-    return [i, volume_array]
+    # clip potential negative values
+    volume_array[(volume_array < 0).astype(bool)] = 0
+    return i
 
 
 class SliceMotionCorrectionInputSpec(BaseInterfaceInputSpec):
@@ -463,6 +814,11 @@ class SliceMotionCorrectionInputSpec(BaseInterfaceInputSpec):
                        desc='Reference BOLD file for naming the output.')
     n_procs = traits.Int(exists=True, mandatory=True,
                          desc="Number of processors available to run in parallel.")
+    engine = traits.Enum('sitk', 'vectorized', usedefault=True,
+                         desc="Backend for the 2D registrations. 'sitk' registers each slice with SimpleITK, whereas "
+                         "'vectorized' estimates the transforms of all slices of a volume together in a batched optimization.")
+    intermediate_format = traits.Enum('nii.gz', 'nii', usedefault=True,
+                                      desc="Format of the 4D images written in the working directory. Uncompressed .nii avoids the gzip compression of intermediates.")
 
 
 class SliceMotionCorrectionOutputSpec(TraitedSpec):
@@ -484,32 +840,39 @@ class SliceMotionCorrection(BaseInterface):
         import os
         import SimpleITK as sitk
         import multiprocessing as mp
+        from rabies.preprocess_pkg.utils import init_4D_memmap, close_4D_memmap, copyInfo_3DImage, init_slice_mc_worker
+
+        import pathlib  # Better path manipulation
+        split = pathlib.Path(self.inputs.name_source).name.rsplit(".nii")
+        out_name = os.path.abspath(
+            '%s_slice_mc.%s' % (split[0], self.inputs.intermediate_format))
 
+        # the timeseries is decoded once into the uncompressed output file, which serves as the
+        # buffer shared with the workers; the (x,y,z,t) nifti layout matches the (t,z,y,x) array layout
         timeseries_image = sitk.ReadImage(
             self.inputs.in_file, sitk.sitkFloat32)
-
-        pool = mp.Pool(processes=self.inputs.n_procs)
-        results = [pool.apply_async(slice_specific_registration, args=(
-            i, self.inputs.ref_file, self.inputs.in_file)) for i in range(timeseries_image.GetSize()[3])]
+        timeseries_array = sitk.GetArrayViewFromImage(timeseries_image)
+        num_volumes = timeseries_image.GetSize()[3]
+        ref_3d = copyInfo_3DImage(sitk.GetImageFromArray(
+            timeseries_array[0, :, :, :], isVector=False), timeseries_image)
+        shared_timeseries = init_4D_memmap(
+            out_name, ref_3d, num_volumes, timeseries_image.GetSpacing()[3], sitk.sitkFloat32)
+        for i in range(num_volumes):
+            shared_timeseries[:, :, :, i] = timeseries_array[i, :, :, :].transpose(2, 1, 0)
+        shared_timeseries.flush()
+        shape = timeseries_array.shape
+        del timeseries_array, timeseries_image
+
+        pool = mp.Pool(processes=self.inputs.n_procs, initializer=init_slice_mc_worker, initargs=(
+            shared_timeseries.filename, shared_timeseries.offset, shape, self.inputs.ref_file, self.inputs.engine))
+        results = [pool.apply_async(slice_specific_registration, args=(i,))
+                   for i in range(num_volumes)]
+        # volumes are written in place by the workers, only their index is returned
         results = [p.get() for p in results]
-        # enforce proper order of the slices
-        results.sort()
-        results = [r[1] for r in results]
-
-        timeseries_array = sitk.GetArrayFromImage(timeseries_image)
-        for i in range(timeseries_image.GetSize()[3]):
-            timeseries_array[i, :, :, :] = results[i]
-
-        # clip potential negative values
-        timeseries_array[(timeseries_array < 0).astype(bool)] = 0
-        resampled_timeseries = sitk.GetImageFromArray(
-            timeseries_array, isVector=False)
-        resampled_timeseries.CopyInformation(timeseries_image)
+        pool.close()
+        pool.join()
 
-        import pathlib  # Better path manipulation
-        split = pathlib.Path(self.inputs.name_source).name.rsplit(".nii")
-        out_name = os.path.abspath(split[0]+'_slice_mc.nii.gz')
-        sitk.WriteImage(resampled_timeseries, out_name)
+        close_4D_memmap(shared_timeseries, out_name)
 
         setattr(self, 'mc_corrected_bold', out_name)
 
@@ -532,82 +895,329 @@ class slice_applyTransformsInputSpec(BaseInterfaceInputSpec):
         exists=True, desc="xforms from head motion estimation .csv file")
     resampling_dim = traits.Str(
         desc="Specification for the dimension of resampling.")
+    composite_warp = File(exists=True,
+                          desc="Displacement field precomposed from the transforms by ComposeTransforms. If provided, the transforms aren't read again.")
+    name_source = File(exists=True, mandatory=True,
+                       desc='Reference BOLD file for naming the output.')
     rabies_data_type = traits.Int(mandatory=True,
                                   desc="Integer specifying SimpleITK data type.")
+    n_procs = traits.Int(1, usedefault=True,
+                         desc="Number of threads used for resampling.")
+    intermediate_format = traits.Enum('nii.gz', 'nii', usedefault=True,
+                                      desc="Format of the 4D images written in the working directory. Uncompressed .nii avoids the gzip compression of intermediates.")
 
 
 class slice_applyTransformsOutputSpec(TraitedSpec):
-    out_files = traits.List(
-        desc="warped images after the application of the transforms")
+    out_file = File(exists=True,
+                    desc="4D timeseries after the application of the transforms")
 
 
 class slice_applyTransforms(BaseInterface):
     """
     This interface will apply a set of transforms to an input 4D EPI as well as motion realignment if specified.
-    Susceptibility distortion correction can be applied through the provided transforms. A list of the corrected
-    single volumes will be provided as outputs, and these volumes require to be merged to recover timeseries.
+    Susceptibility distortion correction can be applied through the provided transforms. The timeseries is
+    loaded once, the static chain of transforms is composed into a single displacement field on the
+    resampling grid, and each volume is resampled in memory with its own rigid motion parameters before
+    the corrected timeseries is written as a single 4D file.
     """
 
     input_spec = slice_applyTransformsInputSpec
     output_spec = slice_applyTransformsOutputSpec
 
     def _run_interface(self, runtime):
-        # resampling the reference image to the dimension of the EPI
-        import SimpleITK as sitk
         import os
-        from rabies.preprocess_pkg.utils import run_command
+        import SimpleITK as sitk
+        from nipype.interfaces.base import isdefined
+        from rabies.preprocess_pkg.utils import load_transforms, compose_displacement_field, new_composite_transform, get_resampling_grid, copyInfo_3DImage, init_4D_memmap, close_4D_memmap
 
-        img = sitk.ReadImage(self.inputs.in_file, self.inputs.rabies_data_type)
+        img = sitk.ReadImage(self.inputs.in_file, sitk.sitkFloat32)
+        num_volumes = img.GetSize()[3]
 
-        if not self.inputs.resampling_dim == 'origin':
-            shape = self.inputs.resampling_dim.split('x')
-            spacing = (float(shape[0]), float(shape[1]), float(shape[2]))
-        else:
-            spacing = img.GetSpacing()[:3]
-        resampled = resample_image_spacing(sitk.ReadImage(
-            self.inputs.ref_file, self.inputs.rabies_data_type), spacing)
-        sitk.WriteImage(resampled, 'resampled.nii.gz')
-
-        # tranforms is a list of transform files, set in order of call within antsApplyTransforms
-        transform_string = ""
-        for transform, inverse in zip(self.inputs.transforms, self.inputs.inverses):
-            if bool(inverse):
-                transform_string += "-t [%s,1] " % (transform,)
-            else:
-                transform_string += "-t %s " % (transform,)
+        resampled = get_resampling_grid(
+            self.inputs.ref_file, self.inputs.resampling_dim, img.GetSpacing()[:3], self.inputs.rabies_data_type)
 
-        print("Splitting bold file into lists of single volumes")
-        [bold_volumes, num_volumes] = split_volumes(
-            self.inputs.in_file, "bold_", self.inputs.rabies_data_type)
+        # the static transforms are the same for every volume, so they are composed only once
+        if isdefined(self.inputs.composite_warp):
+            displacement_field = sitk.DisplacementFieldTransform(
+                sitk.ReadImage(self.inputs.composite_warp, sitk.sitkVectorFloat64))
+        else:
+            static_transform = load_transforms(
+                self.inputs.transforms, self.inputs.inverses)
+            displacement_field = sitk.DisplacementFieldTransform(
+                compose_displacement_field(static_transform, resampled))
 
         if self.inputs.apply_motcorr:
-            motcorr_params = self.inputs.motcorr_params
-        ref_img = os.path.abspath('resampled.nii.gz')
-        warped_volumes = []
-        for x in range(0, num_volumes):
-            warped_vol_fname = os.path.abspath(
-                "deformed_volume" + str(x) + ".nii.gz")
-            warped_volumes.append(warped_vol_fname)
+            from rabies.preprocess_pkg.confounds import extract_rigid_movpar
+            movpar = extract_rigid_movpar(self.inputs.motcorr_params)
+            if not movpar.shape[0] == num_volumes:
+                raise ValueError("The number of motion parameters (%s) doesn't match the number of volumes (%s)." % (
+                    movpar.shape[0], num_volumes))
+
+        resampler = sitk.ResampleImageFilter()
+        resampler.SetReferenceImage(resampled)
+        # 5th-order B-spline, as the BSpline[5] interpolation of antsApplyTransforms; SimpleITK < 2.0 only
+        # provides up to the cubic B-spline interpolator
+        resampler.SetInterpolator(getattr(sitk, 'sitkBSpline5', sitk.sitkBSpline))
+        resampler.SetDefaultPixelValue(0)
+        resampler.SetNumberOfThreads(self.inputs.n_procs)
+
+        import pathlib  # Better path manipulation
+        filename_split = pathlib.Path(
+            self.inputs.name_source).name.rsplit(".nii")
+        combined_file = os.path.abspath(
+            "%s_combined.%s" % (filename_split[0], self.inputs.intermediate_format))
+        # each volume is written to its slot in the output file as soon as it is resampled
+        combined = init_4D_memmap(combined_file, resampled, num_volumes,
+                                  img.GetSpacing()[3], self.inputs.rabies_data_type)
+
+        timeseries_array = sitk.GetArrayViewFromImage(img)
+        for x in range(num_volumes):
+            transform = new_composite_transform()
+            transform.AddTransform(displacement_field)
             if self.inputs.apply_motcorr:
-                command = 'antsMotionCorrStats -m %s -o motcorr_vol%s.mat -t %s' % (
-                    motcorr_params, x, x)
-                rc = run_command(command)
-                command = 'antsApplyTransforms -i %s %s-t motcorr_vol%s.mat -n BSpline[5] -r %s -o %s' % (
-                    bold_volumes[x], transform_string, x, ref_img, warped_vol_fname)
-                rc = run_command(command)
-            else:
-                command = 'antsApplyTransforms -i %s %s-n BSpline[5] -r %s -o %s' % (
-                    bold_volumes[x], transform_string, ref_img, warped_vol_fname)
-                rc = run_command(command)
-            # change image to specified data type
-            sitk.WriteImage(sitk.ReadImage(warped_vol_fname,
-                                           self.inputs.rabies_data_type), warped_vol_fname)
-
-        setattr(self, 'out_files', warped_volumes)
+                # the motion realignment is the last transform called, as it was with antsApplyTransforms
+                motcorr = sitk.Euler3DTransform()
+                motcorr.SetParameters([float(p) for p in movpar[x, :]])
+                transform.AddTransform(motcorr)
+            resampler.SetTransform(transform)
+
+            volume = copyInfo_3DImage(sitk.GetImageFromArray(
+                timeseries_array[x, :, :, :], isVector=False), img)
+            warped = sitk.GetArrayFromImage(sitk.Cast(
+                resampler.Execute(volume), self.inputs.rabies_data_type))
+            # clip potential negative values
+            warped[(warped < 0).astype(bool)] = 0
+            combined[:, :, :, x] = warped.transpose(2, 1, 0)
+        close_4D_memmap(combined, combined_file)
+
+        setattr(self, 'out_file', combined_file)
         return runtime
 
     def _list_outputs(self):
-        return {'out_files': getattr(self, 'out_files')}
+        return {'out_file': getattr(self, 'out_file')}
+
+
+def new_composite_transform(dimension=3):
+    # SimpleITK 2.x moved the composite API to its own class
+    if hasattr(sitk, 'CompositeTransform'):
+        return sitk.CompositeTransform(dimension)
+    return sitk.Transform(dimension, sitk.sitkComposite)
+
+
+def load_transforms(transforms, inverses):
+    '''
+    Loads a list of transform files into a single composite transform, following the
+    same conventions as antsApplyTransforms: the transforms are listed in order of call,
+    hence the last one listed is the first applied to the points of the reference space.
+    Affine files are inverted when specified, and displacement fields are read as images.
+    '''
+    import SimpleITK as sitk
+    composite = new_composite_transform()
+    for transform, inverse in zip(transforms, inverses):
+        if transform == 'NULL':
+            continue
+        if '.nii' in transform:
+            if bool(inverse):
+                raise ValueError(
+                    "Displacement fields can't be inverted. Provide the inverse warp instead of %s" % (transform,))
+            field = sitk.ReadImage(transform, sitk.sitkVectorFloat64)
+            composite.AddTransform(sitk.DisplacementFieldTransform(field))
+        else:
+            tf = sitk.ReadTransform(transform)
+            if bool(inverse):
+                tf = tf.GetInverse()
+            composite.AddTransform(tf)
+    return composite
+
+
+def compose_displacement_field(transform, reference, padding=0.1):
+    '''
+    Collapses a transform into a single displacement field image sampled on the grid of the reference image.
+    The grid is padded by a fraction of its size on each side, since the field is evaluated after
+    the motion realignment, which can move points slightly outside of the reference field of view.
+    '''
+    import numpy as np
+    import SimpleITK as sitk
+    pad = (np.ceil(np.asarray(reference.GetSize())*padding)+2).astype(int)
+    size = [int(s) for s in np.asarray(reference.GetSize())+2*pad]
+    direction = np.asarray(reference.GetDirection()).reshape(3, 3)
+    origin = np.asarray(reference.GetOrigin()) - \
+        direction.dot(np.asarray(reference.GetSpacing())*pad)
+    return sitk.TransformToDisplacementField(transform, sitk.sitkVectorFloat64, size,
+                                             [float(o) for o in origin], reference.GetSpacing(), reference.GetDirection())
+
+
+def resample_label_images(label_files, reference, out_files, transform=None):
+    '''
+    Resamples a set of mask/label images onto the grid of the reference image, through an optional transform
+    (identity otherwise), with a single resampling filter configured once for all images. Label interpolation
+    follows antsApplyTransforms' GenericLabel where SimpleITK provides it (sitkLabelLinear), and falls back
+    to nearest neighbour otherwise. The outputs are written as Int16.
+    '''
+    import SimpleITK as sitk
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetReferenceImage(reference)
+    resampler.SetOutputPixelType(sitk.sitkInt16)
+    resampler.SetDefaultPixelValue(0)
+    if hasattr(sitk, 'sitkLabelLinear'):
+        resampler.SetInterpolator(sitk.sitkLabelLinear)
+    else:
+        resampler.SetInterpolator(sitk.sitkNearestNeighbor)
+    if transform is not None:
+        resampler.SetTransform(transform)
+    for label_file, out_file in zip(label_files, out_files):
+        sitk.WriteImage(resampler.Execute(
+            sitk.ReadImage(label_file, sitk.sitkInt32)), out_file)
+    return out_files
+
+
+def get_resampling_grid(ref_file, resampling_dim, input_spacing, rabies_data_type=8):
+    # resampling the reference image to the dimension specified, or to the dimension of the input EPI with 'origin'
+    import SimpleITK as sitk
+    from rabies.preprocess_pkg.utils import resample_image_spacing
+    if not resampling_dim == 'origin':
+        shape = resampling_dim.split('x')
+        spacing = (float(shape[0]), float(shape[1]), float(shape[2]))
+    else:
+        spacing = tuple(input_spacing)
+    return resample_image_spacing(sitk.ReadImage(ref_file, rabies_data_type), spacing)
+
+
+def file_hash(filename, block_size=2**20):
+    import hashlib
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def cached_displacement_field(transforms, inverses, reference, cache_dir):
+    '''
+    Composes a list of transforms into a displacement field on the grid of the reference image (see
+    compose_displacement_field), which is stored in cache_dir under a key derived from the content of the
+    transform files, the inverse flags and the grid. The field is only composed if it isn't already cached.
+    '''
+    import os
+    import hashlib
+    import numpy as np
+    import SimpleITK as sitk
+    from rabies.preprocess_pkg.utils import load_transforms, compose_displacement_field, file_hash
+
+    key = hashlib.sha1()
+    for transform, inverse in zip(transforms, inverses):
+        if transform == 'NULL':
+            continue
+        key.update(('%s,%s;' % (file_hash(transform), int(bool(inverse)))).encode())
+    key.update(str((reference.GetSize(), np.round(reference.GetOrigin(), 6).tolist(),
+                    np.round(reference.GetSpacing(), 6).tolist(), np.round(reference.GetDirection(), 6).tolist())).encode())
+    field_name = 'composite_warp_%s.nii' % (key.hexdigest(),)
+
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    composite_warp = '%s/%s' % (cache_dir, field_name)
+
+    if os.path.isfile(composite_warp):
+        print("Using cached composite transform %s" % (composite_warp,))
+    else:
+        field = compose_displacement_field(
+            load_transforms(transforms, inverses), reference)
+        # write under a temporary name to avoid exposing partial files to concurrent nodes
+        tmp_file = '%s/.%s_%s.nii' % (cache_dir,
+                                      field_name.rsplit('.nii')[0], os.getpid())
+        sitk.WriteImage(field, tmp_file)
+        os.replace(tmp_file, composite_warp)
+    return composite_warp
+
+
+class ComposeTransformsInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc="Input 4D EPI, from which the spacing is taken if resampling_dim is 'origin'.")
+    ref_file = File(exists=True, mandatory=True,
+                    desc="The reference 3D space to which the EPI will be warped.")
+    transforms = traits.List(desc="List of transforms to compose")
+    inverses = traits.List(
+        desc="Define whether some transforms must be inverse, with a boolean list where true defines inverse e.g.[0,1,0]")
+    resampling_dim = traits.Str(
+        desc="Specification for the dimension of resampling.")
+    cache_dir = traits.Str(
+        desc="Directory where composed fields are stored for reuse. If not provided, the field is written in the working directory.")
+    rabies_data_type = traits.Int(mandatory=True,
+                                  desc="Integer specifying SimpleITK data type.")
+
+
+class ComposeTransformsOutputSpec(TraitedSpec):
+    composite_warp = File(
+        exists=True, desc="Displacement field composed from the list of transforms.")
+
+
+class ComposeTransforms(BaseInterface):
+    """
+    Collapses the chain of static transforms (e.g. bold to anat, anat to template, template to commonspace)
+    into a single displacement field on the resampling grid, so that only the motion realignment remains
+    to be composed for each volume. Fields are cached with a key derived from the content of the
+    transform files, the inverse flags and the resampling grid, so that the same chain is only
+    composed once across workflow re-runs and resampling passes.
+    """
+
+    input_spec = ComposeTransformsInputSpec
+    output_spec = ComposeTransformsOutputSpec
+
+    def _run_interface(self, runtime):
+        import os
+        import SimpleITK as sitk
+        from nipype.interfaces.base import isdefined
+        from rabies.preprocess_pkg.utils import get_resampling_grid, cached_displacement_field
+
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(self.inputs.in_file)
+        reader.ReadImageInformation()
+        resampled = get_resampling_grid(
+            self.inputs.ref_file, self.inputs.resampling_dim, reader.GetSpacing()[:3], self.inputs.rabies_data_type)
+
+        if isdefined(self.inputs.cache_dir):
+            cache_dir = self.inputs.cache_dir
+        else:
+            cache_dir = os.getcwd()
+        composite_warp = cached_displacement_field(
+            self.inputs.transforms, self.inputs.inverses, resampled, cache_dir)
+
+        setattr(self, 'composite_warp', composite_warp)
+        return runtime
+
+    def _list_outputs(self):
+        return {'composite_warp': getattr(self, 'composite_warp')}
+
+
+class CompressedDataSinkInputSpec(DataSinkInputSpec):
+    compresslevel = traits.Range(low=1, high=9, value=1, usedefault=True,
+                                 desc="gzip compression level of the uncompressed .nii outputs.")
+
+
+class CompressedDataSink(DataSink):
+    """
+    DataSink which compresses the uncompressed .nii files it receives into .nii.gz, so that intermediates
+    can be kept uncompressed within the working directory and only the outputs are compressed, with a
+    fast compression level by default.
+    """
+
+    input_spec = CompressedDataSinkInputSpec
+
+    def _list_outputs(self):
+        import os
+        import gzip
+        import shutil
+        outputs = super(CompressedDataSink, self)._list_outputs()
+        out_files = []
+        for out_file in outputs['out_file']:
+            if out_file.endswith('.nii') and os.path.isfile(out_file):
+                with open(out_file, 'rb') as f_in, gzip.open(out_file+'.gz', 'wb', compresslevel=self.inputs.compresslevel) as f_out:
+                    shutil.copyfileobj(f_in, f_out, 2**24)
+                os.remove(out_file)
+                out_file += '.gz'
+            out_files.append(out_file)
+        outputs['out_file'] = out_files
+        return outputs
 
 
 def split_volumes(in_file, output_prefix, rabies_data_type):
@@ -637,74 +1247,80 @@ def split_volumes(in_file, output_prefix, rabies_data_type):
     return [volumes, num_volumes]
 
 
-class MergeInputSpec(BaseInterfaceInputSpec):
-    in_files = InputMultiPath(File(exists=True), mandatory=True,
-                              desc='input list of files to merge, listed in the order to merge')
-    header_source = File(exists=True, mandatory=True,
-                         desc='a Nifti file from which the header should be copied')
-    rabies_data_type = traits.Int(mandatory=True,
-                                  desc="Integer specifying SimpleITK data type.")
-
-
-class MergeOutputSpec(TraitedSpec):
-    out_file = File(exists=True, desc='output merged file')
+def sitk_to_numpy_dtype(rabies_data_type):
+    # numpy data type associated to a SimpleITK pixel type
+    import SimpleITK as sitk
+    return sitk.GetArrayViewFromImage(sitk.Image([1, 1, 1], rabies_data_type)).dtype
 
 
-class Merge(BaseInterface):
-    """
-    Takes a list of 3D Nifti files and merge them in the order listed.
-    """
+def sitk_affine(image):
+    # RAS affine matrix of a 3D SimpleITK image, following the NIfTI convention
+    import numpy as np
+    affine = np.eye(4)
+    affine[:3, :3] = np.asarray(image.GetDirection()).reshape(
+        3, 3).dot(np.diag(image.GetSpacing()))
+    affine[:3, 3] = image.GetOrigin()
+    return np.diag([-1, -1, 1, 1]).dot(affine)
 
-    input_spec = MergeInputSpec
-    output_spec = MergeOutputSpec
 
-    def _run_interface(self, runtime):
-        import os
-        import numpy as np
-        import SimpleITK as sitk
+def init_4D_memmap(filename, ref_3d, num_volumes, TR, rabies_data_type):
+    '''
+    Preallocates an uncompressed 4D nifti on disk with the geometry of ref_3d and returns a
+    memmap to its data, with the (x,y,z,t) nifti layout, so that volumes can be written one at a
+    time with bounded memory. The file is completed with close_4D_memmap.
+    '''
+    import os
+    import numpy as np
+    import nibabel as nb
+    from rabies.preprocess_pkg.utils import sitk_to_numpy_dtype, sitk_affine
+
+    dtype = sitk_to_numpy_dtype(rabies_data_type)
+    shape = tuple(ref_3d.GetSize())+(int(num_volumes),)
+    affine = sitk_affine(ref_3d)
+    header = nb.Nifti1Header()
+    header.set_data_dtype(dtype)
+    header.set_data_shape(shape)
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    header.set_zooms(tuple(ref_3d.GetSpacing())+(float(TR),))
+    header.set_xyzt_units('mm', 'sec')
+    # single-file NIfTI-1 requires the data to start at vox_offset >= 352 (header + extension flag)
+    offset = 352
+    header.set_data_offset(offset)
+
+    if filename.endswith('.gz'):
+        nii_file = filename[:-3]
+    else:
+        nii_file = filename
+    with open(nii_file, 'wb') as f:
+        header.write_to(f)
+        if f.tell() < offset:
+            f.write(b'\x00'*(offset-f.tell()))
+        f.truncate(offset+int(np.prod(shape))*dtype.itemsize)
+    return np.memmap(nii_file, dtype=dtype, mode='r+', offset=offset, shape=shape, order='F')
 
-        import pathlib  # Better path manipulation
-        filename_split = pathlib.Path(
-            self.inputs.header_source).name.rsplit(".nii")
-
-        sample_volume = sitk.ReadImage(
-            self.inputs.in_files[0], self.inputs.rabies_data_type)
-        length = len(self.inputs.in_files)
-        shape = sitk.GetArrayFromImage(sample_volume).shape
-        combined = np.zeros((length, shape[0], shape[1], shape[2]))
-
-        i = 0
-        for file in self.inputs.in_files:
-            combined[i, :, :, :] = sitk.GetArrayFromImage(
-                sitk.ReadImage(file, self.inputs.rabies_data_type))[:, :, :]
-            i = i+1
-        if (i != length):
-            raise ValueError("Error occured with Merge.")
-        combined_files = os.path.abspath(
-            "%s_combined.nii.gz" % (filename_split[0],))
-
-        # clip potential negative values
-        combined[(combined < 0).astype(bool)] = 0
-        combined_image = sitk.GetImageFromArray(combined, isVector=False)
-
-        # set metadata and affine for the newly constructed 4D image
-        header_source = sitk.ReadImage(
-            self.inputs.header_source, self.inputs.rabies_data_type)
-        combined_image = copyInfo_4DImage(
-            combined_image, sample_volume, header_source)
-        sitk.WriteImage(combined_image, combined_files)
-
-        setattr(self, 'out_file', combined_files)
-        return runtime
 
-    def _list_outputs(self):
-        return {'out_file': getattr(self, 'out_file')}
+def close_4D_memmap(memmap, filename):
+    '''
+    Flushes a memmap created by init_4D_memmap, and compresses the file if filename is a .nii.gz.
+    '''
+    import os
+    import gzip
+    import shutil
+    memmap.flush()
+    nii_file = memmap.filename
+    del memmap
+    if filename.endswith('.gz'):
+        with open(nii_file, 'rb') as f_in, gzip.open(filename, 'wb', compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, 2**24)
+        os.remove(nii_file)
+    return filename
 
 
 def copyInfo_4DImage(image_4d, ref_3d, ref_4d):
     # function to establish metadata of an input 4d image. The ref_3d will provide
     # the information for the first 3 dimensions, and the ref_4d for the 4th.
-    if ref_3d.GetMetaData('dim[0]') == '4':
+    if ref_3d.GetDimension() == 4:
         image_4d.SetSpacing(
             tuple(list(ref_3d.GetSpacing()[:3])+[ref_4d.GetSpacing()[3]]))
         image_4d.SetOrigin(
@@ -713,7 +1329,7 @@ def copyInfo_4DImage(image_4d, ref_3d, ref_4d):
         dim_4d = list(ref_4d.GetDirection())
         image_4d.SetDirection(
             tuple(dim_3d[:3]+[dim_4d[3]]+dim_3d[4:7]+[dim_4d[7]]+dim_3d[8:11]+dim_4d[11:]))
-    elif ref_3d.GetMetaData('dim[0]') == '3':
+    elif ref_3d.GetDimension() == 3:
         image_4d.SetSpacing(
             tuple(list(ref_3d.GetSpacing())+[ref_4d.GetSpacing()[3]]))
         image_4d.SetOrigin(
@@ -728,12 +1344,12 @@ def copyInfo_4DImage(image_4d, ref_3d, ref_4d):
 
 
 def copyInfo_3DImage(image_3d, ref_3d):
-    if ref_3d.GetMetaData('dim[0]') == '4':
+    if ref_3d.GetDimension() == 4:
         image_3d.SetSpacing(ref_3d.GetSpacing()[:3])
         image_3d.SetOrigin(ref_3d.GetOrigin()[:3])
         dim_3d = list(ref_3d.GetDirection())
         image_3d.SetDirection(tuple(dim_3d[:3]+dim_3d[4:7]+dim_3d[8:11]))
-    elif ref_3d.GetMetaData('dim[0]') == '3':
+    elif ref_3d.GetDimension() == 3:
         image_3d.SetSpacing(ref_3d.GetSpacing())
         image_3d.SetOrigin(ref_3d.GetOrigin())
         image_3d.SetDirection(ref_3d.GetDirection())
@@ -764,7 +1380,7 @@ def resample_image_spacing(image, output_spacing):
     return pos_resampled_image
 
 
-def convert_to_RAS(img_file, out_dir=None):
+def convert_to_RAS(img_file, out_dir=None, intermediate_format='nii.gz'):
     # convert the input image to the RAS orientation convention
     import os
     import nibabel as nb
@@ -775,9 +1391,9 @@ def convert_to_RAS(img_file, out_dir=None):
         import pathlib  # Better path manipulation
         split = pathlib.Path(img_file).name.rsplit(".nii")
         if out_dir is None:
-            out_file = os.path.abspath(split[0]+'_RAS.nii.gz')
+            out_file = os.path.abspath(split[0]+'_RAS.'+intermediate_format)
         else:
-            out_file = out_dir+'/'+split[0]+'_RAS.nii.gz'
+            out_file = out_dir+'/'+split[0]+'_RAS.'+intermediate_format
             if not os.path.isdir(out_dir):
                 os.makedirs(out_dir)
         nb.as_closest_canonical(img).to_filename(out_file)
@@ -789,21 +1405,20 @@ def resample_template(template_file, file_list, spacing='inputs_defined', rabies
     import SimpleITK as sitk
     import numpy as np
     from rabies.preprocess_pkg.utils import resample_image_spacing
+    from rabies.preprocess_pkg.image_io import read_image_information, read_image, write_image
 
     if spacing == 'inputs_defined':
         file_list = list(np.asarray(file_list).flatten())
-        img = sitk.ReadImage(file_list[0], rabies_data_type)
+        img = read_image_information(file_list[0])
         low_dim = np.asarray(img.GetSpacing()[:3]).min()
         for file in file_list[1:]:
-            img = sitk.ReadImage(file, rabies_data_type)
+            img = read_image_information(file)
             new_low_dim = np.asarray(img.GetSpacing()[:3]).min()
             if new_low_dim < low_dim:
                 low_dim = new_low_dim
         spacing = (low_dim, low_dim, low_dim)
 
-        template_image = sitk.ReadImage(
-            template_file, rabies_data_type)
-        template_dim = template_image.GetSpacing()
+        template_dim = read_image_information(template_file).GetSpacing()
         if np.asarray(template_dim[:3]).min() > low_dim:
             print("The template retains its original resolution.")
             return template_file
@@ -814,8 +1429,8 @@ def resample_template(template_file, file_list, spacing='inputs_defined', rabies
     print("Resampling template to %sx%sx%smm dimensions." %
           (spacing[0], spacing[1], spacing[2],))
     resampled_template = os.path.abspath("resampled_template.nii.gz")
-    sitk.WriteImage(resample_image_spacing(sitk.ReadImage(
-        template_file, rabies_data_type), spacing), resampled_template)
+    write_image(resample_image_spacing(read_image(
+        template_file, rabies_data_type), spacing), resampled_template, rabies_data_type)
 
     return resampled_template
 
@@ -83,6 +83,22 @@ def get_parser():
                             "This second motion correction can correct for interslice misalignment resulting from within-TR motion."
                             "With this option, motion corrections and the subsequent resampling from registration are applied sequentially,"
                             "since the 2D slice registrations cannot be concatenate with 3D transforms.")
+    preprocess.add_argument('--slice_mc_engine', type=str, default='sitk',
+                            choices=['sitk', 'vectorized'],
+                            help="Backend for the 2D registrations of --apply_slice_mc. 'sitk' runs a SimpleITK registration "
+                            "for each slice separately, whereas 'vectorized' estimates the rigid transforms of all slices of a "
+                            "volume together in a batched optimization, which is much faster on long scans.")
+    preprocess.add_argument('--motion_engine', type=str, default='ants',
+                            choices=['ants', 'native'],
+                            help="Select how volumes are realigned for head motion estimation and the generation of reference EPIs. "
+                            "'ants' runs antsMotionCorr, whereas 'native' conducts the same rigid realignment "
+                            "in-process with SimpleITK, and reuses the estimates from the generation of the reference EPI "
+                            "to warm-start head motion estimation.")
+    preprocess.add_argument('--intermediate_format', type=str, default='nii.gz',
+                            choices=['nii.gz', 'nii'],
+                            help="File format of the timeseries written in the working directory. With 'nii', intermediate "
+                            "files are kept uncompressed to avoid spending CPU time on gzip compression, and only the "
+                            "outputs are compressed to .nii.gz (with a fast compression level) in the output folder.")
     preprocess.add_argument('--detect_dummy', dest='detect_dummy', action='store_true',
                             help="Detect and remove initial dummy volumes from the EPI, and generate "
                             "a reference EPI based on these volumes if detected."
@@ -158,6 +174,10 @@ def get_parser():
     g_stc.add_argument('--tpattern', type=str, default='alt',
                        choices=['alt', 'seq'],
                        help="Specify if interleaved or sequential acquisition. 'alt' for interleaved, 'seq' for sequential.")
+    g_stc.add_argument('--stc_engine', type=str, default='afni',
+                       choices=['afni', 'native'],
+                       help="Select 'afni' to apply 3dTshift, or 'native' to conduct the same quintic interpolation "
+                       "in-process, without the AFNI dependency.")
 
     g_atlas = preprocess.add_argument_group(
         'Provided commonspace atlas files.')
@@ -233,6 +253,11 @@ def get_parser():
                                      default=False,
                                      help="Run a diagnosis for each individual image by computing melodic-ICA on the corrected timeseries,"
                                      "and compute a tSNR map from the input uncorrected image.")
+    confound_regression.add_argument('--timeseries_store', dest='timeseries_store', action='store_true',
+                                     default=False,
+                                     help="Also save the cleaned timeseries as a chunked HDF5 store of timepoints X in-mask voxels, "
+                                     "together with the mask indices. The analysis steps then read only the voxels they need from the store "
+                                     "instead of decoding the whole 4D image.")
 
     analysis.add_argument('confound_regression_out', action='store', type=Path,
                           help='path to RABIES confound regression output directory with the datasink.')
@@ -253,10 +278,37 @@ def get_parser():
                              help="Define the types of ROI to extract regional timeseries for correlation matrix analysis. "
                              "Options are 'parcellated', in which case the atlas labels provided for preprocessing are used as ROIs, or "
                              "'voxelwise', in which case all voxel timeseries are cross-correlated.")
+    g_fc_matrix.add_argument("--voxelwise_FC_format", type=str, default='npy',
+                             choices=['npy', 'h5', 'pkl', 'sparse'],
+                             help="Output format of the voxelwise FC matrix, which is computed by blocks of voxels. 'npy' and 'h5' stream "
+                             "the dense matrix in float32 to a memory-mappable .npy or HDF5 file, 'pkl' holds the dense float32 matrix in "
+                             "memory to pickle it, and 'sparse' only keeps the strongest edges in a scipy sparse CSR matrix (.npz), as defined by "
+                             "--voxelwise_FC_top_k or --voxelwise_FC_threshold.")
+    g_fc_matrix.add_argument("--voxelwise_FC_top_k", type=int, default=0,
+                             help="With --voxelwise_FC_format sparse, keep the k edges with the highest absolute correlation for each voxel. "
+                             "If 0, edges are selected with --voxelwise_FC_threshold instead.")
+    g_fc_matrix.add_argument("--voxelwise_FC_threshold", type=float, default=0.25,
+                             help="Correlation threshold defining the edges of each voxel for the voxel degree map, and which absolute "
+                             "correlations are kept with --voxelwise_FC_format sparse when --voxelwise_FC_top_k is 0.")
+    g_group_stats = analysis.add_argument_group(
+        'Options for aggregating the per-scan analysis outputs at the group level.')
+    g_group_stats.add_argument("--group_stats", dest='group_stats', action='store_true',
+                               help="Stream the per-scan FC matrices (--FC_matrix) and dual regression maps (--DR_ICA) into one group store each, "
+                               "while deriving the group mean and variance, and the group mean of Fisher z-transformed FC matrices.")
+    g_group_stats.add_argument("--group_store_format", type=str, default='h5',
+                               choices=['h5', 'npy'],
+                               help="Format of the group stores: a single HDF5 file with the stacked scans, group statistics and scan list ('h5'), "
+                               "or a memory-mappable .npy file of the stacked scans, with the statistics and scan list in an .npz file ('npy').")
     g_group_ICA = analysis.add_argument_group("Options for performing group-ICA using FSL's MELODIC on the whole dataset cleaned timeseries."
                                               "Note that confound regression must have been conducted on commonspace outputs.")
     g_group_ICA.add_argument("--group_ICA", dest='group_ICA', action='store_true',
                              help="Choose this option to conduct group-ICA.")
+    g_group_ICA.add_argument('--group_ICA_engine', type=str, default='melodic',
+                             choices=['melodic', 'native'],
+                             help="Engine for group-ICA. 'melodic' runs FSL's MELODIC on the concatenated scans, and 'native' runs an in-process "
+                             "incremental group-PCA (MIGP), streaming the scans from disk, followed by FastICA. Both provide a melodic_IC.nii.gz file "
+                             "for dual regression. The native engine doesn't estimate the dimensionality automatically, and derives 20 components if "
+                             "--dim is 0.")
     g_group_ICA.add_argument('--TR', type=str, default='1.0s',
                              help="Specify repetition time (TR) in seconds.")
     g_group_ICA.add_argument('--dim', type=int, default=0,